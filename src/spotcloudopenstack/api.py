@@ -4,37 +4,96 @@ Set of HTTP API calls for SpotCloud
 """
 
 import json
-import urllib
 import re
-import cgi
-
+import time
+import urllib
+from datetime import datetime
 
-from flask import request, jsonify, abort
+from flask import Blueprint, request, jsonify, abort, Response, g
+from werkzeug.routing import BaseConverter
 
 from spotcloudopenstack.app import app, db
 from spotcloudopenstack.models import HardwareTemplate, VM, Task, Package
 from spotcloudopenstack.provision import ProvisionWorker
-from spotcloudopenstack.novaconn import get_nova_connection
+from spotcloudopenstack.novaconn import nova_connection
 from spotcloudopenstack.auth import check_auth, WrongAuth
+from spotcloudopenstack.reconciler import get_reconciler
+from spotcloudopenstack.scheduler import get_scheduler
+from spotcloudopenstack.catalog import cached
+from spotcloudopenstack.capacity import get_capacity
+from spotcloudopenstack.retention import get_retention
+from spotcloudopenstack.provisiond import get_lease_keeper, LeasedJob
+from spotcloudopenstack import metrics
 
 import logging
 logger = logging.getLogger('spotcloudopenstack')
 
 
-@app.route("/rest/hosting/<path:path>",
-           methods = ["GET", "PUT", "POST", "DELETE"])
-def rest(path):
-    """ Dispatcher method was created as workoround,
-    but now used for central auth chek then 
-    dispatching to the particular api methods.
-    It could be removed in future.
+PREFIX = '/rest/hosting'
+METRICS_ENABLED = False
+METRICS_ALLOWED_ADDRS = ('127.0.0.1', '::1')
+
+hosting = Blueprint('hosting', __name__, url_prefix=PREFIX)
+_labels = {}
+
+
+class UUIDConverter(BaseConverter):
+    "Lower case UUID as SpotCloud sends it, kept as a string"
+    regex = '[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}'
+
+app.url_map.converters['uuid'] = UUIDConverter
+
+
+class QueryInPath(object):
+    """WSGI middleware for SpotCloud calls with query string
+    quoted into the path as %3F: the part after '?' is moved
+    to QUERY_STRING, trailing slash is dropped, so
+    the precompiled routes match
+
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(PREFIX):
+            if '?' in path:
+                path, query = path.split('?', 1)
+                # PATH_INFO is decoded, QUERY_STRING is not: quote it
+                # back, so both forms are decoded the same times
+                query = urllib.quote(query, safe='=&;')
+                if environ.get('QUERY_STRING'):
+                    query += '&' + environ['QUERY_STRING']
+                environ['QUERY_STRING'] = query
+            if path.endswith('/') and len(path) > len(PREFIX) + 1:
+                path = path.rstrip('/')
+            environ['PATH_INFO'] = path
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = QueryInPath(app.wsgi_app)
+
+
+def route(rule, methods=('GET',)):
+    """Register view for rule under /rest/hosting,
+    the rule without converter names labels its metrics
 
     """
-    if '?' in path:
-        path = path.split('?')[0]
+    def decorator(view):
+        _labels['hosting.' + view.__name__] = re.sub(
+            r'<(\w+):\w+>', r'<\1>', rule).lstrip('/')
+        return hosting.route(rule, methods=list(methods))(view)
+    return decorator
+
+
+@hosting.before_request
+def start_timer():
+    logger.debug("Got %s to %s", request.method, request.path)
+    g.api_started = time.time()
+
 
-    logger.debug("Got %s to %s" % (
-            request.method, path))
+@hosting.before_request
+def authenticate():
+    "Digest auth is checked once for every route"
     try:
         check_auth()
         logger.debug("Auth OK")
@@ -44,61 +103,65 @@ def rest(path):
             errno=1,
             message="Wrong digest auth: %s" % str(e))
 
-        
-    url2method = {
-        'htemplate/list': htemplate_list,
-        'utilization': utilization,
-        'ptemplate/list': ptemplate_list,
-        'network/list': network_list,
-        'vm/list': vm_list,
-        'vm': vm_put
-       }
-
-    view = url2method.get(path)
-    if view:
-        return view()
-    
-    match = re.search(
-        'vm/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/?', 
-        path)
-    if match:
-        return vm_uuid(match.group(1))
-    
-    abort(404)
+
+@hosting.teardown_request
+def observe_time(exc):
+    started = getattr(g, 'api_started', None)
+    if started is not None:
+        metrics.API_SECONDS.observe(
+            time.time() - started,
+            _labels.get(request.endpoint, 'unknown'), request.method)
+
+
+@app.route("/metrics")
+def metrics_text():
+    """Expose metrics for Prometheus. It is outside of digest auth,
+    so served only if enabled and to allowed addresses
+
+    """
+    if not app.config.get('METRICS_ENABLED', METRICS_ENABLED):
+        abort(404)
+    if request.remote_addr not in app.config.get(
+            'METRICS_ALLOWED_ADDRS', METRICS_ALLOWED_ADDRS):
+        logger.warning("Metrics requested from %s", request.remote_addr)
+        abort(403)
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
 
 
+@route('/htemplate/list')
+@cached(HardwareTemplate)
 def htemplate_list():
-    "Return list of HardwareTemplates"
-    return jsonify(
+    "Return list of HardwareTemplates of existing Nova types"
+    return dict(
         errno=0,
         message='Success',
         templates=[
-            x.to_dict() for x in HardwareTemplate.query.all()])
+            x.to_dict() for x in HardwareTemplate.listed()])
     
 
+@route('/utilization')
 def utilization():
-    "Just dummy method for now"
-    return jsonify(
-        total_memory=8000,
-        free_storage=800000,
-        committed_storage=800000,
-        free_memory=6000,
-        total_storage=800000,
-        loadone=0.1,
-        loadfive=0.1,
-        loadfifteen=0.1,
-        cpus=4)
+    """Return capacity from in-memory model,
+    it is refreshed from Nova in background
 
+    """
+    return jsonify(**get_capacity().snapshot())
 
+
+@route('/ptemplate/list')
+@cached(Package)
 def ptemplate_list():
-    "Return list of Packages"
-    return jsonify(
+    "Return list of ready Packages"
+    return dict(
             errno=0,
             message='Success',
             packages=[
-                x.to_dict() for x in Package.query.all()])
+                x.to_dict() for x in Package.query.filter_by(
+                    state='ready')])
 
 
+@route('/network/list')
 def network_list():
     """This method exists only for SpotCloud 
     backward compatibility. The network info came back
@@ -115,62 +178,92 @@ def network_list():
              'vlan_id': None}])
 
 
+@route('/vm/list')
 def vm_list():
-    "Return list of VMs"
-    VM.sync_with_nova()
+    """Return list of VMs from the snapshot
+    kept in sync with Nova by Reconciler
+
+    """
+    vms, age = get_reconciler().snapshot()
     return jsonify(
         errno=0,
         message="Success",
-        vms=[x.to_dict() for x in VM.query.all()])
+        vms=vms,
+        snapshot_age=age)
 
 
 
-def vm_uuid(vm_uuid):
-    """Return dict on GET, delete on DELETE and
-    delete on POST with action=delete
+@route('/vm/<uuid:vm_uuid>')
+def vm_get(vm_uuid):
+    "Return VM dict from the snapshot or db"
+    vm_dict, age = get_reconciler().get(vm_uuid)
+    if vm_dict is None:
+        # could be created after the snapshot
+        vm = VM.query.get(vm_uuid)
+        if not vm:
+            abort(404)
+        vm_dict = vm.to_dict()
+    return json.dumps(
+        dict(
+            errno=0,
+            message='Success',
+            vm=vm_dict,
+            snapshot_age=age))
 
-    """
 
+@route('/vm/<uuid:vm_uuid>', methods=['DELETE'])
+def vm_delete(vm_uuid):
+    "Terminate Nova instance and delete VM"
     vm = VM.query.get(vm_uuid)
     if not vm:
         abort(404)
+    with nova_connection() as conn:
+        conn.terminate_instances([vm.nova_id])
+    db.session.delete(vm)
+    db.session.commit()
+    msg = "VM %s was deleted" % vm_uuid
+    logger.debug(msg)
+    return json.dumps(
+        dict(
+            errno=0,
+            message=msg))
 
-    if request.method == 'GET':
-        return json.dumps(
-            dict(
-                errno=0,
-                message='Success',
-                vm=vm.to_dict()))
-
-    action_delete = request.method == 'POST' and request.form.get(
-        'action') == 'delete'
 
-    if request.method == 'DELETE' or action_delete:
-        conn = get_nova_connection()
-        conn.terminate_instances([vm.nova_id])
-        db.session.delete(vm)
-        db.session.commit()
-        msg = "VM %s was deleted" % vm_uuid
-        logger.debug(msg)
-        return json.dumps(
-            dict(
-                errno=0,
-                message=msg))
-    
+@route('/vm/<uuid:vm_uuid>', methods=['POST'])
+def vm_post(vm_uuid):
+    "Delete VM on POST with action=delete"
+    if request.form.get('action') == 'delete':
+        return vm_delete(vm_uuid)
+    if not VM.query.get(vm_uuid):
+        abort(404)
     return json.dumps(
         dict(
             errno=1,
             message="This action is not supported"))
 
 
+@route('/provision/stats')
+def provision_stats():
+    "Return queue depth and wait times of provisioning scheduler"
+    return jsonify(
+        errno=0,
+        message='Success',
+        **get_scheduler().stats())
+
+
+@route('/vm', methods=['GET', 'POST', 'DELETE'])
+def vm_not_put():
+    "Kept for SpotCloud, other methods get errno 2 instead of 405"
+    return jsonify(
+        errno=2,
+        message="Only PUT method is allowed"
+        )
+
+
+@route('/vm', methods=['PUT'])
 def vm_put():
-    "Create Task and run ProvisionWorker"
+    "Create Task and queue ProvisionWorker"
     logger.debug("Creating a new VM")
-    if request.method != "PUT":
-        return jsonify(
-            errno=2,
-            message="Only PUT method is allowed"
-            )
     for arg in ['name', 'package', 'hardware']:
         if arg not in request.form:
             return json.dumps(
@@ -179,30 +272,62 @@ def vm_put():
                     message="%s parameter was not provided" % arg))
 
     hardware = HardwareTemplate.query.get(request.form['hardware'])
-    if not hardware:
+    if not hardware or hardware.retired:
         return jsonify(
             errno=1,
             message="HardwareTemplate %s does not exist" % (
                 request.form['hardware'],))
     vm_uuid = request.form['name']
-    task = Task(vm_uuid=vm_uuid)
+    task = Task(vm_uuid=vm_uuid,
+                hardware_uuid=hardware.ecp_uuid,
+                package_uuid=request.form['package'])
+    daemon = app.config.get('PROVISION_MODE', 'inprocess') == 'daemon'
+    if not daemon:
+        # this process runs the task, provisiond takes it over
+        # only when the lease is not renewed
+        keeper = get_lease_keeper()
+        keeper.hold(task)
     db.session.add(task)
     try:
         db.session.commit()
     except Exception, e:
         db.session.rollback()
+        if not daemon:
+            keeper.finished(task.ecp_uuid)
         return json.dumps(
             {'errno': 1,
              'message': str(e)})
+    # every provision adds a task, keep their number bounded
+    get_retention()
     try:
-        ProvisionWorker(vm_uuid, 
-                        task.ecp_uuid, 
-                        hardware.ecp_uuid, 
-                        request.form['package']).start()
+        if not daemon:
+            worker = ProvisionWorker(vm_uuid, 
+                                     task.ecp_uuid, 
+                                     hardware.ecp_uuid, 
+                                     request.form['package'])
+            get_scheduler().submit(LeasedJob(keeper, worker),
+                                   fast=worker.is_fast())
     except Exception, e:
+        message = "Could not start provision: %s" % str(e)
+        if not daemon:
+            # the caller sees an error, so provisiond must not
+            # run the task once its lease expires
+            task.is_error = True
+            task.completed = 100
+            task.ended = datetime.now()
+            task.message = message
+            task.lease_owner = None
+            task.lease_expires = None
+            try:
+                db.session.commit()
+            except Exception, e:
+                db.session.rollback()
+                logger.error("Could not fail task %s: %s",
+                             task.ecp_uuid, e)
+            keeper.finished(task.ecp_uuid)
         return json.dumps(
             {'errno': 1,
-             'message': "Could not start provision: %s" % str(e)})
+             'message': message})
 
     return json.dumps(
         {'errno': 0, 
@@ -210,3 +335,8 @@ def vm_put():
          'txid': task.ecp_uuid,
          'machine_id': vm_uuid})
 
+
+app.register_blueprint(hosting)
+# rules are sorted lazily on the first match, sort them now,
+# so concurrent first requests do not see the list being sorted
+app.url_map.update()
@@ -0,0 +1,235 @@
+"""
+Load benchmark of the API against FakeNovaServer.
+Latency percentiles of vm/list, vm/<uuid>, get_instance_id
+and VM.sync_with_nova as the number of Nova instances
+and concurrent requests grow.
+
+    $ python -m spotcloudopenstack.apibench --instances 100,1000,10000
+
+"""
+
+import os
+import sys
+import time
+import uuid
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+from threading import Thread, Lock
+
+from spotcloudopenstack.app import app, db
+from spotcloudopenstack import auth, fakes, novaconn, reconciler
+from spotcloudopenstack.models import HardwareTemplate, Package, VM, SQL_CHUNK
+from spotcloudopenstack.api import hosting
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+USER = 'bench'
+PASSWD = 'bench'
+
+
+def percentile(values, p):
+    "Nearest rank percentile of sorted values"
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def setup(work_dir, latency=0):
+    """Point app config at FakeNovaServer and sqlite db in work_dir.
+    Return started server and uuids of HardwareTemplate and Package
+
+    """
+    server = fakes.FakeNovaServer(latency).start()
+    access, secret = server.users['admin']
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///%s' % os.path.join(
+            work_dir, 'apibench.db'),
+        NOVA_ENDPOINT=server.url,
+        NOVA_REGION='nova',
+        NOVA_ACCESS_KEY=access,
+        NOVA_SECRET_KEY=secret,
+        USERNAME='admin',
+        PROJECT_NAME='bench',
+        SPOTCLOUD_USER=USER,
+        SPOTCLOUD_PASSWD=PASSWD)
+    # session of this thread is bound to the engine of old uri
+    db.session.remove()
+    novaconn._manager = None
+    reconciler._reconciler = None
+    db.create_all()
+    hardware = HardwareTemplate(
+        name='m1.small', nova_id='m1.small', cpus=1,
+        arch='x86_64', memory=2048)
+    package = Package(nova_id='ami-bench', state='ready')
+    db.session.add(hardware)
+    db.session.add(package)
+    db.session.commit()
+    return server, hardware.ecp_uuid, package.ecp_uuid
+
+
+def populate(server, hardware_uuid, package_uuid, count):
+    """Add count instances to Nova and VMs for them to db.
+    Return list of (reservation id, vm uuid)
+
+    """
+    added = server.add_instances(count)
+    result = []
+    rows = []
+    for reservation_id, instance_id in added:
+        vm_uuid = str(uuid.uuid1())
+        result.append((reservation_id, vm_uuid))
+        # stale state, so the first sync has updates to write
+        rows.append(dict(ecp_uuid=vm_uuid, nova_id=instance_id,
+                         state='scheduling', ip_address='127.0.0.1',
+                         hardware_uuid=hardware_uuid,
+                         package_uuid=package_uuid))
+    for i in range(0, len(rows), SQL_CHUNK):
+        db.session.execute(VM.__table__.insert(), rows[i:i + SQL_CHUNK])
+    db.session.commit()
+    return result
+
+
+def measure(call, concurrency, requests):
+    """Run call() requests times by concurrency threads.
+    Return dict with latency percentiles, errors and throughput
+
+    """
+    latencies = []
+    errors = []
+    lock = Lock()
+
+    def worker(count):
+        try:
+            for i in range(count):
+                started = time.time()
+                try:
+                    call()
+                except Exception, e:
+                    with lock:
+                        errors.append(str(e))
+                    continue
+                with lock:
+                    latencies.append(time.time() - started)
+        finally:
+            db.session.remove()
+
+    threads = [Thread(target=worker,
+                      args=(requests // concurrency +
+                            (i < requests % concurrency and 1 or 0),))
+               for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - started
+    latencies.sort()
+    return dict(count=len(latencies),
+                p50=percentile(latencies, 50),
+                p95=percentile(latencies, 95),
+                p99=percentile(latencies, 99),
+                max=latencies and latencies[-1] or 0.0,
+                errors=errors,
+                rps=len(latencies) / max(wall, 1e-6))
+
+
+def make_calls(vms):
+    "Return {name: callable} of measured calls"
+    client = app.test_client()
+    auth_args = 'ecp_username=%s&ecp_auth_digest=%s' % (
+        USER, auth.get_digest(PASSWD, {'ecp_username': USER}))
+
+    def get(url):
+        response = client.get('/rest/hosting/%s?%s' % (url, auth_args))
+        if response.status_code != 200:
+            raise RuntimeError('%s returned %s' % (
+                    url, response.status_code))
+
+    def instance_id():
+        reservation_id = random.choice(vms)[0]
+        if novaconn.get_instance_id(reservation_id) is None:
+            raise RuntimeError('no instance in %s' % reservation_id)
+
+    return {
+        'vm/list': lambda: get('vm/list'),
+        'vm/<uuid>': lambda: get('vm/%s' % random.choice(vms)[1]),
+        'get_instance_id': instance_id,
+        }
+
+
+def run_level(vms, concurrency, requests):
+    """Measure API calls with concurrency and VM.sync_with_nova
+    in one thread like Reconciler runs it. Return {name: result}
+
+    """
+    # snapshot must hold all VMs before vm/list is measured
+    reconciler.get_reconciler().refresh()
+    results = dict(
+        (name, measure(call, concurrency, requests))
+        for name, call in make_calls(vms).items())
+    results['sync_with_nova'] = measure(
+        VM.sync_with_nova, 1, max(3, requests // 10))
+    return results
+
+
+def report(instances, concurrency, results, out=sys.stdout):
+    out.write('\ninstances %s, concurrency %s\n' % (instances, concurrency))
+    out.write('  %-16s %6s %9s %9s %9s %9s %8s %7s\n' % (
+            'call', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms',
+            'req/s', 'errors'))
+    for name, result in sorted(results.items()):
+        out.write('  %-16s %6s %9.1f %9.1f %9.1f %9.1f %8.1f %7s\n' % (
+                name, result['count'], result['p50'] * 1000,
+                result['p95'] * 1000, result['p99'] * 1000,
+                result['max'] * 1000, result['rps'], len(result['errors'])))
+        for error in sorted(set(result['errors']))[:3]:
+            out.write('    ERROR %s\n' % error)
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--instances', default='100,1000,10000',
+                      help='comma separated numbers of Nova instances')
+    parser.add_option('--concurrency', default='1,8,32',
+                      help='comma separated numbers of concurrent '
+                      'requests')
+    parser.add_option('--requests', type='int', default=200,
+                      help='requests per call and level')
+    parser.add_option('--nova-latency', type='float', default=0.01,
+                      help='seconds added to every fake Nova call')
+    parser.add_option('--failure-rate', type='float', default=0,
+                      help='part of fake Nova calls failing')
+    parser.add_option('--work-dir', help='default is temporary dir')
+    options, args = parser.parse_args(argv[1:])
+    counts = [int(x) for x in options.instances.split(',')]
+    levels = [int(x) for x in options.concurrency.split(',')]
+
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='scapibench-')
+    logger.setLevel(logging.WARNING)
+    try:
+        server, hardware_uuid, package_uuid = setup(
+            work_dir, options.nova_latency)
+        server.failure_rate = options.failure_rate
+        try:
+            vms = []
+            for count in counts:
+                vms.extend(populate(server, hardware_uuid, package_uuid,
+                                    count - len(vms)))
+                for level in levels:
+                    report(count, level,
+                           run_level(vms, level, options.requests))
+        finally:
+            server.stop()
+            if reconciler._reconciler is not None:
+                reconciler._reconciler.stop()
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
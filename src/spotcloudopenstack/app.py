@@ -5,11 +5,21 @@ Initilize Flask App and logging
 
 import sys
 import os
+import sqlite3
+from contextlib import contextmanager
 
 from flask import Flask
 from flaskext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 DEFAULT_CONFIG = '/var/lib/spotcloudopenstack/spotcloudopenstack.conf'
+# API processes, provisiond and their threads write the same file
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL' # WAL stays consistent, fsync on checkpoint
+SQLITE_BUSY_TIMEOUT = 30000 #msec to wait for write lock
+# takes effect for new file, existing one needs offline VACUUM
+SQLITE_AUTO_VACUUM = 'INCREMENTAL'
 
 app = Flask(__name__)
 
@@ -18,7 +28,74 @@ if os.path.exists(DEFAULT_CONFIG):
 if os.environ.has_key("SPOTCLOUDOPENSTACK_SETTINGS"):
     app.config.from_envvar('SPOTCLOUDOPENSTACK_SETTINGS')
 
-db = SQLAlchemy(app)
+
+
+class Database(SQLAlchemy):
+    """SQLAlchemy with pool options applied to server databases only.
+    SQLite file keeps NullPool, every checkout is a new connection
+    with pragmas set by _sqlite_connected
+
+    """
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername == 'sqlite':
+            for key in ('pool_size', 'pool_timeout', 'pool_recycle'):
+                options.pop(key, None)
+        elif app.config.get('SQLALCHEMY_MAX_OVERFLOW') is not None:
+            options['max_overflow'] = app.config['SQLALCHEMY_MAX_OVERFLOW']
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+
+db = Database(app)
+
+
+def _sqlite_connected(dbapi_connection, connection_record):
+    """Set busy timeout, auto vacuum, journal and synchronous mode
+    of SQLite connection
+
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        # first, so switching journal mode waits for other writers too
+        cursor.execute('PRAGMA busy_timeout = %d' % int(
+                app.config.get('SQLITE_BUSY_TIMEOUT', SQLITE_BUSY_TIMEOUT)))
+        # before journal mode, WAL creates the file
+        cursor.execute('PRAGMA auto_vacuum = %s' % app.config.get(
+                'SQLITE_AUTO_VACUUM', SQLITE_AUTO_VACUUM))
+        journal_mode = app.config.get(
+            'SQLITE_JOURNAL_MODE', SQLITE_JOURNAL_MODE)
+        # mode is kept in the file, setting it again takes a lock
+        cursor.execute('PRAGMA journal_mode')
+        if cursor.fetchone()[0].lower() != journal_mode.lower():
+            cursor.execute('PRAGMA journal_mode = %s' % journal_mode)
+        cursor.execute('PRAGMA synchronous = %s' % app.config.get(
+                'SQLITE_SYNCHRONOUS', SQLITE_SYNCHRONOUS))
+    except sqlite3.Error, e:
+        logger.warning("Could not set SQLite pragmas: %s", e)
+    finally:
+        cursor.close()
+
+
+event.listen(Engine, 'connect', _sqlite_connected)
+
+
+@contextmanager
+def session_scope():
+    """Session of this thread for one unit of work, e.g. a job
+    of a worker thread. Commit at exit, rollback on error, then
+    remove it, so neither connection nor instances outlive it
+
+    """
+    session = db.session()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        db.session.remove()
 
 import logging
 from logging.handlers import RotatingFileHandler
@@ -7,8 +7,10 @@ import hmac
 from hashlib import sha1
 import base64
 import logging
+import time
 import urllib
-import cgi
+from collections import OrderedDict
+from threading import Lock
 
 from flask import request
 
@@ -17,28 +19,143 @@ from spotcloudopenstack.app import app
 logger = logging.getLogger('spotcloudopenstack')
 
 
+HASH_KEY = 'ECPSuperSecretHashKey'
+# the protocol has no nonce, identical retries of a client
+# are replays too, so the check is off unless configured
+REPLAY_CACHE_SIZE = 0 # digests, 0 disables replay check
+REPLAY_WINDOW = 5*60 #sec
+
+
 class WrongAuth(Exception):
     "Raise if any issue with SpotCloud digest auth"
     pass
 
-    
+
+def _compare_digest(a, b):
+    "Compare strings in time not depending on the first difference"
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+_compare = getattr(hmac, 'compare_digest', _compare_digest)
+
+
+def compare_digest(a, b):
+    "Constant time compare of digests, str or unicode"
+    return _compare(to_bytestring(a), to_bytestring(b))
+
+
+_keys = {}
+_get_digests = {}
+_keys_lock = Lock()
+
+
+def _keyed(password):
+    """Return HMAC state keyed by password secret to copy for
+    every digest. Derived once per password, so config
+    reloads are picked up
+
+    """
+    keyed = _keys.get(password)
+    if keyed is None:
+        secret = hmac.new(HASH_KEY, password, sha1).hexdigest()
+        keyed = hmac.new(secret, '', sha1)
+        with _keys_lock:
+            _keys[password] = keyed
+    return keyed
+
+
+def _get_digest_for(login, password):
+    "Return digest for GET and DELETE, it depends only on login"
+    digest = _get_digests.get((login, password))
+    if digest is None:
+        digest = get_digest(password, {'ecp_username': login})
+        with _keys_lock:
+            _get_digests[(login, password)] = digest
+    return digest
+
+
+class ReplayCache(object):
+    """Bounded LRU of digests accepted within window seconds.
+    Digest of POST or PUT seen again inside the window for
+    the same method and path is a replay. Digests do not sign
+    the path, e.g. every action=delete has the same one
+
+    """
+    def __init__(self, size=REPLAY_CACHE_SIZE, window=REPLAY_WINDOW):
+        self.size = size
+        self.window = window
+        self._seen = OrderedDict()
+        self._lock = Lock()
+
+    def check_and_add(self, digest, method='POST', path=''):
+        "Remember digest, return False if it was seen in window"
+        if not self.size:
+            return True
+        now = time.time()
+        key = (method, path, digest)
+        with self._lock:
+            seen = self._seen.pop(key, None)
+            self._seen[key] = now
+            while len(self._seen) > self.size:
+                self._seen.popitem(last=False)
+        return seen is None or now - seen > self.window
+
+
+_replay_cache = None
+_replay_cache_lock = Lock()
+
+
+def get_replay_cache():
+    "Return ReplayCache of this process"
+    global _replay_cache
+    with _replay_cache_lock:
+        if _replay_cache is None:
+            _replay_cache = ReplayCache(
+                app.config.get('AUTH_REPLAY_CACHE_SIZE', REPLAY_CACHE_SIZE),
+                app.config.get('AUTH_REPLAY_WINDOW', REPLAY_WINDOW))
+        return _replay_cache
+
+
 def _check_auth_post(login, passwd):
     "Check digest for POST and PUT"
     logger.debug('method POST or PUT with %s', request.form)
     if request.form.get('ecp_username') != login:
         logger.warning("Wrong ecp_username is used")
         raise WrongAuth("Wrong ecp_username is used")
-    if request.form.get('ecp_auth_digest'
-                        ) != get_digest(passwd, request.form):
-        logger.warning(
-            "Wrong auth digest, waiting for %s, but got %s",
-            get_digest(passwd, request.form),
-            request.form.get('ecp_auth_digest'))
+    ecp_auth_digest = request.form.get('ecp_auth_digest') or ''
+    if not compare_digest(ecp_auth_digest,
+                          get_digest(passwd, request.form)):
+        logger.warning("Wrong auth digest %s", ecp_auth_digest)
         raise WrongAuth("Wrong auth digest")
+    if not get_replay_cache().check_and_add(
+            ecp_auth_digest, request.method, request.path):
+        logger.warning("Replayed auth digest %s", ecp_auth_digest)
+        raise WrongAuth("Replayed auth digest")
+
+
+def _query_values(query, names):
+    """Return {name: first value} for names from query string,
+    values are unquoted and blank ones skipped like cgi.parse_qs does
+
+    """
+    result = {}
+    for pair in query.replace(';', '&').split('&'):
+        name, sep, value = pair.partition('=')
+        if not sep or not value:
+            continue
+        name = urllib.unquote_plus(name)
+        if name in names and name not in result:
+            result[name] = urllib.unquote_plus(value)
+    return result
 
 
 def _check_auth_get(login, passwd):
     "Check diget auth for args from GET or DELETE"
+    # query could come inside of the path as %3F, see api.QueryInPath
     url = urllib.unquote(request.url)
     if '?' in url:
         query = url.split('?')[1]
@@ -46,28 +163,25 @@ def _check_auth_get(login, passwd):
         logger.warning('No query string provided')
         raise WrongAuth(
             "No query string provided")
-    query_dict = cgi.parse_qs(query)
+    query_dict = _query_values(query, ('ecp_username', 'ecp_auth_digest'))
     if 'ecp_username' not in query_dict or \
             'ecp_auth_digest' not in query_dict:
         logger.warning(
             "No ecp_username or ecp_auth_digest are provided")
         raise WrongAuth(
             "ecp_username for ecp_auth_digest was not provided")
-    if query_dict['ecp_username'][0] != login:
+    if query_dict['ecp_username'] != login:
         logger.warning('%s is a wrong user name' % (
-                query_dict['ecp_username'][0],))
+                query_dict['ecp_username'],))
         raise WrongAuth(
             "Wrong user name is used")
-    ecp_auth_digest = query_dict['ecp_auth_digest'][0].replace(
+    ecp_auth_digest = query_dict['ecp_auth_digest'].replace(
         '%253D', '=')
-    if ecp_auth_digest != get_digest(passwd, {'ecp_username':login}):
-        logger.debug(
-            "Wrong digest provided, got %s but waiting for %s",
-            ecp_auth_digest,
-            get_digest(passwd, {'ecp_username':login}))
+    if not compare_digest(ecp_auth_digest, _get_digest_for(login, passwd)):
+        logger.debug("Wrong digest provided, got %s", ecp_auth_digest)
         raise WrongAuth(
             "Wrong digest provided")
-        
+
 
 def check_auth():
     """Test request args for digest auth.
@@ -98,15 +212,8 @@ def to_bytestring(s, encoding='utf-8', errors='strict'):
 
 def get_digest(password, args):
     "Create sha1 digest from args"
-    args = dict(args.items())
-    if 'ecp_auth_digest' in args:
-        del args['ecp_auth_digest']
-    sorted_keys = sorted(
-        args.keys(), key=lambda k: k.lower())
-    data = ''.join(
-        key + to_bytestring(args[key]) for key in sorted_keys)
-    secret = hmac.new(
-        'ECPSuperSecretHashKey', password, sha1).hexdigest()
-    digest = hmac.new(secret, data, sha1).digest()
-    return  base64.b64encode(digest)
-
+    digest = _keyed(password).copy()
+    for key in sorted(args.keys(), key=lambda k: k.lower()):
+        if key != 'ecp_auth_digest':
+            digest.update(key + to_bytestring(args[key]))
+    return base64.b64encode(digest.digest())
@@ -0,0 +1,112 @@
+"""
+Microbenchmark of digest auth per request.
+Compares check_auth with the digest computed the way
+it was before the keyed HMAC state and GET digest were cached.
+
+    $ python -m spotcloudopenstack.authbench --requests 20000
+
+"""
+
+import sys
+import hmac
+import time
+import uuid
+import base64
+import urllib
+from hashlib import sha1
+from optparse import OptionParser
+
+from spotcloudopenstack.app import app
+from spotcloudopenstack import auth
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+USER = 'spotcloud'
+PASSWD = 'password'
+
+
+def uncached_digest(password, args):
+    "Digest computed from scratch, like every request did"
+    args = dict(args.items())
+    if 'ecp_auth_digest' in args:
+        del args['ecp_auth_digest']
+    sorted_keys = sorted(
+        args.keys(), key=lambda k: k.lower())
+    data = ''.join(
+        key + auth.to_bytestring(args[key]) for key in sorted_keys)
+    secret = hmac.new(
+        auth.HASH_KEY, password, sha1).hexdigest()
+    digest = hmac.new(secret, data, sha1).digest()
+    return base64.b64encode(digest)
+
+
+def put_form(name):
+    form = {'ecp_username': USER,
+            'name': name,
+            'package': str(uuid.uuid4()),
+            'hardware': str(uuid.uuid4()),
+            'network': str(uuid.uuid4())}
+    form['ecp_auth_digest'] = auth.get_digest(PASSWD, form)
+    return form
+
+
+def time_calls(call, requests):
+    "Return microseconds per call"
+    started = time.time()
+    for i in xrange(requests):
+        call(i)
+    return (time.time() - started) * 1e6 / requests
+
+
+def run(requests):
+    "Return list of (name, microseconds per request)"
+    app.config.update(SPOTCLOUD_USER=USER, SPOTCLOUD_PASSWD=PASSWD)
+    get_args = {'ecp_username': USER}
+    query = 'ecp_username=%s&ecp_auth_digest=%s' % (
+        USER, urllib.quote(auth.get_digest(PASSWD, get_args)))
+    forms = [put_form(str(uuid.uuid4())) for i in xrange(requests)]
+    get_ctx = app.test_request_context(
+        '/rest/hosting/vm/list?%s' % query)
+    put_ctxs = [app.test_request_context(
+            '/rest/hosting/vm', method='PUT', data=form) for form in forms]
+    results = [
+        ('digest uncached', time_calls(
+                lambda i: uncached_digest(PASSWD, forms[i]), requests)),
+        ('digest', time_calls(
+                lambda i: auth.get_digest(PASSWD, forms[i]), requests))]
+    get_ctx.push()
+    try:
+        results.append(('GET check_auth', time_calls(
+                    lambda i: auth.check_auth(), requests)))
+    finally:
+        get_ctx.pop()
+
+    def put(i):
+        put_ctxs[i].push()
+        try:
+            auth.check_auth()
+        finally:
+            put_ctxs[i].pop()
+
+    # form parsing is not auth cost, so it is done before timing
+    for ctx in put_ctxs:
+        with ctx:
+            ctx.request.form
+    results.append(('PUT check_auth', time_calls(put, requests)))
+    return results
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--requests', type='int', default=20000,
+                      help='requests per measurement')
+    options, args = parser.parse_args(argv[1:])
+    logger.setLevel(logging.WARNING)
+    for name, usec in run(options.requests):
+        print '%-16s %8.1f usec/request' % (name, usec)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Benchmark of the provisioning pipeline without root or a cloud.
+Synthetic .xvm2 packages are served by local HTTP server,
+qemu-img, publish script and Nova are stand-ins, everything
+else is the real ProvisionWorker run by the scheduler.
+
+    $ python -m spotcloudopenstack.bench --size 256 --concurrency 1,4,16
+
+"""
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+from optparse import OptionParser
+from threading import Event
+
+from spotcloudopenstack.app import app, db
+from spotcloudopenstack import fakes, metrics, novaconn
+from spotcloudopenstack.models import HardwareTemplate, Task
+from spotcloudopenstack.provision import ProvisionWorker
+from spotcloudopenstack.scheduler import get_scheduler
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+MB = 1024.0*1024
+
+
+class TimedJob(object):
+    "ProvisionWorker with wall time of the whole provision"
+    def __init__(self, worker):
+        self.worker = worker
+        self.queued = time.time()
+        self.seconds = None
+        self.done = Event()
+
+    def run(self):
+        try:
+            self.worker.run()
+        finally:
+            self.seconds = time.time() - self.queued
+            self.done.set()
+
+
+def setup(work_dir, packages, nova_latency=0, publish_delay=0,
+          qemu_img_version='1.0'):
+    """Point app config at work_dir, fake tools and package server.
+    Return started PackageServer and HardwareTemplate uuid
+
+    """
+    tools_dir = os.path.join(work_dir, 'tools')
+    repo_dir = os.path.join(work_dir, 'repo')
+    for path in (tools_dir, repo_dir):
+        os.mkdir(path)
+    qemu_img, publish = fakes.write_fake_tools(
+        tools_dir, qemu_img_version, publish_delay)
+    server = fakes.PackageServer(packages).start()
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///%s' % os.path.join(
+            work_dir, 'bench.db'),
+        REPO_DIR=repo_dir,
+        PACKAGE_DOWNLOAD_URL_TMPL=server.url_tmpl,
+        QEMU_IMG=qemu_img,
+        PUBLISH_SCRIPT=publish)
+    # session of this thread is bound to the engine of old uri
+    db.session.remove()
+    novaconn._manager = fakes.FakeNovaManager(nova_latency)
+    db.create_all()
+    hardware = HardwareTemplate(
+        name='m1.bench', nova_id='m1.bench', cpus=1,
+        arch='x86_64', memory=512)
+    db.session.add(hardware)
+    db.session.commit()
+    return server, hardware.ecp_uuid
+
+
+def run_level(server, hardware_uuid, package_data, concurrency):
+    """Provision concurrency VMs from distinct packages at once.
+    Return dict with wall time, job times and stage totals
+
+    """
+    jobs = []
+    stages_before = metrics.STAGE_SECONDS.totals()
+    started = time.time()
+    for i in range(concurrency):
+        pkg_uuid = str(uuid.uuid4())
+        server.packages[pkg_uuid] = package_data
+        task = Task(vm_uuid=str(uuid.uuid4()))
+        db.session.add(task)
+        db.session.commit()
+        job = TimedJob(ProvisionWorker(
+                task.vm_uuid, task.ecp_uuid, hardware_uuid, pkg_uuid))
+        jobs.append((task.ecp_uuid, job))
+        get_scheduler().submit(job)
+    for task_uuid, job in jobs:
+        job.done.wait()
+    wall = time.time() - started
+    errors = []
+    for task_uuid, job in jobs:
+        task = Task.query.populate_existing().get(task_uuid)
+        if task.is_error:
+            errors.append(task.message)
+    stages = {}
+    for (name,), (count, total) in metrics.STAGE_SECONDS.totals().items():
+        count_before, total_before = stages_before.get((name,), (0, 0.0))
+        if count > count_before:
+            stages[name] = (count - count_before, total - total_before)
+    times = sorted(job.seconds for task_uuid, job in jobs)
+    return dict(concurrency=concurrency,
+                wall=wall,
+                job_avg=sum(times) / len(times),
+                job_max=times[-1],
+                stages=stages,
+                errors=errors)
+
+
+def report(result, disk_size, out=sys.stdout):
+    out.write('\nconcurrency %(concurrency)s: wall %(wall).2f s, '
+              'provision avg %(job_avg).2f s, max %(job_max).2f s, ' % result)
+    out.write('%.1f MB/s of raw disks\n' % (
+            disk_size * result['concurrency'] / MB / result['wall']))
+    out.write('  %-16s %6s %10s %10s\n' % ('stage', 'count', 'avg s',
+                                           'total s'))
+    for name, (count, total) in sorted(result['stages'].items(),
+                                       key=lambda x: -x[1][1]):
+        out.write('  %-16s %6s %10.3f %10.3f\n' % (
+                name, count, total / count, total))
+    for error in result['errors']:
+        out.write('  ERROR %s\n' % error)
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--size', type='int', default=64,
+                      help='raw disk size, MB')
+    parser.add_option('--fill', type='float', default=0.1,
+                      help='part of root file system with random data')
+    parser.add_option('--layout', default='mbr',
+                      help='one of %s' % ', '.join(fakes.LAYOUTS))
+    parser.add_option('--concurrency', default='1,4,16',
+                      help='comma separated numbers of packages at once')
+    parser.add_option('--nova-latency', type='float', default=0.05,
+                      help='seconds per fake Nova call')
+    parser.add_option('--publish-delay', type='float', default=0.5,
+                      help='seconds per fake publish')
+    parser.add_option('--qemu-img-version', default='1.0',
+                      help='2.9 or newer lets qemu-img read partition '
+                      'in place')
+    parser.add_option('--work-dir', help='default is temporary dir')
+    options, args = parser.parse_args(argv[1:])
+    levels = [int(x) for x in options.concurrency.split(',')]
+
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='scbench-')
+    logger.setLevel(logging.WARNING)
+    app.config['PROVISION_WORKERS'] = max(levels)
+    try:
+        disk_path = os.path.join(work_dir, 'disk.img')
+        xvm2_path = os.path.join(work_dir, 'bench.xvm2')
+        started = time.time()
+        fakes.make_disk(disk_path, options.size * 1024 * 1024,
+                        options.layout, options.fill)
+        fakes.make_xvm2(disk_path, xvm2_path)
+        os.unlink(disk_path)
+        package_data = open(xvm2_path, 'rb').read()
+        os.unlink(xvm2_path)
+        print 'package: %s MB disk, %s layout, %.1f MB .xvm2, ' \
+            'made in %.1f s' % (options.size, options.layout,
+                                len(package_data) / MB,
+                                time.time() - started)
+        server, hardware_uuid = setup(
+            work_dir, {}, options.nova_latency, options.publish_delay,
+            options.qemu_img_version)
+        try:
+            for level in levels:
+                report(run_level(server, hardware_uuid, package_data, level),
+                       options.size * 1024 * 1024)
+        finally:
+            server.stop()
+            get_scheduler().stop()
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""
+Capacity model for the utilization API call.
+Totals come from Nova hosts, committed resources from VMs
+and their instance types, HardwareTemplates are kept in sync
+with the types on the way. The aggregate is kept in memory,
+adjusted on every committed provision or termination and
+refreshed in background, so serving it never calls Nova
+
+"""
+
+import math
+import time
+from threading import Thread, Event, Lock, local
+
+from sqlalchemy import event, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from spotcloudopenstack.app import app, db
+from spotcloudopenstack.models import VM, HardwareTemplate
+from spotcloudopenstack.novaconn import get_connection_manager
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+CAPACITY_INTERVAL = 60 #sec
+# per compute host, used when Nova does not report them
+HOST_MEMORY = 8000 #MB
+HOST_CPUS = 4
+HOST_STORAGE = 800000 #MB
+LOAD_PERIODS = (60, 5*60, 15*60) #sec, like loadavg
+
+
+class Capacity(Thread):
+    """In-memory aggregate of total and committed memory,
+    CPUs and storage. Load averages are exponentially damped
+    averages of committed part of CPUs, like loadavg
+
+    """
+    def __init__(self, interval=CAPACITY_INTERVAL, config=None):
+        Thread.__init__(self, name='capacity')
+        self.daemon = True
+        self.interval = interval
+        self.config = config or app.config
+        self._wakeup = Event()
+        self._lock = Lock()
+        self._stopped = False
+        self._refreshed = None
+        self.total = dict(memory=0, cpus=0, storage=0)
+        self.committed = dict(memory=0, cpus=0, storage=0)
+        self.vms = 0
+        self.hosts = 0
+        # hardware uuid: (memory, cpus, storage) of one VM
+        self._sizes = {}
+        self._loads = [0.0] * len(LOAD_PERIODS)
+        self._loads_at = time.time()
+
+    def run(self):
+        while not self._stopped:
+            try:
+                self.refresh()
+            except Exception, e:
+                logger.error("Could not refresh capacity: %s", e)
+            finally:
+                db.session.remove()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def stop(self):
+        "Ask thread to exit"
+        self._stopped = True
+        self._wakeup.set()
+
+    def _advance(self, now):
+        "Damp load averages up to now with current usage"
+        usage = float(self.committed['cpus']) / max(self.total['cpus'], 1)
+        dt = max(now - self._loads_at, 0)
+        self._loads = [
+            load * math.exp(-dt / period) +
+            usage * (1 - math.exp(-dt / period))
+            for load, period in zip(self._loads, LOAD_PERIODS)]
+        self._loads_at = now
+
+    def _host_totals(self, hosts):
+        "Sum resources of hosts, config defaults for missing ones"
+        total = dict(memory=0, cpus=0, storage=0)
+        for host in hosts:
+            for key, attr, config_key, default, scale in [
+                ('memory', 'memory_mb', 'CAPACITY_HOST_MEMORY',
+                 HOST_MEMORY, 1),
+                ('cpus', 'vcpus', 'CAPACITY_HOST_CPUS', HOST_CPUS, 1),
+                ('storage', 'local_gb', 'CAPACITY_HOST_STORAGE',
+                 HOST_STORAGE, 1024)]:
+                value = getattr(host, attr, None)
+                if value:
+                    total[key] += int(value) * scale
+                else:
+                    total[key] += self.config.get(config_key, default)
+        return total
+
+    def _count(self, sizes):
+        "Return committed resources and number of VMs from db"
+        committed = dict(memory=0, cpus=0, storage=0)
+        vms = 0
+        rows = db.session.query(
+            VM.hardware_uuid, func.count(VM.ecp_uuid)
+            ).group_by(VM.hardware_uuid).all()
+        for hardware_uuid, count in rows:
+            memory, cpus, storage = sizes.get(hardware_uuid, (0, 0, 0))
+            committed['memory'] += memory * count
+            committed['cpus'] += cpus * count
+            committed['storage'] += storage * count
+            vms += count
+        return committed, vms
+
+    def refresh(self):
+        """Fetch hosts and instance types from Nova, sync
+        HardwareTemplates with the types, recount VMs
+
+        """
+        manager = get_connection_manager()
+        hosts = manager.admin_client().get_hosts()
+        disks = dict((x.name, int(x.disk_gb or 0) * 1024)
+                     for x in manager.instance_types())
+        # types are cached, rows are written only if types changed
+        try:
+            summary = HardwareTemplate.sync_with_nova()
+        except IntegrityError, e:
+            # capacity threads of other processes add the same
+            # new types, the next refresh sees their rows
+            logger.info("HardwareTemplates synced concurrently: %s", e)
+        else:
+            if summary['added'] or summary['updated'] or \
+                    summary['deleted'] or summary['retired']:
+                logger.info("HardwareTemplate sync: %s", summary)
+        sizes = dict(
+            (ecp_uuid, (memory, cpus, disks.get(nova_id, 0)))
+            for ecp_uuid, memory, cpus, nova_id in db.session.query(
+                HardwareTemplate.ecp_uuid, HardwareTemplate.memory,
+                HardwareTemplate.cpus, HardwareTemplate.nova_id))
+        # volume or network only hosts and hosts with compute
+        # service down cannot run instances
+        hosts = [host for host in hosts
+                 if getattr(host, 'compute', None) == 'up']
+        total = self._host_totals(hosts)
+        committed, vms = self._count(sizes)
+        with self._lock:
+            self._advance(time.time())
+            self.total = total
+            self.hosts = len(hosts)
+            self._sizes = sizes
+            # a change committed while counting could be lost
+            # or counted twice until the next refresh
+            self.committed = committed
+            self.vms = vms
+            self._refreshed = time.time()
+        logger.debug("capacity refreshed: %s hosts, %s VMs",
+                     len(hosts), vms)
+
+    def recount(self):
+        "Refresh in background, e.g. after bulk delete of VMs"
+        self._wakeup.set()
+
+    def apply(self, changes):
+        """Adjust committed resources by changes,
+        list of (hardware uuid, +1 or -1)
+
+        """
+        unknown = False
+        with self._lock:
+            self._advance(time.time())
+            for hardware_uuid, sign in changes:
+                size = self._sizes.get(hardware_uuid)
+                if size is None:
+                    # template added after the last refresh
+                    unknown = True
+                    continue
+                for key, value in zip(('memory', 'cpus', 'storage'), size):
+                    self.committed[key] += sign * value
+                self.vms += sign
+        if unknown:
+            self.recount()
+
+    def age(self):
+        "Seconds passed since last refresh from Nova or None"
+        if self._refreshed is None:
+            return None
+        return round(time.time() - self._refreshed, 3)
+
+    def snapshot(self):
+        "Return dict for utilization API call"
+        with self._lock:
+            self._advance(time.time())
+            total = dict(self.total)
+            committed = dict(self.committed)
+            loads = list(self._loads)
+            vms = self.vms
+        return dict(
+            total_memory=total['memory'],
+            free_memory=max(total['memory'] - committed['memory'], 0),
+            cpus=total['cpus'],
+            free_cpus=max(total['cpus'] - committed['cpus'], 0),
+            total_storage=total['storage'],
+            committed_storage=committed['storage'],
+            free_storage=max(total['storage'] - committed['storage'], 0),
+            loadone=round(loads[0], 2),
+            loadfive=round(loads[1], 2),
+            loadfifteen=round(loads[2], 2),
+            vms=vms,
+            capacity_age=self.age())
+
+
+_capacity = None
+_capacity_lock = Lock()
+
+
+def get_capacity():
+    """Return running Capacity of this process,
+    start it if needed (e.g. after uwsgi fork)
+
+    """
+    global _capacity
+    with _capacity_lock:
+        if _capacity is None or not _capacity.is_alive():
+            _capacity = Capacity(
+                app.config.get('CAPACITY_INTERVAL', CAPACITY_INTERVAL))
+            _capacity.start()
+        return _capacity
+
+
+_pending = local()
+
+
+def _changes():
+    if not hasattr(_pending, 'changes'):
+        _pending.changes = []
+    return _pending.changes
+
+
+def _vm_inserted(mapper, connection, target):
+    _changes().append((target.hardware_uuid, 1))
+
+
+def _vm_deleted(mapper, connection, target):
+    _changes().append((target.hardware_uuid, -1))
+
+
+def _bulk_deleted(session, query, query_context, result):
+    if query.column_descriptions[0]['type'] is VM:
+        # VM.sync_with_nova, rows are not known
+        _pending.recount = True
+
+
+def _after_commit(session):
+    changes = getattr(_pending, 'changes', None)
+    recount = getattr(_pending, 'recount', False)
+    if not changes and not recount:
+        return
+    _pending.changes = []
+    _pending.recount = False
+    capacity = _capacity
+    if capacity is None:
+        return
+    if changes:
+        capacity.apply(changes)
+    if recount:
+        capacity.recount()
+
+
+def _after_rollback(session):
+    _pending.changes = []
+    _pending.recount = False
+
+
+event.listen(VM, 'after_insert', _vm_inserted)
+event.listen(VM, 'after_delete', _vm_deleted)
+event.listen(Session, 'after_bulk_delete', _bulk_deleted)
+event.listen(Session, 'after_commit', _after_commit)
+event.listen(Session, 'after_rollback', _after_rollback)
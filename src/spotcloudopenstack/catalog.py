@@ -0,0 +1,147 @@
+"""
+Pre-serialized catalog responses for SpotCloud polling.
+Body of htemplate/list and ptemplate/list is rebuilt only
+after a commit wrote to the tables behind it, and is served
+with ETag and Last-Modified, so If-None-Match gets 304
+
+"""
+
+import time
+from hashlib import md5
+from functools import wraps
+from threading import Lock, local
+
+from flask import json, request, Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from spotcloudopenstack.app import app
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+# writes of other processes (provisiond, other uwsgi workers)
+# are not seen by events, so staleness is bounded by ttl
+CATALOG_TTL = 30 #sec
+
+_by_model = {}
+
+
+class Catalog(object):
+    """JSON body of one catalog with its validators.
+    invalidate() bumps version, get() rebuilds if version
+    changed or entry is older than ttl
+
+    """
+    def __init__(self, name, build):
+        self.name = name
+        self.build = build
+        self.builds = 0
+        self._version = 0
+        self._entry = None # (version, built, body, etag, last_modified)
+        self._lock = Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+
+    def _fresh(self, entry, ttl):
+        return entry is not None and entry[0] == self._version and \
+            time.time() - entry[1] < ttl
+
+    def get(self, ttl=CATALOG_TTL):
+        "Return (body, etag, last_modified)"
+        entry = self._entry
+        if self._fresh(entry, ttl):
+            return entry[2:]
+        with self._lock:
+            entry = self._entry
+            if self._fresh(entry, ttl):
+                return entry[2:]
+            version = self._version
+        # version is taken before the query, so a commit
+        # during the build makes the next get rebuild again
+        body = json.dumps(self.build())
+        etag = md5(body).hexdigest()
+        now = time.time()
+        with self._lock:
+            self.builds += 1
+            if entry is not None and entry[3] == etag:
+                last_modified = entry[4]
+            else:
+                last_modified = now
+            self._entry = (version, now, body, etag, last_modified)
+        logger.debug("catalog %s rebuilt", self.name)
+        return body, etag, last_modified
+
+
+def cached(*models):
+    """Serve dict returned by the view from Catalog
+    invalidated by commits writing to models:
+
+        @cached(Package)
+        def ptemplate_list():
+            return dict(...)
+
+    """
+    def decorator(view):
+        catalog = Catalog(view.__name__, view)
+        for model in models:
+            if model not in _by_model:
+                _by_model[model] = []
+                for name in ('after_insert', 'after_update',
+                             'after_delete'):
+                    event.listen(model, name, _model_changed)
+            _by_model[model].append(catalog)
+
+        @wraps(view)
+        def wrapper():
+            body, etag, last_modified = catalog.get(
+                app.config.get('CATALOG_TTL', CATALOG_TTL))
+            response = Response(body, mimetype='application/json')
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.headers['Cache-Control'] = 'no-cache'
+            return response.make_conditional(request)
+        wrapper.catalog = catalog
+        return wrapper
+    return decorator
+
+
+_pending = local()
+
+
+def _mark(model):
+    if model in _by_model:
+        if not hasattr(_pending, 'models'):
+            _pending.models = set()
+        _pending.models.add(model)
+
+
+def _model_changed(mapper, connection, target):
+    _mark(mapper.class_)
+
+
+def _bulk_changed(session, query, query_context, result):
+    _mark(query.column_descriptions[0]['type'])
+
+
+def _after_commit(session):
+    models = getattr(_pending, 'models', None)
+    if not models:
+        return
+    _pending.models = set()
+    for model in models:
+        for catalog in _by_model[model]:
+            catalog.invalidate()
+
+
+def _after_rollback(session):
+    _pending.models = set()
+
+
+event.listen(Session, 'after_bulk_update', _bulk_changed)
+event.listen(Session, 'after_bulk_delete', _bulk_changed)
+event.listen(Session, 'after_commit', _after_commit)
+event.listen(Session, 'after_rollback', _after_rollback)
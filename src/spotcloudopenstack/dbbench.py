@@ -0,0 +1,160 @@
+"""
+Contention benchmark of the database layer.
+N writers, processes like uwsgi workers or threads like
+ProvisionWorkers, commit provision-like transactions to one
+SQLite file. Commit throughput, latency and lock errors are
+compared across journal modes.
+
+    $ python -m spotcloudopenstack.dbbench --writers 1,4,16 --journal delete,wal
+
+"""
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+import Queue
+import multiprocessing
+from optparse import OptionParser
+from threading import Thread
+
+from sqlalchemy.exc import OperationalError
+
+from spotcloudopenstack.app import app, db
+from spotcloudopenstack.models import Task
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+def setup(work_dir, journal_mode, busy_timeout):
+    "Point app config at new SQLite file in work_dir"
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///%s' % os.path.join(
+            work_dir, 'dbbench-%s.db' % journal_mode),
+        SQLITE_JOURNAL_MODE=journal_mode,
+        SQLITE_BUSY_TIMEOUT=busy_timeout)
+    # session of this thread is bound to the engine of old uri
+    db.session.remove()
+    db.create_all()
+    db.session.remove()
+
+
+def writer(transactions, results):
+    """Insert Task and complete it, two commits per transaction
+    like PUT vm and ProvisionWorker. Put (latencies, errors)
+    to results
+
+    """
+    latencies = []
+    errors = []
+    try:
+        for i in xrange(transactions):
+            started = time.time()
+            try:
+                task = Task(str(uuid.uuid1()))
+                db.session.add(task)
+                db.session.commit()
+                task.completed = 100
+                db.session.commit()
+            except OperationalError, e:
+                db.session.rollback()
+                errors.append(str(e.orig))
+                continue
+            latencies.append(time.time() - started)
+    finally:
+        db.session.remove()
+    results.put((latencies, errors))
+
+
+def run_level(writers, transactions, processes=True):
+    """Run writers at once. Return dict with commits per second,
+    latency percentiles of transaction and errors
+
+    """
+    if processes:
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(
+                target=writer, args=(transactions, results))
+                   for i in range(writers)]
+    else:
+        results = Queue.Queue()
+        workers = [Thread(target=writer, args=(transactions, results))
+                   for i in range(writers)]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    latencies = []
+    errors = []
+    # read before join, child process exits after its queue is drained
+    for worker in workers:
+        worker_latencies, worker_errors = results.get()
+        latencies.extend(worker_latencies)
+        errors.extend(worker_errors)
+    for worker in workers:
+        worker.join()
+    wall = time.time() - started
+    latencies.sort()
+
+    def percentile(p):
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    return dict(commits=len(latencies) * 2,
+                commits_per_sec=len(latencies) * 2 / max(wall, 1e-6),
+                p50=percentile(0.5),
+                p95=percentile(0.95),
+                max=latencies and latencies[-1] or 0.0,
+                errors=errors)
+
+
+def report(journal_mode, writers, result, out=sys.stdout):
+    out.write('  %-8s %7s %8s %10.1f %9.1f %9.1f %9.1f %7s\n' % (
+            journal_mode, writers, result['commits'],
+            result['commits_per_sec'], result['p50'] * 1000,
+            result['p95'] * 1000, result['max'] * 1000,
+            len(result['errors'])))
+    for error in sorted(set(result['errors']))[:3]:
+        out.write('    ERROR %s\n' % error)
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--writers', default='1,4,16',
+                      help='comma separated numbers of concurrent writers')
+    parser.add_option('--transactions', type='int', default=200,
+                      help='transactions per writer, two commits each')
+    parser.add_option('--journal', default='delete,wal',
+                      help='comma separated SQLite journal modes')
+    parser.add_option('--busy-timeout', type='int', default=30000,
+                      help='SQLite busy timeout, msec')
+    parser.add_option('--threads', action='store_true',
+                      help='writers are threads of one process')
+    parser.add_option('--work-dir', help='default is temporary dir')
+    options, args = parser.parse_args(argv[1:])
+    levels = [int(x) for x in options.writers.split(',')]
+
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='scdbbench-')
+    logger.setLevel(logging.WARNING)
+    print '%s writers, busy timeout %s ms' % (
+        options.threads and 'thread' or 'process', options.busy_timeout)
+    print '  %-8s %7s %8s %10s %9s %9s %9s %7s' % (
+        'journal', 'writers', 'commits', 'commits/s', 'p50 ms',
+        'p95 ms', 'max ms', 'errors')
+    try:
+        for journal_mode in options.journal.split(','):
+            setup(work_dir, journal_mode, options.busy_timeout)
+            for level in levels:
+                report(journal_mode, level,
+                       run_level(level, options.transactions,
+                                 not options.threads))
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Streaming helpers for the image pipeline:
+.xvm2 tar stream -> gzip member -> raw disk file
+in one pass without temporary files.
+Raw disks are mostly zeros, so all files
+are written sparse
+
+"""
+
+import tarfile
+import zlib
+from hashlib import sha1
+from collections import namedtuple
+
+
+BLOCK_SIZE = 1024*1024
+SPARSE_BLOCK = 64*1024
+ZERO_BLOCK = '\0' * SPARSE_BLOCK
+
+# logical is file size, physical is bytes really written,
+# the rest became holes
+IOStats = namedtuple('IOStats', 'logical physical')
+
+
+class SparseFile(object):
+    """Write only file turning all-zero blocks into holes.
+    Blocks are aligned to file offset, a partial block is
+    kept until the next write completes it
+
+    """
+    def __init__(self, path, block_size=SPARSE_BLOCK):
+        self.path = path
+        self.block_size = block_size
+        if block_size == SPARSE_BLOCK:
+            self._zero = ZERO_BLOCK
+        else:
+            self._zero = '\0' * block_size
+        self.logical = 0
+        self.physical = 0
+        self._pending = ''
+        self._file = open(path, 'wb')
+
+    def write(self, data):
+        block_size = self.block_size
+        if self._pending:
+            need = block_size - len(self._pending)
+            self._pending += data[:need]
+            data = data[need:]
+            if len(self._pending) < block_size:
+                return
+            self._write_block(self._pending)
+            self._pending = ''
+        end = len(data) - len(data) % block_size
+        for start in xrange(0, end, block_size):
+            self._write_block(data[start:start + block_size])
+        self._pending = data[end:]
+
+    def _write_block(self, block):
+        if len(block) == self.block_size:
+            is_zero = block == self._zero
+        else:
+            is_zero = block.count('\0') == len(block)
+        if is_zero:
+            self._file.seek(len(block), 1)
+        else:
+            self._file.write(block)
+            self.physical += len(block)
+        self.logical += len(block)
+
+    def close(self):
+        "Set file size, trailing holes are not written by seek"
+        if not self._file.closed:
+            if self._pending:
+                self._write_block(self._pending)
+                self._pending = ''
+            self._file.truncate(self.logical)
+            self._file.close()
+
+    def stats(self):
+        return IOStats(self.logical, self.physical)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _member_ended(decompressor):
+    """Whether decompressor has seen the end of its gzip member.
+    Bytes fed after the end come back as unused_data, before it
+    at least the first one is consumed.
+
+    """
+    probe = decompressor.copy()
+    try:
+        probe.decompress('\0\0')
+    except zlib.error:
+        return False
+    return probe.unused_data == '\0\0'
+
+
+def gunzip_stream(src, dst, block_size=BLOCK_SIZE):
+    """Decompress gzip data read from src into dst file object.
+    Concatenated gzip members are supported like gunzip does.
+    Output is produced by at most block_size bytes, zeros
+    of raw disk compress about thousand times.
+    Return (bytes written, sha1 hex digest of written data)
+
+    """
+    digest = sha1()
+    written = 0
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        chunk = src.read(block_size)
+        if not chunk:
+            break
+        while True:
+            data = decompressor.decompress(chunk, block_size)
+            dst.write(data)
+            digest.update(data)
+            written += len(data)
+            if decompressor.unused_data:
+                # next member, unconsumed_tail holds it too
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                continue
+            chunk = decompressor.unconsumed_tail
+            if not chunk and len(data) < block_size:
+                # else output could still be pending inside zlib
+                break
+    if not _member_ended(decompressor):
+        raise RuntimeError("Truncated gzip data after %s bytes" % written)
+    data = decompressor.flush()
+    dst.write(data)
+    digest.update(data)
+    written += len(data)
+    return written, digest.hexdigest()
+
+
+def extract_disk(fileobj, target_path):
+    """Walk .xvm2 tar stream read from fileobj up to the first
+    .gz member and decompress it into sparse target_path on the fly.
+    fileobj does not have to be seekable, e.g. HTTP response.
+    Return (member name, sha1 hex digest of raw disk, IOStats)
+
+    """
+    pkg_file = tarfile.open(fileobj=fileobj, mode='r|*')
+    for member in pkg_file:
+        if member.isfile() and member.name.endswith('.gz'):
+            src = pkg_file.extractfile(member)
+            with SparseFile(target_path) as dst:
+                size, checksum = gunzip_stream(src, dst)
+            return member.name, checksum, dst.stats()
+    raise RuntimeError(
+        "Could not find disk file in package")
+
+
+def copy_range(src_path, offset, length, dst_path,
+               block_size=BLOCK_SIZE):
+    """Copy length bytes from offset of src_path to sparse
+    dst_path by large blocks. Return IOStats
+
+    """
+    src = open(src_path, 'rb')
+    try:
+        src.seek(offset)
+        with SparseFile(dst_path) as dst:
+            left = length
+            while left > 0:
+                data = src.read(min(block_size, left))
+                if not data:
+                    raise RuntimeError(
+                        "%s ends before %s bytes copied from %s" % (
+                            src_path, length, offset))
+                dst.write(data)
+                left -= len(data)
+        return dst.stats()
+    finally:
+        src.close()
@@ -0,0 +1,281 @@
+"""
+Resumable package download with parallel HTTP Range requests.
+Completed chunks are saved next to the file,
+so restarted provision fetches only the missing ones
+
+"""
+
+import os
+import re
+import json
+import time
+import base64
+import urllib2
+from hashlib import md5
+from threading import Thread, Lock
+from Queue import Queue, Empty
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+WORKERS = 4
+CHUNK_SIZE = 8*1024*1024
+READ_SIZE = 256*1024
+SOCKET_TIMEOUT = 60 #sec
+RETRIES = 3
+RETRY_DELAY = 1 #sec, grows with attempts
+
+
+class RangesNotSupported(Exception):
+    "Raise if server ignores Range header"
+    pass
+
+
+class DownloadError(RuntimeError):
+    "Raise if download could not be completed"
+    pass
+
+
+class Downloader(object):
+    """Download url to path by chunk_size pieces
+    with workers concurrent requests.
+
+    The file is preallocated with its final size,
+    chunk numbers already written are kept in path.state.
+    Size is always verified, MD5 is verified if the server
+    sends it in X-Goog-Hash or as plain MD5 ETag.
+
+    """
+    retry_delay = RETRY_DELAY
+
+    def __init__(self, url, path, workers=WORKERS,
+                 chunk_size=CHUNK_SIZE, timeout=SOCKET_TIMEOUT,
+                 deadline=None):
+        self.url = url
+        self.path = path
+        self.state_path = path + '.state'
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.deadline = deadline
+        self.size = None
+        self.md5 = None
+        self.done = set()
+        self.fetched = 0
+        self.started = None
+        self._lock = Lock()
+        self._error = None
+
+    def probe(self):
+        """Get size and checksum with one byte range request.
+        Raise RangesNotSupported if server sends whole body
+
+        """
+        request = urllib2.Request(self.url, headers={'Range': 'bytes=0-0'})
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        try:
+            content_range = response.info().getheader('Content-Range', '')
+            match = re.match('bytes\s+0-0/(\d+)', content_range)
+            if response.getcode() != 206 or not match:
+                raise RangesNotSupported(
+                    "%s does not support Range requests" % self.url)
+            self.size = int(match.group(1))
+            self.md5 = _expected_md5(response.info())
+        finally:
+            response.close()
+
+    def chunks(self):
+        "Number of chunks in file"
+        return (self.size + self.chunk_size - 1) // self.chunk_size
+
+    def _load_state(self):
+        "Restore completed chunks if they were made for the same file"
+        self.done = set()
+        if not os.path.exists(self.state_path) or \
+                not os.path.exists(self.path):
+            return
+        try:
+            state = json.load(open(self.state_path))
+        except ValueError:
+            logger.warning("Broken download state %s", self.state_path)
+            return
+        if (state.get('url'), state.get('size'),
+            state.get('chunk_size')) == (
+            self.url, self.size, self.chunk_size) and \
+            os.path.getsize(self.path) == self.size:
+            self.done = set(state.get('done', []))
+
+    def _save_state(self):
+        """Atomically write list of completed chunks,
+        their data is already synced by _fetch
+
+        """
+        tmp_path = self.state_path + '.tmp'
+        file_ = open(tmp_path, 'w')
+        try:
+            json.dump({'url': self.url,
+                       'size': self.size,
+                       'chunk_size': self.chunk_size,
+                       'done': sorted(self.done)},
+                      file_)
+            file_.flush()
+            os.fsync(file_.fileno())
+        finally:
+            file_.close()
+        os.rename(tmp_path, self.state_path)
+
+    def _preallocate(self):
+        if os.path.exists(self.path) and \
+                os.path.getsize(self.path) == self.size:
+            return
+        file_ = open(self.path, 'wb')
+        file_.truncate(self.size)
+        file_.close()
+
+    def _fetch(self, chunk):
+        "Download one chunk and write it in place"
+        start = chunk * self.chunk_size
+        end = min(start + self.chunk_size, self.size) - 1
+        request = urllib2.Request(
+            self.url, headers={'Range': 'bytes=%s-%s' % (start, end)})
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        try:
+            content_range = response.info().getheader('Content-Range', '')
+            if response.getcode() != 206 or not content_range.startswith(
+                'bytes %s-%s/' % (start, end)):
+                raise DownloadError(
+                    "Unexpected response for chunk %s: %s %s" % (
+                        chunk, response.getcode(), content_range))
+            fd = os.open(self.path, os.O_WRONLY)
+            try:
+                os.lseek(fd, start, os.SEEK_SET)
+                left = end - start + 1
+                while left > 0:
+                    if self._error:
+                        raise DownloadError("Download aborted")
+                    data = response.read(min(READ_SIZE, left))
+                    if not data:
+                        raise DownloadError(
+                            "Connection closed in chunk %s" % chunk)
+                    os.write(fd, data)
+                    left -= len(data)
+                    with self._lock:
+                        self.fetched += len(data)
+                # chunk is on disk before state says it is done,
+                # so resume after a crash does not keep holes
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        finally:
+            response.close()
+        with self._lock:
+            self.done.add(chunk)
+            self._save_state()
+
+    def _worker(self, queue):
+        while not self._error:
+            try:
+                chunk = queue.get_nowait()
+            except Empty:
+                return
+            for attempt in range(RETRIES):
+                try:
+                    self._fetch(chunk)
+                    break
+                except Exception, e:
+                    if self._error:
+                        return
+                    logger.warning("Chunk %s of %s failed: %s",
+                                   chunk, self.url, e)
+                    if attempt == RETRIES - 1:
+                        self._error = e
+                        return
+                    time.sleep(self.retry_delay * (attempt + 1))
+
+    def run(self, progress=None, progress_interval=5):
+        """Download missing chunks, verify the file.
+        progress(self) is called from the calling thread
+        every progress_interval seconds
+
+        """
+        if self.size is None:
+            self.probe()
+        self._load_state()
+        self._preallocate()
+        queue = Queue()
+        for chunk in range(self.chunks()):
+            if chunk not in self.done:
+                queue.put(chunk)
+        if self.done:
+            logger.info("Resuming %s, %s of %s chunks are done",
+                        self.url, len(self.done), self.chunks())
+        self.started = time.time()
+        threads = [Thread(target=self._worker, args=(queue,))
+                   for i in range(min(self.workers, queue.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        reported = time.time()
+        while [x for x in threads if x.is_alive()]:
+            for thread in threads:
+                thread.join(0.5)
+            if self.deadline and time.time() > self.deadline:
+                self._error = DownloadError(
+                    "Time limit for package download is reached.")
+            if progress and time.time() - reported >= progress_interval:
+                progress(self)
+                reported = time.time()
+        if self._error:
+            raise DownloadError(
+                "Could not download %s: %s" % (self.url, self._error))
+        self._verify()
+        os.unlink(self.state_path)
+        if progress:
+            progress(self)
+
+    def _verify(self):
+        size = os.path.getsize(self.path)
+        if size != self.size or len(self.done) != self.chunks():
+            raise DownloadError(
+                "%s has %s bytes in %s chunks, expected %s" % (
+                    self.path, size, len(self.done), self.size))
+        if self.md5:
+            digest = md5()
+            file_ = open(self.path, 'rb')
+            try:
+                for data in iter(lambda: file_.read(CHUNK_SIZE), ''):
+                    digest.update(data)
+            finally:
+                file_.close()
+            if digest.hexdigest() != self.md5:
+                os.unlink(self.state_path)
+                raise DownloadError(
+                    "MD5 of %s is %s, expected %s" % (
+                        self.path, digest.hexdigest(), self.md5))
+
+    def completed(self):
+        "Part of file already on disk, from 0 to 1"
+        if not self.size:
+            return 0.0
+        with self._lock:
+            done = len(self.done) * self.chunk_size
+        return min(done, self.size) / float(self.size)
+
+    def rate(self):
+        "Bytes per second fetched by this run"
+        if not self.started:
+            return 0.0
+        return self.fetched / max(time.time() - self.started, 0.001)
+
+
+def _expected_md5(headers):
+    "Return MD5 hex digest of whole file announced by server or None"
+    goog_hash = headers.getheader('X-Goog-Hash', '')
+    match = re.search('md5=([A-Za-z0-9+/=]+)', goog_hash)
+    if match:
+        return base64.b64decode(match.group(1)).encode('hex')
+    etag = headers.getheader('ETag', '').strip('"')
+    if re.match('^[0-9a-f]{32}$', etag):
+        return etag
+    return None
@@ -0,0 +1,314 @@
+"""
+Read-only access to ext2/3/4 file systems inside raw disk images.
+Used to take kernel and initrd out of VM disk
+without sudo mount and loop devices
+
+"""
+
+import mmap
+import struct
+import posixpath
+from fnmatch import fnmatch
+
+
+EXT_MAGIC = 0xef53
+ROOT_INODE = 2
+
+INCOMPAT_FILETYPE = 0x2
+INCOMPAT_64BIT = 0x80
+
+EXTENTS_FL = 0x80000
+INLINE_DATA_FL = 0x10000000
+EXTENT_MAGIC = 0xf30a
+EXTENT_INIT_MAX_LEN = 32768
+
+S_IFMT = 0xf000
+S_IFDIR = 0x4000
+S_IFREG = 0x8000
+S_IFLNK = 0xa000
+
+MAX_SYMLINKS = 8
+COPY_SIZE = 1024*1024
+
+
+class ExtFSError(RuntimeError):
+    "Raise if file system could not be read"
+    pass
+
+
+class Inode(object):
+    "Fields of on-disk inode needed for reading"
+    def __init__(self, number, raw):
+        self.number = number
+        self.mode, = struct.unpack('<H', raw[0:2])
+        size_lo, = struct.unpack('<I', raw[4:8])
+        self.flags, = struct.unpack('<I', raw[32:36])
+        self.block = raw[40:100]
+        size_hi = 0
+        if len(raw) >= 112:
+            size_hi, = struct.unpack('<I', raw[108:112])
+        self.size = size_lo | (size_hi << 32)
+        self.blocks, = struct.unpack('<I', raw[28:32])
+
+    def is_dir(self):
+        return self.mode & S_IFMT == S_IFDIR
+
+    def is_file(self):
+        return self.mode & S_IFMT == S_IFREG
+
+    def is_symlink(self):
+        return self.mode & S_IFMT == S_IFLNK
+
+
+class ExtFS(object):
+    """ext2/3/4 file system starting at offset bytes of
+    the image file. The image is memory mapped,
+    so only touched blocks are read from disk.
+
+    mount_point is where the file system is mounted
+    inside VM, e.g. '/boot' for separate boot partition.
+    It is needed to follow absolute symlinks.
+
+    """
+    def __init__(self, path, offset=0, mount_point='/'):
+        self.path = path
+        self.offset = offset
+        self.mount_point = mount_point
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+        try:
+            self._read_superblock()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read(self, pos, size):
+        "Read bytes from file system position"
+        start = self.offset + pos
+        if start + size > len(self._map):
+            raise ExtFSError(
+                "Read beyond the end of %s" % self.path)
+        return self._map[start:start + size]
+
+    def _read_superblock(self):
+        sb = self._read(1024, 1024)
+        magic, = struct.unpack('<H', sb[56:58])
+        if magic != EXT_MAGIC:
+            raise ExtFSError(
+                "No ext file system in %s at %s" % (
+                    self.path, self.offset))
+        (self.first_data_block, log_block_size) = struct.unpack(
+            '<II', sb[20:28])
+        self.block_size = 1024 << log_block_size
+        self.inodes_per_group, = struct.unpack('<I', sb[40:44])
+        rev_level, = struct.unpack('<I', sb[76:80])
+        self.inode_size = 128
+        if rev_level >= 1:
+            self.inode_size, = struct.unpack('<H', sb[88:90])
+        self.incompat, = struct.unpack('<I', sb[96:100])
+        self.desc_size = 32
+        if self.incompat & INCOMPAT_64BIT:
+            self.desc_size, = struct.unpack('<H', sb[254:256])
+
+    def _block(self, number, count=1):
+        return self._read(number * self.block_size,
+                          count * self.block_size)
+
+    def inode(self, number):
+        "Return Inode by its number"
+        group, index = divmod(number - 1, self.inodes_per_group)
+        desc_pos = (self.first_data_block + 1) * self.block_size + \
+            group * self.desc_size
+        desc = self._read(desc_pos, self.desc_size)
+        table, = struct.unpack('<I', desc[8:12])
+        if self.desc_size >= 64:
+            table |= struct.unpack('<I', desc[40:44])[0] << 32
+        return Inode(number, self._read(
+                table * self.block_size + index * self.inode_size,
+                self.inode_size))
+
+    def _extent_runs(self, node):
+        "Yield (logical block, physical block, count) from extent tree"
+        magic, entries, _, depth = struct.unpack('<HHHH', node[:8])
+        if magic != EXTENT_MAGIC:
+            raise ExtFSError("Bad extent header in %s" % self.path)
+        for i in range(entries):
+            entry = node[12 + 12*i:24 + 12*i]
+            if depth == 0:
+                logical, length, start_hi, start_lo = struct.unpack(
+                    '<IHHI', entry)
+                if length > EXTENT_INIT_MAX_LEN:
+                    # not initialized extent reads as zeros
+                    continue
+                yield logical, (start_hi << 32) | start_lo, length
+            else:
+                logical, leaf_lo, leaf_hi = struct.unpack(
+                    '<IIH', entry[:10])
+                for run in self._extent_runs(
+                    self._block((leaf_hi << 32) | leaf_lo)):
+                    yield run
+
+    def _indirect_runs(self, block, level, logical):
+        "Yield runs of indirect block map, return nothing for holes"
+        if not block:
+            return
+        if level == 0:
+            yield logical, block, 1
+            return
+        per_block = self.block_size / 4
+        pointers = struct.unpack(
+            '<%dI' % per_block, self._block(block))
+        span = per_block ** (level - 1)
+        for i, pointer in enumerate(pointers):
+            for run in self._indirect_runs(
+                pointer, level - 1, logical + i * span):
+                yield run
+
+    def _runs(self, inode):
+        "Yield (logical block, physical block, count) of inode data"
+        if inode.flags & INLINE_DATA_FL:
+            raise ExtFSError(
+                "Inline data of inode %s is not supported" % (
+                    inode.number,))
+        if inode.flags & EXTENTS_FL:
+            for run in self._extent_runs(inode.block):
+                yield run
+            return
+        pointers = struct.unpack('<15I', inode.block)
+        for i in range(12):
+            if pointers[i]:
+                yield i, pointers[i], 1
+        per_block = self.block_size / 4
+        logical = 12
+        for level, pointer in [(1, pointers[12]),
+                               (2, pointers[13]),
+                               (3, pointers[14])]:
+            for run in self._indirect_runs(pointer, level, logical):
+                yield run
+            logical += per_block ** level
+
+    def iter_data(self, inode, chunk_size=COPY_SIZE):
+        "Yield file content of inode by chunks, holes as zeros"
+        block_size = self.block_size
+        pos = 0
+        for logical, physical, count in sorted(self._runs(inode)):
+            start = logical * block_size
+            if start >= inode.size:
+                break
+            if start > pos:
+                yield '\0' * (start - pos)
+                pos = start
+            end = min(start + count * block_size, inode.size)
+            base = physical * block_size
+            while pos < end:
+                size = min(chunk_size, end - pos)
+                yield self._read(base + pos - start, size)
+                pos += size
+        if pos < inode.size:
+            yield '\0' * (inode.size - pos)
+
+    def read_data(self, inode):
+        return ''.join(self.iter_data(inode))
+
+    def _entries(self, inode):
+        "Yield (name, inode number) of directory"
+        data = self.read_data(inode)
+        with_type = self.incompat & INCOMPAT_FILETYPE
+        pos = 0
+        while pos + 8 <= len(data):
+            number, rec_len = struct.unpack('<IH', data[pos:pos+6])
+            if with_type:
+                name_len = ord(data[pos+6])
+            else:
+                name_len, = struct.unpack('<H', data[pos+6:pos+8])
+            if rec_len < 8:
+                break
+            if number:
+                yield data[pos+8:pos+8+name_len], number
+            pos += rec_len
+
+    def _symlink_target(self, inode):
+        if inode.size < 60 and not inode.flags & EXTENTS_FL and \
+                not inode.blocks:
+            return inode.block[:inode.size]
+        return self.read_data(inode)
+
+    def lookup(self, path, follow=True):
+        "Return Inode for path, symlinks are followed"
+        return self._lookup(path, follow, 0)
+
+    def _lookup(self, path, follow, depth):
+        if depth > MAX_SYMLINKS:
+            raise ExtFSError("Too many symlinks for %s" % path)
+        inode = self.inode(ROOT_INODE)
+        current = '/'
+        parts = [x for x in path.split('/') if x and x != '.']
+        for i, name in enumerate(parts):
+            if not inode.is_dir():
+                raise ExtFSError("%s is not a directory" % current)
+            if name == '..':
+                current = posixpath.dirname(current)
+                inode = self._lookup(current, True, depth)
+                continue
+            number = dict(self._entries(inode)).get(name)
+            if number is None:
+                raise ExtFSError(
+                    "%s not found in %s" % (name, current))
+            inode = self.inode(number)
+            last = i == len(parts) - 1
+            if inode.is_symlink() and (follow or not last):
+                target = self._symlink_target(inode)
+                if target.startswith('/'):
+                    target = self._strip_mount_point(target)
+                else:
+                    target = posixpath.join(current, target)
+                rest = '/'.join(parts[i+1:])
+                return self._lookup(
+                    posixpath.join(target, rest), follow, depth + 1)
+            current = posixpath.join(current, name)
+        return inode
+
+    def _strip_mount_point(self, path):
+        "Convert absolute path inside VM to path inside this fs"
+        mount_point = self.mount_point.rstrip('/')
+        if mount_point and (path == mount_point or
+                            path.startswith(mount_point + '/')):
+            return path[len(mount_point):] or '/'
+        return path
+
+    def listdir(self, path):
+        "Return names in directory except . and .."
+        return [name for name, number in self._entries(
+                self.lookup(path)) if name not in ('.', '..')]
+
+    def glob(self, path, pattern):
+        "Return sorted names in directory matching pattern"
+        return sorted(x for x in self.listdir(path) if fnmatch(x, pattern))
+
+    def copy(self, path, target_path):
+        "Stream regular file out of the file system, return its size"
+        inode = self.lookup(path)
+        if not inode.is_file():
+            raise ExtFSError("%s is not a regular file" % path)
+        target = open(target_path, 'wb')
+        try:
+            for chunk in self.iter_data(inode):
+                target.write(chunk)
+        finally:
+            target.close()
+        return inode.size
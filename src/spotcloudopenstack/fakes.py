@@ -0,0 +1,708 @@
+"""
+Local stand-ins for external services,
+used by tests and benchmarks
+
+"""
+
+import os
+import re
+import sys
+import gzip
+import time
+import random
+import uuid
+import shutil
+import struct
+import base64
+import tarfile
+import zipfile
+import tempfile
+import socket
+import urlparse
+from hashlib import md5
+from threading import Thread, Lock
+from contextlib import contextmanager
+from subprocess import Popen, PIPE
+from StringIO import StringIO
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+class _PackageHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        data = server.packages.get(query.get('uuid', [''])[0])
+        if data is None:
+            self.send_error(404)
+            return
+        with server.lock:
+            server.requests += 1
+            fail = server.fail_after is not None and \
+                server.requests > server.fail_after
+        match = re.match('bytes=(\d+)-(\d*)',
+                         self.headers.getheader('Range', ''))
+        if match and server.ranges:
+            start = int(match.group(1))
+            end = int(match.group(2) or len(data) - 1)
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (
+                    start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if server.etag:
+            self.send_header('ETag', '"%s"' % md5(data).hexdigest())
+        self.end_headers()
+        if fail:
+            # drop connection in the middle of the body
+            self.wfile.write(body[:len(body) // 2])
+            return
+        self.wfile.write(body)
+
+
+class PackageServer(ThreadingMixIn, HTTPServer):
+    """Serve .xvm2 packages like PACKAGE_DOWNLOAD_URL_TMPL does:
+    GET /api/package/download?uuid=<uuid>
+    with Range support. Requests after fail_after are cut short.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, packages=None, ranges=True, etag=True):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _PackageHandler)
+        self.packages = packages or {}
+        self.ranges = ranges
+        self.etag = etag
+        self.fail_after = None
+        self.requests = 0
+        self.lock = Lock()
+        self._thread = None
+
+    def handle_error(self, request, client_address):
+        "Clients dropping connections are expected"
+        pass
+
+    @property
+    def url_tmpl(self):
+        return 'http://127.0.0.1:%s/api/package/download?uuid=%%s' % (
+            self.server_address[1],)
+
+    def start(self):
+        self._thread = Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+MB = 1024*1024
+PART_START = 1024*1024 # first partition at LBA 2048 like fdisk does
+BOOT_SIZE = 32*MB
+SECTOR = 512
+MBR_LINUX = 0x83
+GPT_BOOT = 'bc13c2ff-59e6-4262-a352-b275fd6f7172'
+GPT_ROOT = '4f68bce3-e8cd-4db1-96e7-fbcaf984b709'
+# mbr: one root partition, mbr-boot and gpt: separate /boot,
+# none: file system on the whole disk
+LAYOUTS = ('mbr', 'mbr-boot', 'gpt', 'none')
+KERNEL_VERSION = '2.6.32-21-generic'
+
+
+def _mke2fs(path, offset, size, files):
+    "Make ext4 at offset of path with files {name: data}, no root needed"
+    src = tempfile.mkdtemp()
+    try:
+        for name, data in files.items():
+            file_path = os.path.join(src, name)
+            if not os.path.exists(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            out = open(file_path, 'wb')
+            try:
+                # big random files are written by parts
+                for i in range(0, len(data) or 1, 4*MB):
+                    out.write(data[i:i + 4*MB])
+            finally:
+                out.close()
+        proc = Popen(['mke2fs', '-q', '-F', '-t', 'ext4',
+                      '-E', 'offset=%s' % offset, '-d', src,
+                      path, '%dk' % (size // 1024)],
+                     stdout=PIPE, stderr=PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode:
+            raise RuntimeError("mke2fs failed: %s" % stderr)
+    finally:
+        shutil.rmtree(src)
+
+
+def _mbr(entries):
+    "Return MBR with (bootable, type, offset, size) entries"
+    table = ''.join(
+        struct.pack('<B3sB3sII', bootable and 0x80 or 0, '\0' * 3,
+                    ptype, '\0' * 3, offset // SECTOR, size // SECTOR)
+        for bootable, ptype, offset, size in entries)
+    return '\0' * 446 + table.ljust(64, '\0') + '\x55\xaa'
+
+
+def _gpt(entries):
+    "Return protective MBR, GPT header and entries, (type, offset, size)"
+    table = ''.join(
+        uuid.UUID(ptype).bytes_le + uuid.uuid4().bytes_le +
+        struct.pack('<QQQ', offset // SECTOR,
+                    (offset + size) // SECTOR - 1, 0) + '\0' * 72
+        for ptype, offset, size in entries)
+    header = 'EFI PART' + '\0' * 64 + struct.pack('<QII', 2, 128, 128)
+    return _mbr([(False, 0xee, SECTOR, PART_START - SECTOR)]) + \
+        header.ljust(SECTOR, '\0') + table.ljust(128 * 128, '\0')
+
+
+def make_disk(path, size, layout='mbr', fill=0.1, kernel_size=4*MB):
+    """Make raw disk image of size bytes with ext4 root file system
+    holding /boot/vmlinuz-* and /boot/initrd.img-*.
+    fill is part of root file system taken by random data,
+    the rest of the disk is zeros
+
+    """
+    if layout not in LAYOUTS:
+        raise ValueError("layout should be one of %s" % (LAYOUTS,))
+    boot_files = {
+        'vmlinuz-' + KERNEL_VERSION: os.urandom(kernel_size),
+        'initrd.img-' + KERNEL_VERSION: os.urandom(kernel_size // 2)}
+    out = open(path, 'wb')
+    out.truncate(size)
+    out.close()
+    # root must stay the largest partition
+    boot_size = min(BOOT_SIZE, size // 8 // MB * MB)
+    if layout == 'none':
+        root_start, root_size = 0, size
+    elif layout == 'mbr':
+        root_start, root_size = PART_START, size - PART_START
+    else:
+        root_start = PART_START + boot_size
+        root_size = size - root_start
+    root_files = {'var/lib/data': os.urandom(int(root_size * fill)),
+                  'etc/hostname': 'bench\n'}
+    if layout in ('none', 'mbr'):
+        root_files.update(('boot/' + name, data)
+                          for name, data in boot_files.items())
+    else:
+        _mke2fs(path, PART_START, boot_size, boot_files)
+    _mke2fs(path, root_start, root_size, root_files)
+    if layout == 'mbr':
+        head = _mbr([(True, MBR_LINUX, root_start, root_size)])
+    elif layout == 'mbr-boot':
+        head = _mbr([(True, MBR_LINUX, PART_START, boot_size),
+                     (False, MBR_LINUX, root_start, root_size)])
+    elif layout == 'gpt':
+        head = _gpt([(GPT_BOOT, PART_START, boot_size),
+                     (GPT_ROOT, root_start, root_size)])
+    else:
+        return path
+    out = open(path, 'r+b')
+    out.write(head)
+    out.close()
+    return path
+
+
+def make_xvm2(disk_path, target_path, compresslevel=1):
+    """Pack raw disk into .xvm2: tar with package.xml and gzipped
+    disk. All-zero blocks compress to almost nothing like in real
+    packages
+
+    """
+    gz_path = target_path + '.gz'
+    src = open(disk_path, 'rb')
+    try:
+        gz = gzip.GzipFile(gz_path, 'wb', compresslevel)
+        for data in iter(lambda: src.read(4*MB), ''):
+            gz.write(data)
+        gz.close()
+    finally:
+        src.close()
+    try:
+        tar = tarfile.open(target_path, 'w')
+        xml = '<package><os>linux</os></package>'
+        info = tarfile.TarInfo('package.xml')
+        info.size = len(xml)
+        tar.addfile(info, StringIO(xml))
+        tar.add(gz_path, 'disk.raw.gz')
+        tar.close()
+    finally:
+        os.unlink(gz_path)
+    return target_path
+
+
+FAKE_QEMU_IMG = """#!%(python)s
+# qemu-img stand-in: version and convert to "qcow2"
+# by sparse copy of raw input
+import sys, json
+args = sys.argv[1:]
+if args[0] == '--version':
+    print('qemu-img version %(version)s')
+    sys.exit(0)
+files = []
+i = 1
+while i < len(args):
+    if args[i] in ('-f', '-O'):
+        i += 2
+        continue
+    files.append(args[i])
+    i += 1
+src, dst = files
+offset, size = 0, None
+if src.startswith('json:'):
+    spec = json.loads(src[5:])
+    offset, size = spec['offset'], spec['size']
+    src = spec['file']['filename']
+inp = open(src, 'rb')
+inp.seek(offset)
+out = open(dst, 'wb')
+left = size
+written = 0
+while left is None or left > 0:
+    data = inp.read(1024*1024 if left is None else min(1024*1024, left))
+    if not data:
+        break
+    if data.count(b'\\0') == len(data):
+        out.seek(len(data), 1)
+    else:
+        out.write(data)
+    written += len(data)
+    if left is not None:
+        left -= len(data)
+out.truncate(written)
+out.close()
+"""
+
+# prints image id like uec-publish-tarball does
+FAKE_PUBLISH = """#!/bin/sh
+sleep %(delay)s
+%(keep)s
+echo "emi=\\"emi-$2\\"; eri=\\"none\\"; eki=\\"none\\";"
+"""
+
+
+def write_fake_tools(target_dir, qemu_img_version='1.0', publish_delay=0,
+                     keep_dir=None):
+    """Write qemu-img and publish script stand-ins into target_dir.
+    qemu-img older than 2.9 makes provision copy root partition out.
+    Published tar.gz files are copied to keep_dir if it is given.
+    Return (qemu_img path, publish script path)
+
+    """
+    result = []
+    keep = keep_dir and 'cp "$1" "%s/"' % keep_dir or ''
+    for name, text in [
+        ('qemu-img', FAKE_QEMU_IMG % {'python': sys.executable,
+                                      'version': qemu_img_version}),
+        ('publish', FAKE_PUBLISH % {'delay': publish_delay,
+                                    'keep': keep})]:
+        path = os.path.join(target_dir, name)
+        open(path, 'w').write(text)
+        os.chmod(path, 0755)
+        result.append(path)
+    return tuple(result)
+
+
+class FakeEC2Instance(object):
+    def __init__(self, image_id, instance_type):
+        self.id = 'i-%08x' % (uuid.uuid4().int & 0xffffffff)
+        self.image_id = image_id
+        self.instance_type = instance_type
+        self.state = 'running'
+        self.dns_name = '10.0.0.%s' % (uuid.uuid4().int % 250 + 2)
+
+
+class FakeReservation(object):
+    def __init__(self, instances):
+        self.id = 'r-%08x' % (uuid.uuid4().int & 0xffffffff)
+        self.instances = instances
+
+
+class FakeEC2Connection(object):
+    "In memory subset of EC2 API used by provision"
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.reservations = []
+        self._lock = Lock()
+
+    def run_instances(self, image_id, instance_type=None, **kw):
+        time.sleep(self.latency)
+        reservation = FakeReservation(
+            [FakeEC2Instance(image_id, instance_type)])
+        with self._lock:
+            self.reservations.append(reservation)
+        return reservation
+
+    def get_all_instances(self):
+        time.sleep(self.latency)
+        with self._lock:
+            return list(self.reservations)
+
+    def terminate_instances(self, instance_ids):
+        time.sleep(self.latency)
+        with self._lock:
+            for reservation in self.reservations:
+                reservation.instances = [
+                    x for x in reservation.instances
+                    if x.id not in instance_ids]
+
+
+class FakeNovaManager(object):
+    """Stand-in for NovaConnectionManager, set it as
+    novaconn._manager to provision without a cloud
+
+    """
+    def __init__(self, latency=0):
+        self.conn = FakeEC2Connection(latency)
+
+    @contextmanager
+    def connection(self):
+        yield self.conn
+
+    def new_connection(self):
+        return self.conn
+
+
+INSTANCE_TYPES = [
+    # name, memory MB, vcpus, disk GB, flavor id; Nova defaults
+    ('m1.tiny', 512, 1, 0, 1),
+    ('m1.small', 2048, 1, 20, 2),
+    ('m1.medium', 4096, 2, 40, 3),
+    ('m1.large', 8192, 4, 80, 4),
+    ('m1.xlarge', 16384, 8, 160, 5)]
+
+_XMLNS = 'http://ec2.amazonaws.com/doc/2010-08-31/'
+
+
+def _xml_escape(value):
+    return str(value).replace('&', '&amp;').replace(
+        '<', '&lt;').replace('>', '&gt;')
+
+
+def _instance_xml(instance):
+    return ('<item><instanceId>%(id)s</instanceId>'
+            '<imageId>%(image_id)s</imageId>'
+            '<instanceState><code>%(code)s</code>'
+            '<name>%(state)s</name></instanceState>'
+            '<privateDnsName>%(dns_name)s</privateDnsName>'
+            '<dnsName>%(dns_name)s</dnsName>'
+            '<instanceType>%(instance_type)s</instanceType>'
+            '<launchTime>%(launch_time)s</launchTime>'
+            '<placement><availabilityZone>nova</availabilityZone>'
+            '</placement></item>') % instance
+
+
+def _reservation_xml(reservation_id, instances, owner):
+    return ('<reservationId>%s</reservationId><ownerId>%s</ownerId>'
+            '<groupSet><item><groupId>default</groupId></item></groupSet>'
+            '<instancesSet>%s</instancesSet>') % (
+        reservation_id, owner, ''.join(_instance_xml(x) for x in instances))
+
+
+class _NovaHandler(BaseHTTPRequestHandler):
+    # keep-alive like the real API, so connection pool is exercised
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            params.update(urlparse.parse_qs(self.rfile.read(length)))
+        return url.path, dict((key, value[0])
+                              for key, value in params.items())
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path, params = self._params()
+        action = params.get('Action')
+        server = self.server
+        handler = server.ACTIONS.get((path.rstrip('/'), action))
+        if handler is None:
+            self._reply(400, server.error_xml(
+                    'InvalidAction', 'Unknown action %s' % action))
+            return
+        failure = server.begin_call(action)
+        if failure:
+            self._reply(failure[0], server.error_xml(*failure[1:]))
+            return
+        try:
+            body = getattr(server, handler)(params)
+        except KeyError, e:
+            self._reply(400, server.error_xml(
+                    'NotFound', 'Not found: %s' % e))
+            return
+        self._reply(200, '<%sResponse xmlns="%s">'
+                    '<requestId>%s</requestId>%s</%sResponse>' % (
+                action, _XMLNS, uuid.uuid4(), body, action))
+
+    do_POST = do_GET
+
+
+class FakeNovaServer(ThreadingMixIn, HTTPServer):
+    """Subset of Nova EC2 (/services/Cloud) and Admin
+    (/services/Admin) query API used by the adapter,
+    kept in memory. Signatures are not checked.
+
+    latency is seconds added to every call, action_latency
+    overrides it per action. Calls fail with 400 by
+    failure_rate or after fail(action); boto retries 5xx
+    with backoff, so pass status=503 to exercise that.
+
+    """
+    daemon_threads = True
+    ACTIONS = {
+        ('/services/Cloud', 'DescribeInstances'): 'describe_instances',
+        ('/services/Cloud', 'RunInstances'): 'run_instances',
+        ('/services/Cloud', 'TerminateInstances'): 'terminate_instances',
+        ('/services/Admin', 'DescribeUser'): 'describe_user',
+        ('/services/Admin', 'DescribeInstanceTypes'):
+            'describe_instance_types',
+        ('/services/Admin', 'DescribeHosts'): 'describe_hosts',
+        ('/services/Admin', 'GenerateX509ForUser'):
+            'generate_x509_for_user',
+        }
+
+    def __init__(self, latency=0, failure_rate=0,
+                 users=None, hosts=None, instance_types=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _NovaHandler)
+        self.latency = latency
+        self.action_latency = {}
+        self.failure_rate = failure_rate
+        self.users = users or {'admin': ('admin-access', 'admin-secret')}
+        self.hosts = hosts or ['compute-1']
+        # extra DescribeHosts fields by host, e.g. {'memoryMb': 16384};
+        # compute is 'up' unless given, None omits a field
+        self.host_fields = {}
+        self.instance_types = instance_types or list(INSTANCE_TYPES)
+        self.reservations = {}
+        self.instances = {}
+        self._instance_number = 0 # ids are not reused after terminate
+        self.calls = {}
+        self.lock = Lock()
+        self._fail_next = {}
+        self._random = random.Random(0)
+        self._describe_cache = None
+        self._sockets = set()
+        self._thread = None
+
+    def handle_error(self, request, client_address):
+        "Clients dropping connections are expected"
+        pass
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self._sockets.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.lock:
+            self._sockets.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    @property
+    def url(self):
+        "Value for NOVA_ENDPOINT"
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def start(self):
+        self._thread = Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        "Stop serving and close keep-alive connections of clients"
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            sockets = list(self._sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def fail(self, action, count=1, status=400, code='Unavailable'):
+        "Make next count calls of action fail"
+        with self.lock:
+            self._fail_next[action] = (count, status, code)
+
+    def begin_call(self, action):
+        """Count the call and sleep its latency.
+        Return (status, code, message) if it should fail
+
+        """
+        with self.lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            failure = None
+            count, status, code = self._fail_next.get(
+                action, (0, None, None))
+            if count:
+                self._fail_next[action] = (count - 1, status, code)
+                failure = (status, code, 'Injected failure')
+            elif self.failure_rate and \
+                    self._random.random() < self.failure_rate:
+                failure = (400, 'Unavailable', 'Injected failure')
+        time.sleep(self.action_latency.get(action, self.latency))
+        return failure
+
+    def error_xml(self, code, message):
+        return ('<Response><Errors><Error><Code>%s</Code>'
+                '<Message>%s</Message></Error></Errors>'
+                '<RequestID>%s</RequestID></Response>') % (
+            code, _xml_escape(message), uuid.uuid4())
+
+    def add_instances(self, count, image_id='ami-bench',
+                      instance_type='m1.small', state='running'):
+        """Put count instances, one per reservation, into cloud.
+        Return list of (reservation id, instance id)
+
+        """
+        result = []
+        with self.lock:
+            for i in range(count):
+                reservation_id = 'r-%08x' % (uuid.uuid4().int & 0xffffffff)
+                instance = self._new_instance(image_id, instance_type, state)
+                self.reservations[reservation_id] = [instance['id']]
+                result.append((reservation_id, instance['id']))
+        return result
+
+    def _new_instance(self, image_id, instance_type, state):
+        self._instance_number += 1
+        number = self._instance_number
+        instance = dict(
+            id='i-%08x' % number,
+            image_id=image_id,
+            instance_type=instance_type,
+            state=state,
+            code=state == 'running' and 16 or 0,
+            dns_name='10.%s.%s.%s' % (number >> 16 & 255,
+                                      number >> 8 & 255, number & 255),
+            launch_time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+        self.instances[instance['id']] = instance
+        self._describe_cache = None
+        return instance
+
+    def describe_instances(self, params):
+        wanted = set(value for key, value in params.items()
+                     if key.startswith('InstanceId.'))
+        items = []
+        with self.lock:
+            # server shares CPU with the client in tests and
+            # benchmarks, so the full listing is rendered once
+            if not wanted and self._describe_cache is not None:
+                return self._describe_cache
+            for reservation_id, ids in self.reservations.items():
+                instances = [self.instances[x] for x in ids
+                             if not wanted or x in wanted]
+                if instances:
+                    items.append('<item>%s</item>' % _reservation_xml(
+                            reservation_id, instances, 'bench'))
+            body = '<reservationSet>%s</reservationSet>' % ''.join(items)
+            if not wanted:
+                self._describe_cache = body
+        return body
+
+    def run_instances(self, params):
+        count = int(params.get('MaxCount', 1))
+        reservation_id = 'r-%08x' % (uuid.uuid4().int & 0xffffffff)
+        with self.lock:
+            instances = [
+                self._new_instance(params['ImageId'],
+                                   params.get('InstanceType', 'm1.small'),
+                                   'scheduling')
+                for i in range(count)]
+            self.reservations[reservation_id] = [x['id'] for x in instances]
+        return _reservation_xml(reservation_id, instances, 'bench')
+
+    def terminate_instances(self, params):
+        ids = [value for key, value in sorted(params.items())
+               if key.startswith('InstanceId.')]
+        items = []
+        with self.lock:
+            for instance_id in ids:
+                instance = self.instances.pop(instance_id, None)
+                if instance is None:
+                    continue
+                self._describe_cache = None
+                for reservation_id, members in self.reservations.items():
+                    if instance_id in members:
+                        members.remove(instance_id)
+                        if not members:
+                            del self.reservations[reservation_id]
+                items.append(
+                    '<item><instanceId>%s</instanceId>'
+                    '<currentState><code>32</code><name>shutting-down'
+                    '</name></currentState><previousState><code>16</code>'
+                    '<name>%s</name></previousState></item>' % (
+                        instance_id, instance['state']))
+        return '<instancesSet>%s</instancesSet>' % ''.join(items)
+
+    def describe_user(self, params):
+        access, secret = self.users[params['Name']]
+        return ('<username>%s</username><accesskey>%s</accesskey>'
+                '<secretkey>%s</secretkey>') % (
+            _xml_escape(params['Name']), access, secret)
+
+    def generate_x509_for_user(self, params):
+        "nova.zip with novarc and dummy certificates like Nova makes"
+        access, secret = self.users[params['Name']]
+        novarc = '\n'.join([
+                'NOVA_KEY_DIR=$(pushd $(dirname $BASH_SOURCE)>/dev/null; '
+                'pwd; popd>/dev/null)',
+                'export EC2_ACCESS_KEY="%s:%s"' % (access, params['Project']),
+                'export EC2_SECRET_KEY="%s"' % secret,
+                'export EC2_URL="%s/services/Cloud"' % self.url,
+                'export EC2_CERT=${NOVA_KEY_DIR}/cert.pem',
+                ''])
+        data = StringIO()
+        archive = zipfile.ZipFile(data, 'w')
+        archive.writestr('novarc', novarc)
+        for name in ('pk.pem', 'cert.pem', 'cacert.pem'):
+            archive.writestr(name, '-----BEGIN FAKE-----\n')
+        archive.close()
+        return '<username>%s</username><file>%s</file>' % (
+            _xml_escape(params['Name']), base64.b64encode(data.getvalue()))
+
+    def describe_instance_types(self, params):
+        return '<instanceTypeSet>%s</instanceTypeSet>' % ''.join(
+            '<item><name>%s</name><memoryMb>%s</memoryMb>'
+            '<vcpus>%s</vcpus><diskGb>%s</diskGb>'
+            '<flavorId>%s</flavorId></item>' % x
+            for x in self.instance_types)
+
+    def describe_hosts(self, params):
+        with self.lock:
+            count = len(self.instances)
+        items = []
+        for host in self.hosts:
+            fields = {'compute': 'up'}
+            fields.update(self.host_fields.get(host, {}))
+            items.append(
+                '<item><hostname>%s</hostname><instanceCount>%s'
+                '</instanceCount><volumeCount>0</volumeCount>%s</item>' % (
+                    host, count // len(self.hosts), ''.join(
+                        '<%s>%s</%s>' % (name, value, name)
+                        for name, value in sorted(fields.items())
+                        if value is not None)))
+        return '<hostSet>%s</hostSet>' % ''.join(items)
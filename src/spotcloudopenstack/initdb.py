@@ -1,9 +1,7 @@
 """
 Drop and create all needed tables in the Database.
-Run it from account with ability to run nova-manager.
-Usually that means run 
-$ . novarc 
-incide your home folder
+HardwareTemplates are made from Nova instance types
+read with Admin API credentials from config
 
 """
 
@@ -6,10 +6,10 @@ Run App
 from flask import request
 
 from spotcloudopenstack.app import app, db
-from spotcloudopenstack.novaconn import get_nova_connection, nova_manage
+from spotcloudopenstack.novaconn import get_nova_connection
 from spotcloudopenstack.models import HardwareTemplate, Package, VM, Task
 from spotcloudopenstack.provision import ProvisionWorker
-from spotcloudopenstack.api import rest
+from spotcloudopenstack.api import hosting
 
 import logging
 logger = logging.getLogger('spotcloudopenstack')
@@ -0,0 +1,233 @@
+"""
+In-process metrics rendered in Prometheus text format:
+provision stage timings, bytes and child CPU time,
+API and Nova call latencies
+
+"""
+
+import os
+import time
+import errno
+import tempfile
+from threading import Lock
+from contextlib import contextmanager
+from subprocess import Popen
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+_registry = []
+
+
+class Metric(object):
+    "Values of one metric by label values"
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def _label_str(self, values, extra=()):
+        pairs = zip(self.labels, values) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (name, str(value).replace('\\', '\\\\'
+                                                   ).replace('"', '\\"'))
+            for name, value in pairs)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, value in items:
+            lines.extend(self._render_value(values, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *values):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def get(self, *values):
+        return self._values.get(values, 0)
+
+    def _render_value(self, values, value):
+        return ['%s%s %s' % (self.name, self._label_str(values), value)]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *values):
+        with self._lock:
+            counts, total, count = self._values.get(
+                values, ((0,) * len(self.buckets), 0.0, 0))
+            counts = tuple(n + (value <= bound and 1 or 0)
+                           for n, bound in zip(counts, self.buckets))
+            self._values[values] = (counts, total + value, count + 1)
+
+    def count(self, *values):
+        return self._values.get(values, (None, 0.0, 0))[2]
+
+    def totals(self):
+        "Return {label values: (count, sum)}"
+        with self._lock:
+            return dict((values, (count, total))
+                        for values, (counts, total, count)
+                        in self._values.items())
+
+    @contextmanager
+    def time(self, *values):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, *values)
+
+    def _render_value(self, values, value):
+        counts, total, count = value
+        lines = ['%s_bucket%s %s' % (
+                self.name, self._label_str(values, [('le', bound)]), n)
+                 for bound, n in zip(self.buckets, counts)]
+        lines.append('%s_bucket%s %s' % (
+                self.name, self._label_str(values, [('le', '+Inf')]), count))
+        lines.append('%s_sum%s %s' % (
+                self.name, self._label_str(values), total))
+        lines.append('%s_count%s %s' % (
+                self.name, self._label_str(values), count))
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    'spotcloud_provision_stage_seconds',
+    'Time spent in provision stage', ['stage'], STAGE_BUCKETS)
+STAGE_ERRORS = Counter(
+    'spotcloud_provision_stage_errors_total',
+    'Provision stages failed', ['stage'])
+STAGE_BYTES = Counter(
+    'spotcloud_provision_stage_bytes_total',
+    'Bytes processed by provision stage', ['stage'])
+CHILD_CPU = Counter(
+    'spotcloud_provision_child_cpu_seconds_total',
+    'CPU time of child processes run by provision stage',
+    ['stage', 'mode'])
+API_SECONDS = Histogram(
+    'spotcloud_api_request_seconds',
+    'Latency of SpotCloud API calls', ['endpoint', 'method'])
+NOVA_SECONDS = Histogram(
+    'spotcloud_nova_call_seconds',
+    'Latency of Nova EC2 and Admin API calls', ['call'])
+NOVA_ERRORS = Counter(
+    'spotcloud_nova_call_errors_total',
+    'Nova EC2 and Admin API calls failed', ['call'])
+
+
+class StageRecord(object):
+    "Bytes processed by the stage, set inside the with block"
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+
+
+@contextmanager
+def stage(name):
+    """Time provision stage:
+
+        with metrics.stage('extract') as record:
+            record.bytes = size
+
+    """
+    record = StageRecord(name)
+    started = time.time()
+    try:
+        yield record
+    except:
+        STAGE_ERRORS.inc(1, name)
+        raise
+    finally:
+        seconds = time.time() - started
+        STAGE_SECONDS.observe(seconds, name)
+        if record.bytes:
+            STAGE_BYTES.inc(record.bytes, name)
+        logger.debug('stage %s took %.3f sec, %s bytes',
+                     name, seconds, record.bytes)
+
+
+def run(cmd, stage_name, cwd=None):
+    """Run child process, count its CPU time for stage_name.
+    Output goes to temporary files, so the child is reaped
+    by wait4 to get its rusage. Return (returncode, stdout, stderr)
+
+    """
+    stdout = tempfile.TemporaryFile()
+    stderr = tempfile.TemporaryFile()
+    try:
+        proc = Popen(cmd, stdout=stdout, stderr=stderr, cwd=cwd)
+        while True:
+            try:
+                pid, status, rusage = os.wait4(proc.pid, 0)
+                break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        CHILD_CPU.inc(rusage.ru_utime, stage_name, 'user')
+        CHILD_CPU.inc(rusage.ru_stime, stage_name, 'system')
+        stdout.seek(0)
+        stderr.seek(0)
+        return proc.returncode, stdout.read(), stderr.read()
+    finally:
+        stdout.close()
+        stderr.close()
+
+
+class TimedProxy(object):
+    "Time public method calls of target as prefix.method"
+    def __init__(self, target, prefix):
+        self._target = target
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        call_name = '%s.%s' % (self._prefix, name)
+        def timed(*args, **kw):
+            started = time.time()
+            try:
+                return attr(*args, **kw)
+            except:
+                NOVA_ERRORS.inc(1, call_name)
+                raise
+            finally:
+                NOVA_SECONDS.observe(time.time() - started, call_name)
+        return timed
+
+
+def render():
+    "Return all metrics in Prometheus text format"
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -4,28 +4,117 @@ Flask-SQLAlchemy Model subclusses for working with database
 """
 
 
-from datetime import datetime
+from datetime import datetime, timedelta
+import time
 import uuid
 
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine.reflection import Inspector
+
 from spotcloudopenstack.app import app, db
 from spotcloudopenstack.novaconn import get_instance_types, get_instances_dict
 
 
+SQL_CHUNK = 500 # keep IN (...) below SQLite variables limit
+
+
 class Task(db.Model):
     "Model for Tasks, mostly for provision"
     ecp_uuid = db.Column(db.String(36), primary_key=True)
     started = db.Column(db.DateTime, 
-                        default=datetime.now)
+                        default=datetime.now, index=True)
     ended = db.Column(db.DateTime)
     completed = db.Column(db.Integer, default=0)# from 1 to 100
     is_error = db.Column(db.Boolean, default=False)
-    vm_uuid = db.Column(db.String(36), db.ForeignKey("VM.ecp_uuid"))
+    vm_uuid = db.Column(db.String(36), db.ForeignKey("VM.ecp_uuid"),
+                        index=True)
     vm = db.relationship('VM')
     message = db.Column(db.Text)
+    # what to provision, so any process could run the task
+    hardware_uuid = db.Column(db.String(36))
+    package_uuid = db.Column(db.String(36))
+    # provisioning daemon holding the task
+    lease_owner = db.Column(db.String(80))
+    lease_expires = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, default=0)
+    # Nova reservation launched for the task, a retry reuses it
+    reservation_id = db.Column(db.String(80))
+    # claim_pending seeks unfinished tasks instead of reading history
+    __table_args__ = (
+        db.Index('ix_task_pending', 'is_error', 'completed'),)
     
-    def __init__(self, vm_uuid):
+    def __init__(self, vm_uuid, hardware_uuid=None, package_uuid=None):
         self.vm_uuid = vm_uuid
         self.ecp_uuid = str(uuid.uuid1())
+        self.hardware_uuid = hardware_uuid
+        self.package_uuid = package_uuid
+
+    @classmethod
+    def _pending(cls, now):
+        return db.and_(
+            cls.completed < 100,
+            cls.is_error == False,
+            cls.package_uuid != None,
+            db.or_(cls.lease_expires == None,
+                   cls.lease_expires < now))
+
+    @classmethod
+    def claim_pending(cls, owner, lease, limit, max_attempts):
+        """Lease up to limit pending tasks, new ones or abandoned
+        by crashed daemon, to owner for lease seconds.
+        Tasks already tried max_attempts times are failed.
+        Return list of claimed tasks
+
+        """
+        now = datetime.now()
+        rows = db.session.query(
+            cls.ecp_uuid, cls.attempts).filter(
+            cls._pending(now)).order_by(cls.started).limit(limit).all()
+        claimed = []
+        for ecp_uuid, attempts in rows:
+            query = cls.query.filter(
+                cls.ecp_uuid == ecp_uuid, cls._pending(now))
+            if (attempts or 0) >= max_attempts:
+                query.update(
+                    {'is_error': True,
+                     'completed': 100,
+                     'ended': now,
+                     'lease_owner': None,
+                     'lease_expires': None,
+                     'message': "Provision abandoned after %s attempts" % (
+                            attempts,)},
+                    synchronize_session=False)
+                continue
+            # the same pending condition makes update compare-and-set
+            count = query.update(
+                {'lease_owner': owner,
+                 'lease_expires': now + timedelta(seconds=lease),
+                 'attempts': db.func.coalesce(cls.attempts, 0) + 1},
+                synchronize_session=False)
+            if count == 1:
+                claimed.append(ecp_uuid)
+        db.session.commit()
+        return [cls.query.populate_existing().get(x) for x in claimed]
+
+    @classmethod
+    def renew_leases(cls, owner, task_uuids, lease):
+        "Extend leases of tasks still run by owner"
+        for i in range(0, len(task_uuids), SQL_CHUNK):
+            cls.query.filter(
+                cls.ecp_uuid.in_(task_uuids[i:i+SQL_CHUNK]),
+                cls.lease_owner == owner).update(
+                {'lease_expires': datetime.now() + timedelta(seconds=lease)},
+                synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def release_lease(cls, ecp_uuid, owner):
+        "Drop lease of finished task"
+        cls.query.filter_by(
+            ecp_uuid=ecp_uuid, lease_owner=owner).update(
+            {'lease_owner': None, 'lease_expires': None},
+            synchronize_session=False)
+        db.session.commit()
 
 
 class Package(db.Model):
@@ -39,7 +128,7 @@ class Package(db.Model):
     updated = db.Column(db.DateTime, 
                         default=datetime.now,
                         onupdate=datetime.now)
-    state = db.Column(db.String(80))
+    state = db.Column(db.String(80), index=True)
 
     STATES = ('ready', 'downloading')
 
@@ -49,18 +138,20 @@ class Package(db.Model):
         self.description = kw.get('description', '')
         self.name = kw.get('name', self.ecp_uuid)
         self.storage = kw.get('storage', 0)
-        try:
-            self.nova_id = kw['nova_id']
-        except KeyError, e:
-            raise RuntimeError(
-                "%s must be provided for %s constructor" % (
-                    str(e), self.__class__))
         state = kw.get('state', 'ready')
         if state not in self.STATES:
-            raise RunimeError(
+            raise RuntimeError(
                 "Profile state should be in %s not %s" % (
                     str(self.STATES), state))
         self.state = state
+        try:
+            self.nova_id = kw['nova_id']
+        except KeyError, e:
+            if state == 'ready':
+                raise RuntimeError(
+                    "%s must be provided for %s constructor" % (
+                        str(e), self.__class__))
+            self.nova_id = None
 
     def to_dict(self):
         "Return dict for SpotCloud API"
@@ -71,6 +162,51 @@ class Package(db.Model):
             os=self.os,
             description=self.description)
 
+    @classmethod
+    def claim(cls, ecp_uuid, ttl):
+        """Take the right to download and convert package.
+        Insert of 'downloading' row is atomic, so only one
+        caller gets True. A claim not touched for ttl seconds
+        is considered abandoned and could be taken over.
+
+        """
+        now = datetime.now()
+        try:
+            # plain INSERT, the session may already hold
+            # the row loaded by the caller
+            db.session.execute(cls.__table__.insert().values(
+                    ecp_uuid=ecp_uuid, name=ecp_uuid, os='unknown',
+                    description='', storage=0, state='downloading',
+                    updated=now))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+        count = cls.query.filter(
+            cls.ecp_uuid == ecp_uuid,
+            cls.state == 'downloading',
+            cls.updated < now - timedelta(seconds=ttl)
+            ).update({'updated': now}, synchronize_session=False)
+        db.session.commit()
+        return count == 1
+
+    @classmethod
+    def touch(cls, ecp_uuid):
+        "Show that claim is still alive"
+        cls.query.filter_by(
+            ecp_uuid=ecp_uuid, state='downloading'
+            ).update({'updated': datetime.now()},
+                     synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def release(cls, ecp_uuid):
+        "Give up claim, so package could be converted again"
+        cls.query.filter_by(
+            ecp_uuid=ecp_uuid, state='downloading'
+            ).delete(synchronize_session=False)
+        db.session.commit()
+
                    
 class HardwareTemplate(db.Model):
     "Model from SpotCloud domain with nova_id field"
@@ -81,7 +217,10 @@ class HardwareTemplate(db.Model):
     cpus = db.Column(db.Integer, nullable=False)
     arch = db.Column(db.String(12))
     memory = db.Column(db.Integer, nullable=False)
+    # Nova type removed, row is kept for VMs using it
+    retired = db.Column(db.Boolean, default=False)
 
+    ARCHS = ('i386', 'x86_64')
 
     def __init__(self, **kw):
         self.ecp_uuid = kw.get('ecp_uuid', str(uuid.uuid1()))
@@ -110,24 +249,70 @@ class HardwareTemplate(db.Model):
             hypervisor_name=self.hypervisor_name)
 
 
+    @classmethod
+    def listed(cls):
+        "Return query of templates offered to SpotCloud"
+        # NULL in rows of databases upgraded by upgrade_db
+        return cls.query.filter(db.or_(cls.retired == None,
+                                       cls.retired == False))
+
     @classmethod
     def sync_with_nova(cls):
-        """Delete any existed data and create 2 
-        instances for each Nova's instance type 
-        i386 and x86_64
+        """Make 2 templates, i386 and x86_64, for each Nova instance
+        type in one transaction. Existing ones are updated in place,
+        so their uuids known to SpotCloud stay. Templates of removed
+        types are deleted, or retired if VMs use them. Return summary
+        dict with numbers of added, updated, deleted, retired
+        and unchanged rows
 
         """
-        cls.query.delete()
+        wanted = {}
         for nova_id, memory, cpus in get_instance_types():
-            for arch in ['i386', 'x86_64']:
-                name = "%s.%s" % (nova_id, arch)
-                obj = cls(nova_id=nova_id,
-                          name=name,
-                          memory=memory,
-                          cpus=cpus,
-                          arch=arch)
-                db.session.add(obj)
-                db.session.commit()
+            for arch in cls.ARCHS:
+                wanted["%s.%s" % (nova_id, arch)] = dict(
+                    nova_id=nova_id, memory=int(memory), cpus=int(cpus),
+                    arch=arch)
+        if not wanted:
+            # most likely Nova is broken, not all types removed
+            raise RuntimeError("Nova returned no instance types")
+        templates = cls.query.all()
+        removed = [x.ecp_uuid for x in templates if x.name not in wanted]
+        used = set()
+        if removed:
+            used = set(x for x, in db.session.query(VM.hardware_uuid).filter(
+                    VM.hardware_uuid.in_(removed)).distinct())
+        added = updated = deleted = retired = unchanged = 0
+        try:
+            for template in templates:
+                fields = wanted.pop(template.name, None)
+                if fields is None:
+                    if template.ecp_uuid not in used:
+                        db.session.delete(template)
+                        deleted += 1
+                    elif not template.retired:
+                        template.retired = True
+                        retired += 1
+                    else:
+                        unchanged += 1
+                    continue
+                # type came back to Nova
+                fields['retired'] = False
+                if any(getattr(template, key) != value
+                       for key, value in fields.items()):
+                    for key, value in fields.items():
+                        setattr(template, key, value)
+                    updated += 1
+                else:
+                    unchanged += 1
+            for name, fields in sorted(wanted.items()):
+                db.session.add(cls(name=name, **fields))
+                added += 1
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        return dict(added=added, updated=updated, deleted=deleted,
+                    retired=retired, unchanged=unchanged)
 
 
 class VM(db.Model):
@@ -136,10 +321,10 @@ class VM(db.Model):
     state = db.Column(db.String(80))
     ip_address = db.Column(db.String(80), default='127.0.0.1')
     hardware_uuid = db.Column(db.String(36), db.ForeignKey(
-            'hardware_template.ecp_uuid'))
+            'hardware_template.ecp_uuid'), index=True)
     hardware = db.relationship('HardwareTemplate')
     package_uuid = db.Column(db.String(36), db.ForeignKey(
-            'package.ecp_uuid'))
+            'package.ecp_uuid'), index=True)
     package = db.relationship('Package')
                               
     STATES = ('scheduling', 'launching', 'running')
@@ -177,24 +362,55 @@ class VM(db.Model):
             
     @classmethod
     def sync_with_nova(cls):
-        "Sync VM states from Nova with db"
+        """Sync VM states from Nova with db in one transaction.
+        Return summary dict with numbers of deleted, updated
+        and unchanged rows and time spent
+
+        """
+        started = time.time()
+        # rows first: a VM committed by instance_created while Nova
+        # is described is not in rows, instead of missing in Nova
+        rows = db.session.query(
+            cls.ecp_uuid, cls.nova_id, cls.state, cls.ip_address).all()
         nova_instances = get_instances_dict()
-        for vm in cls.query.all():
-            if vm.nova_id not in nova_instances:
-                db.session.delete(vm)
-                db.session.commit()
-                continue
-            nova_instance = nova_instances[vm.nova_id]
-            updated = False
-            if vm.ip_address != nova_instance.dns_name:
-                vm.ip_address = nova_instance.dns_name
-                updated = True
-            if vm.state != nova_instance.state:
-                vm.state = nova_instance.state
-                updated = True
+        deleted = []
+        updated = []
+        for ecp_uuid, nova_id, state, ip_address in rows:
+            nova_instance = nova_instances.get(nova_id)
+            if nova_instance is None:
+                deleted.append(ecp_uuid)
+            elif state != nova_instance.state or \
+                    ip_address != nova_instance.dns_name:
+                updated.append(
+                    {'_ecp_uuid': ecp_uuid,
+                     'state': nova_instance.state,
+                     'ip_address': nova_instance.dns_name})
+        try:
+            for i in range(0, len(deleted), SQL_CHUNK):
+                cls.query.filter(
+                    cls.ecp_uuid.in_(deleted[i:i+SQL_CHUNK])
+                    ).delete(synchronize_session=False)
             if updated:
-                db.session.add(vm)
-                db.session.commit()
+                table = cls.__table__
+                db.session.execute(
+                    table.update().where(
+                        table.c.ecp_uuid == db.bindparam('_ecp_uuid')
+                        ).values(
+                        state=db.bindparam('state'),
+                        ip_address=db.bindparam('ip_address')),
+                    updated)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        if deleted or updated:
+            db.session.expire_all()
+        return dict(
+            deleted=len(deleted),
+            updated=len(updated),
+            unchanged=len(rows) - len(deleted) - len(updated),
+            nova_instances=len(nova_instances),
+            seconds=round(time.time() - started, 3))
 
 
 def init_db(uri=None):
@@ -210,5 +426,33 @@ def init_db(uri=None):
     db.create_all()
     HardwareTemplate.sync_with_nova()    
 
+
+def upgrade_db(engine=None):
+    """Create missing tables, add missing columns and indexes
+    to existing ones, data is kept. Return list of added
+    table.column and index names
+
+    """
+    engine = engine or db.engine
+    db.metadata.create_all(bind=engine)
+    inspector = Inspector.from_engine(engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = set(x['name'] for x in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name,
+                    column.type.compile(engine.dialect)))
+            added.append('%s.%s' % (table.name, column.name))
+        existing = set(x['name'] for x in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            index.create(bind=engine)
+            added.append(index.name)
+    return added
+
     
 
@@ -1,39 +1,204 @@
 """
 Interact with Nova system
-via EC2 API and command line tools
+via EC2 and Admin API
 
 """
 
-from subprocess import Popen, PIPE
+import os
+import time
+from threading import Lock
+from contextlib import contextmanager
+
+import boto
+from boto.ec2.regioninfo import RegionInfo
 
 from spotcloudopenstack.client import NovaAdminClient
 from spotcloudopenstack.app import app
+from spotcloudopenstack.metrics import TimedProxy
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+CREDENTIALS_TTL = 15*60 #sec
+INSTANCE_TYPES_TTL = 5*60 #sec
+POOL_SIZE = 8
+
+
+class NovaConnectionManager(object):
+    """Process wide holder of the Admin API client,
+    the resolved user credentials and a pool of
+    keep-alive EC2 connections.
+
+    DescribeUser is called once per NOVA_CREDENTIALS_TTL,
+    not once per request, DescribeInstanceTypes once per
+    NOVA_INSTANCE_TYPES_TTL.
+    """
+    def __init__(self, config):
+        self.config = config
+        self._lock = Lock()
+        self._refresh_lock = Lock()
+        self._pid = os.getpid()
+        self._admin = None
+        self._credentials = None
+        self._credentials_expire = 0
+        self._instance_types = None
+        self._instance_types_expire = 0
+        self._idle = []
+
+    def _make_admin_client(self):
+        "Build Admin API client from config"
+        return TimedProxy(NovaAdminClient(
+            clc_url = self.config['NOVA_ENDPOINT'],
+            region = self.config['NOVA_REGION'],
+            access_key = self.config['NOVA_ACCESS_KEY'],
+            secret_key = self.config['NOVA_SECRET_KEY']), 'admin')
+
+    def _make_connection(self, credentials):
+        "Build EC2 connection signed with credentials"
+        admin = self.admin_client()
+        parts = admin.split_clc_url(admin.clc_url)
+        access_key, secret_key = credentials
+        conn = boto.connect_ec2(aws_access_key_id=access_key,
+                                aws_secret_access_key=secret_key,
+                                is_secure=parts['is_secure'],
+                                region=RegionInfo(None,
+                                                  admin.region,
+                                                  parts['ip']),
+                                port=parts['port'],
+                                path='/services/Cloud')
+        return TimedProxy(conn, 'ec2')
+
+    def _check_pid(self):
+        "Drop everything inherited from parent process after fork"
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._admin = None
+            self._idle = []
+
+    def admin_client(self):
+        "Return shared NovaAdminClient"
+        with self._lock:
+            self._check_pid()
+            if self._admin is None:
+                self._admin = self._make_admin_client()
+            return self._admin
+
+    def credentials(self):
+        """Return (access_key, secret_key) tuple for
+        USERNAME and PROJECT_NAME, cached with TTL
+
+        """
+        with self._lock:
+            if self._credentials and \
+                    time.time() < self._credentials_expire:
+                return self._credentials
+        with self._refresh_lock:
+            with self._lock:
+                if self._credentials and \
+                        time.time() < self._credentials_expire:
+                    return self._credentials
+            username = self.config['USERNAME']
+            logger.debug('resolving nova credentials for %s', username)
+            user = self.admin_client().get_user(username)
+            if user is None:
+                raise RuntimeError(
+                    "Nova user %s does not exist" % username)
+            credentials = (
+                '%s:%s' % (user.accesskey, self.config['PROJECT_NAME']),
+                user.secretkey)
+            with self._lock:
+                if credentials != self._credentials:
+                    self._idle = []
+                self._credentials = credentials
+                self._credentials_expire = time.time() + self.config.get(
+                    'NOVA_CREDENTIALS_TTL', CREDENTIALS_TTL)
+            return credentials
+
+    def instance_types(self):
+        "Return list of InstanceType from Admin API, cached with TTL"
+        with self._lock:
+            if self._instance_types is not None and \
+                    time.time() < self._instance_types_expire:
+                return self._instance_types
+        with self._refresh_lock:
+            with self._lock:
+                if self._instance_types is not None and \
+                        time.time() < self._instance_types_expire:
+                    return self._instance_types
+            instance_types = self.admin_client().get_instance_types()
+            with self._lock:
+                self._instance_types = instance_types
+                self._instance_types_expire = time.time() + \
+                    self.config.get('NOVA_INSTANCE_TYPES_TTL',
+                                    INSTANCE_TYPES_TTL)
+            return instance_types
+
+    def new_connection(self):
+        "Return a new not pooled EC2 connection"
+        return self._make_connection(self.credentials())
+
+    def acquire(self):
+        "Take idle connection from the pool or make a new one"
+        credentials = self.credentials()
+        with self._lock:
+            self._check_pid()
+            while self._idle:
+                idle_credentials, conn = self._idle.pop()
+                if idle_credentials == credentials:
+                    return credentials, conn
+        return credentials, self._make_connection(credentials)
+
+    def release(self, credentials, conn):
+        "Put connection back to the pool if there is a room for it"
+        with self._lock:
+            if credentials == self._credentials and \
+                    len(self._idle) < self.config.get(
+                    'NOVA_POOL_SIZE', POOL_SIZE):
+                self._idle.append((credentials, conn))
+
+    @contextmanager
+    def connection(self):
+        """Checkout EC2 connection for the with block.
+        A connection that raised is not returned to the pool
+        since the state of its HTTP socket is unknown.
+
+        """
+        credentials, conn = self.acquire()
+        yield conn
+        self.release(credentials, conn)
+
+
+_manager = None
+_manager_lock = Lock()
+
+
+def get_connection_manager():
+    "Return process wide NovaConnectionManager"
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = NovaConnectionManager(app.config)
+        return _manager
+
+
+def nova_connection():
+    """Return context manager with pooled EC2 connection:
+
+        with nova_connection() as conn:
+            conn.get_all_instances()
+
+    """
+    return get_connection_manager().connection()
+
 
 def get_nova_connection():
-    """Return Admin Client connection to communicate with
-    Nova via HTTP API
+    """Return EC2 connection to communicate with
+    Nova via HTTP API. It is not pooled, so prefer
+    nova_connection() for short calls
 
     """
-    nova = NovaAdminClient(
-        clc_url = app.config['NOVA_ENDPOINT'],
-        region = app.config['NOVA_REGION'],
-        access_key = app.config['NOVA_ACCESS_KEY'],
-        secret_key = app.config['NOVA_SECRET_KEY'])
-
-    return nova.connection_for(app.config['USERNAME'], 
-                               app.config['PROJECT_NAME'])
-
-    
-def nova_manage(*args):
-    "Run nova-manage command and return output"
-    cmd = list(args)
-    cmd.insert(0, app.config['NOVA_MANAGE'])
-    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr =  proc.communicate()
-    if stderr:
-        raise RuntimeError(
-            "Could not run nova manage with %s" % str(args))
-    return stdout
+    return get_connection_manager().new_connection()
 
 
 def get_instances_dict():
@@ -41,8 +206,9 @@ def get_instances_dict():
     key is nova_id, value is an instance
     """
     result = {}
-    conn = get_nova_connection()
-    for reservation in conn.get_all_instances():
+    with nova_connection() as conn:
+        reservations = conn.get_all_instances()
+    for reservation in reservations:
         for instance in reservation.instances:
             result[instance.id] = instance
     return result
@@ -50,30 +216,27 @@ def get_instances_dict():
 
 def get_instance_id(reservation_id):
     "Return instance id for first instance from reservation"
-    conn = get_nova_connection()
-    for reservation in conn.get_all_instances():
+    with nova_connection() as conn:
+        reservations = conn.get_all_instances()
+    for reservation in reservations:
         if reservation.id == reservation_id:
             for instance in reservation.instances:
                 return instance.id
     return None
 
 
+def get_credentials_zip(user, project):
+    """Return content of nova.zip with novarc and certificates
+    of user in project, like nova-manage project zipfile makes
+
+    """
+    return get_connection_manager().admin_client().get_zip(user, project)
+
+
 def get_instance_types():
     """Return a list of available intance types.
     Each insance type is a tuple (name, memory, vcpu)
 
     """
-    import re
-    result = []
-    output = nova_manage('instance_type', 'list')
-    lines = [x.strip() for x in output.split('\n') if x.strip()]
-    for line in lines:
-        try:
-            nova_name = re.search('^([^\:]+)', line).group(1)
-            memory = re.search('Memory:\s+(\d+)', line).group(1)
-            cpus = re.search('VCPUS:\s+(\d+)', line).group(1)
-        except (AttributeError, IndexError):
-            raise RuntimeError(
-                "Could not parse nova-manage output %s" % line)
-        result.append((nova_name, memory, cpus))
-    return result
+    return [(x.name, int(x.memory_mb), int(x.vcpus))
+            for x in get_connection_manager().instance_types()]
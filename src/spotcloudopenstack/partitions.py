@@ -0,0 +1,187 @@
+"""
+Read MBR and GPT partition tables of raw disk images
+without running any external tools
+
+"""
+
+import os
+import mmap
+import struct
+import uuid
+from collections import namedtuple
+
+
+SECTOR = 512
+HEAD_SECTORS = 34 # MBR, GPT header and 128 GPT entries
+
+MBR_SIGNATURE = '\x55\xaa'
+MBR_EXTENDED = (0x05, 0x0f, 0x85)
+MBR_GPT = 0xee
+MBR_LINUX = 0x83
+MBR_LINUX_TYPES = (MBR_LINUX, 0x93)
+
+GPT_SIGNATURE = 'EFI PART'
+GPT_LINUX = '0fc63daf-8483-4772-8e79-3d69d8477de4'
+GPT_ROOT_TYPES = ('44479540-f297-41b2-9af7-d131d5f0458a', # x86
+                  '4f68bce3-e8cd-4db1-96e7-fbcaf984b709') # x86_64
+GPT_BOOT = 'bc13c2ff-59e6-4262-a352-b275fd6f7172'
+GPT_LINUX_TYPES = (GPT_LINUX, GPT_BOOT) + GPT_ROOT_TYPES
+GPT_LEGACY_BOOTABLE = 1 << 2
+
+EXT_MAGIC_OFFSET = 1024 + 56
+EXT_MAGIC = '\x53\xef'
+
+# start and size are in bytes,
+# type is int for MBR and GUID string for GPT,
+# scheme is one of 'mbr', 'gpt' or 'none' for not partitioned disk
+Partition = namedtuple(
+    'Partition', 'number start size type bootable scheme')
+
+
+def _read_at(file_, offset, size):
+    file_.seek(offset)
+    return file_.read(size)
+
+
+def _mbr_entries(sector):
+    "Yield (bootable, type, first lba, sectors) for 4 MBR entries"
+    for i in range(4):
+        entry = sector[446 + 16*i:446 + 16*(i+1)]
+        status, ptype = ord(entry[0]), ord(entry[4])
+        lba, sectors = struct.unpack('<II', entry[8:16])
+        if ptype and sectors:
+            yield status == 0x80, ptype, lba, sectors
+
+
+def _read_logical(file_, ext_lba):
+    "Follow EBR chain of extended partition"
+    result = []
+    ebr_lba = ext_lba
+    seen = set()
+    while ebr_lba not in seen:
+        seen.add(ebr_lba)
+        ebr = _read_at(file_, ebr_lba * SECTOR, SECTOR)
+        if len(ebr) < SECTOR or ebr[510:512] != MBR_SIGNATURE:
+            break
+        entries = list(_mbr_entries(ebr))
+        if not entries:
+            break
+        bootable, ptype, lba, sectors = entries[0]
+        result.append(Partition(
+                5 + len(result), (ebr_lba + lba) * SECTOR,
+                sectors * SECTOR, ptype, bootable, 'mbr'))
+        if len(entries) < 2 or entries[1][1] not in MBR_EXTENDED:
+            break
+        ebr_lba = ext_lba + entries[1][2]
+    return result
+
+
+def _read_gpt(file_, head):
+    "Parse GPT header at LBA 1 and its partition entries"
+    header = head[SECTOR:2*SECTOR]
+    if header[:8] != GPT_SIGNATURE:
+        raise RuntimeError("Protective MBR found but no GPT header")
+    entries_lba, count, entry_size = struct.unpack(
+        '<QII', header[72:88])
+    start = entries_lba * SECTOR
+    length = count * entry_size
+    if start + length <= len(head):
+        table = head[start:start + length]
+    else:
+        table = _read_at(file_, start, length)
+    result = []
+    for i in range(count):
+        entry = table[i*entry_size:(i+1)*entry_size]
+        if len(entry) < 56 or entry[:16] == '\0' * 16:
+            continue
+        ptype = str(uuid.UUID(bytes_le=entry[:16]))
+        first, last, attrs = struct.unpack('<QQQ', entry[32:56])
+        result.append(Partition(
+                i + 1, first * SECTOR, (last - first + 1) * SECTOR,
+                ptype, bool(attrs & GPT_LEGACY_BOOTABLE), 'gpt'))
+    return result
+
+
+def read_partitions(path):
+    """Return list of Partitions of raw disk image.
+    Only the first sectors of the image are mapped to memory,
+    EBRs of extended partition are read on demand.
+    Not partitioned disk with ext file system gives one
+    partition with number 0
+
+    """
+    file_ = open(path, 'rb')
+    try:
+        disk_size = os.fstat(file_.fileno()).st_size
+        if disk_size < 2 * SECTOR:
+            raise RuntimeError(
+                "%s is too small for disk image" % path)
+        head = mmap.mmap(file_.fileno(),
+                         min(disk_size, HEAD_SECTORS * SECTOR),
+                         access=mmap.ACCESS_READ)
+        try:
+            entries = []
+            if head[510:512] == MBR_SIGNATURE:
+                entries = [x for x in _mbr_entries(head[:SECTOR])
+                           if x[2] * SECTOR < disk_size]
+            if not entries:
+                if head[EXT_MAGIC_OFFSET:EXT_MAGIC_OFFSET+2] == EXT_MAGIC:
+                    return [Partition(
+                            0, 0, disk_size, MBR_LINUX, True, 'none')]
+                raise RuntimeError(
+                    "Could not find partition table in %s" % path)
+            if [x for x in entries if x[1] == MBR_GPT]:
+                return _read_gpt(file_, head)
+            result = []
+            for number, (bootable, ptype, lba, sectors) in enumerate(
+                entries):
+                if ptype in MBR_EXTENDED:
+                    result.extend(_read_logical(file_, lba))
+                else:
+                    result.append(Partition(
+                            number + 1, lba * SECTOR, sectors * SECTOR,
+                            ptype, bootable, 'mbr'))
+            return sorted(result, key=lambda x: x.number)
+        finally:
+            head.close()
+    finally:
+        file_.close()
+
+
+def is_linux(partition):
+    "True if partition could hold Linux file system"
+    return partition.type in MBR_LINUX_TYPES + GPT_LINUX_TYPES
+
+
+def find_root(partitions):
+    """Return partition with root file system:
+    GPT root type if any, otherwise the largest
+    Linux partition
+
+    """
+    roots = [x for x in partitions if x.type in GPT_ROOT_TYPES]
+    if not roots:
+        roots = [x for x in partitions
+                 if is_linux(x) and x.type != GPT_BOOT]
+    if not roots:
+        raise RuntimeError(
+            "Could not find Linux partition in %s" % (partitions,))
+    return max(roots, key=lambda x: x.size)
+
+
+def find_boot(partitions, root=None):
+    """Return partition holding kernel and initrd:
+    GPT boot loader partition, bootable Linux partition
+    other than root or root itself
+
+    """
+    if root is None:
+        root = find_root(partitions)
+    for partition in partitions:
+        if partition.type == GPT_BOOT:
+            return partition
+    for partition in partitions:
+        if partition.bootable and is_linux(partition) and \
+                partition != root and partition.size < root.size:
+            return partition
+    return root
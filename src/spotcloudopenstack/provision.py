@@ -4,18 +4,28 @@ If needed download a .XVM2 and convet it in Nova Image
 
 """
 
-from threading import Thread
+from threading import Event, Lock
 import time
 import os
-import urllib
-from subprocess import call, Popen, PIPE
-import tarfile
-import shutil
+import urllib2
+from subprocess import Popen, PIPE
+import posixpath
 import re
-from glob import glob
+import json
+import shutil
+import tempfile
+from datetime import datetime, timedelta
 
 from spotcloudopenstack.models import Package, HardwareTemplate, Task, VM
-from spotcloudopenstack.novaconn import get_nova_connection, get_instance_id
+from spotcloudopenstack.novaconn import nova_connection, get_instance_id
+from spotcloudopenstack.diskio import extract_disk, copy_range
+from spotcloudopenstack.download import Downloader, RangesNotSupported, \
+    WORKERS, CHUNK_SIZE
+from spotcloudopenstack.partitions import read_partitions, \
+    find_root, find_boot
+from spotcloudopenstack.extfs import ExtFS
+from spotcloudopenstack.scheduler import stage
+from spotcloudopenstack import metrics
 from spotcloudopenstack.app import app, db
 
 import logging
@@ -23,26 +33,75 @@ logger = logging.getLogger('spotcloudopenstack')
 
 
 DOWNLOAD_LIMIT = 30*60 #sec
+CLAIM_TTL = 60*60 #sec without touch before conversion is retried
+WAIT_POLL = 5 #sec
+SOCKET_TIMEOUT = 60 #sec
+DISK_FILE = 'disk.img'
+PACKAGE_FILE = 'package.xvm2'
+DOWNLOAD_SHARE = 50 # Task.completed when download is done
+MB = 1024.0*1024
+QEMU_IMG = 'qemu-img'
+QEMU_IMG_OFFSET_VERSION = (2, 9) # raw driver got offset and size
+
+
+_qemu_img_versions = {}
+
+
+def qemu_img_supports_offset(qemu_img):
+    "True if qemu-img is able to read raw image from offset"
+    if qemu_img not in _qemu_img_versions:
+        version = None
+        try:
+            proc = Popen([qemu_img, '--version'],
+                         stdout=PIPE, stderr=PIPE)
+            stdout, stderr = proc.communicate()
+            match = re.search('version (\d+)\.(\d+)', stdout)
+            if match:
+                version = (int(match.group(1)), int(match.group(2)))
+        except OSError:
+            pass
+        _qemu_img_versions[qemu_img] = version
+    version = _qemu_img_versions[qemu_img]
+    return version is not None and version >= QEMU_IMG_OFFSET_VERSION
+
+
+def _repo_dir():
+    return os.path.abspath(app.config['REPO_DIR'])
+
 
+def _natural_key(name):
+    "Sort key putting vmlinuz-2.6.32 after vmlinuz-2.6.9"
+    return [x.isdigit() and int(x) or x for x in re.split('(\d+)', name)]
 
-class ProvisionWorker(Thread):
+
+class ProvisionWorker(object):
     """If needed Download XVM2 file
     convert it to OpenStack image and publish it.
-    Create a VM
+    Create a VM.
+    It is a job run by scheduler, each step takes
+    a slot of its scheduler stage
     """
     def __init__(self, vm_uuid, task_uuid, hardware_uuid, package_uuid):
-        Thread.__init__(self)
         self.vm_uuid = vm_uuid
         self.task_uuid = task_uuid
         self.hardware_uuid = hardware_uuid
         self.package_uuid = package_uuid
-        self.nova_connection = get_nova_connection()
+        self.io_stats = {}
+        self.nova_id = None # instance launched by this attempt
+
+    def is_fast(self):
+        "True if package is ready and only run_instances is needed"
+        package = Package.query.get(self.package_uuid)
+        return package is not None and package.state == 'ready'
 
     def run(self):
         try:
             self._run()
         except Exception, e:
             logger.error(str(e))
+            # failed flush or commit leaves the session unusable
+            db.session.rollback()
+            self._terminate_launched()
             task = Task.query.get(self.task_uuid)
             vm = VM.query.get(self.vm_uuid)
             task.message = str(e)
@@ -61,17 +120,61 @@ class ProvisionWorker(Thread):
             raise RuntimeError(
                 "Could not get hardware %s" % self.vm.hardware_uuid)
 
+        nova_id = self._launched_instance()
+        if nova_id is not None:
+            logger.warning('Instance %s of task %s was launched '
+                           'by previous attempt', nova_id, self.task_uuid)
+            self.instance_created(nova_id)
+            return
+
         package = self.get_or_download_pkg(
             self.package_uuid, hardware.arch)
 
         logger.debug('Creating Instance from %s',  package.nova_id)
-        reservation = self.nova_connection.run_instances(
-            package.nova_id,
-            instance_type=hardware.nova_id,
-            addressing_type='private',
-            min_count=1,
-            max_count=1)
-        self.instance_created(get_instance_id(reservation.id))
+        with stage('nova'), metrics.stage('run_instances'), \
+                nova_connection() as conn:
+            reservation = conn.run_instances(
+                package.nova_id,
+                instance_type=hardware.nova_id,
+                addressing_type='private',
+                min_count=1,
+                max_count=1)
+        # committed before anything else could fail,
+        # so a retry finds the instance instead of launching one more
+        task = Task.query.get(self.task_uuid)
+        task.reservation_id = reservation.id
+        db.session.commit()
+        if reservation.instances:
+            nova_id = reservation.instances[0].id
+        else:
+            nova_id = get_instance_id(reservation.id)
+        self.nova_id = nova_id
+        self.instance_created(nova_id)
+
+
+    def _launched_instance(self):
+        """Return id of Nova instance launched by previous attempt
+        of the task, None if there was none or it is gone
+
+        """
+        task = Task.query.get(self.task_uuid)
+        if task is None or not task.reservation_id:
+            return None
+        return get_instance_id(task.reservation_id)
+
+
+    def _terminate_launched(self):
+        "Terminate instance launched before provision failed"
+        if self.nova_id is None:
+            return
+        try:
+            with nova_connection() as conn:
+                conn.terminate_instances([self.nova_id])
+            logger.info('Instance %s of failed task %s terminated',
+                        self.nova_id, self.task_uuid)
+        except Exception, e:
+            logger.error('Could not terminate instance %s: %s',
+                         self.nova_id, e)
 
 
     def instance_created(self, nova_id):
@@ -92,216 +195,266 @@ class ProvisionWorker(Thread):
         logger.debug('Provision OK')
 
 
-    def _download_pkg(self, pkg_uuid):
-        "Download package inside repo dir"
-        target_dir = os.path.join(
-            app.config['REPO_DIR'], pkg_uuid)
+    def _ingest_pkg(self, pkg_uuid, working_dir):
+        """Download package into repo dir and extract raw disk from it
+        into working_dir. Download is parallel and resumable
+        if the server supports Range, otherwise HTTP body
+        is streamed: tar -> gunzip -> raw disk.
+        Ranged download writes the whole package.xvm2 and reads it
+        back for extraction, one package-sized write more than
+        streaming, traded for resume and parallel chunks.
+        Return path of raw disk file
+
+        """
+        # kept between attempts, so download could be resumed
+        target_dir = os.path.join(_repo_dir(), pkg_uuid)
         if not os.path.exists(target_dir):
             os.mkdir(target_dir)
-        os.chdir(target_dir)
         url = app.config['PACKAGE_DOWNLOAD_URL_TMPL'] % pkg_uuid
+        disk_path = os.path.join(working_dir, DISK_FILE)
+        package_path = os.path.join(target_dir, PACKAGE_FILE)
+        downloader = Downloader(
+            url, package_path,
+            workers=app.config.get('DOWNLOAD_WORKERS', WORKERS),
+            chunk_size=app.config.get('DOWNLOAD_CHUNK_SIZE', CHUNK_SIZE),
+            timeout=SOCKET_TIMEOUT,
+            deadline=time.time() + DOWNLOAD_LIMIT)
         logger.debug('going to download %s', url)
-        file_, headers = urllib.urlretrieve(
-            url, 'package.xvm2')
-        logger.debug('download completed')
-        return target_dir, file_
-    
-
-    def _extract_disk(self, working_dir, file_name):
-        "Extract disk image, unzip it, return its name"
-        def get_disk_name(pkg_file):
-            "find and return disk file tar memeber"
-            for member in pkg_file.getmembers():
-                if member.name.endswith('.gz'):
-                    return member
-            raise RuntimeError(
-                "Could not find disk file in %s" % pkg_file.name)
-        pkg_file = tarfile.open(
-            os.path.join(working_dir, file_name))
-        disk_file = get_disk_name(pkg_file)
-        os.chdir(working_dir)
-        pkg_file.extract(disk_file)
-        logger.debug('unzipping disk')
-        if call(['gunzip', '-f', disk_file.name]):
-            raise RuntimeError(
-                "Could not gunzip %s" % disk_file.name)
-        logger.debug('done')
-        return disk_file.name[:-3]
-
-
-    def _get_offset(self, file_path):
-        "Calculate offset for mounting"
-        proc = Popen(['file', file_path], stdout=PIPE, stdin=PIPE)
-        stdout, stderr = proc.communicate()
-        if proc.returncode:
-            raise RuntimeError(
-                "Could not get info about %s, got: %s" % (
-                    file_path, stderr))
-        match = re.search('startsector\W(\d+)', stdout)
-        if match is None:
-            raise RuntimeError(
-                "Could not parse file info %s" % (
-                    stdout))
-        return int(match.group(1)) * 512
-
-        
-    def _mount_disk(self, working_dir, file_name):
-        "Mount first partition from disk file"
-        file_path = os.path.join(working_dir, file_name)
-        offset = self._get_offset(file_path)
-        mount_dir = os.path.join(working_dir, 'mnt')
-        if not os.path.exists(mount_dir):
-            os.mkdir(mount_dir)
-        if call(['sudo',
-                 'mount', 
-                 '-o', 
-                 'loop,offset=%s' % offset, 
-                 file_path,
-                 mount_dir]):
-            raise RuntimeError(
-                "Could not mount %s to %s with offset %s" % (
-                    file_path, mount_dir, offset))
-        return mount_dir
-
+        streamed = False
+        with stage('download'):
+            try:
+                downloader.probe()
+            except RangesNotSupported, e:
+                logger.info('%s, streaming it', e)
+                # network and gunzip could not be split here
+                streamed = True
+                with metrics.stage('extract') as record:
+                    src = urllib2.urlopen(url, timeout=SOCKET_TIMEOUT)
+                    try:
+                        member, checksum, stats = extract_disk(
+                            src, disk_path)
+                    finally:
+                        src.close()
+                    record.bytes = stats.logical
+            else:
+                with metrics.stage('download') as record:
+                    downloader.run(progress=self._download_progress)
+                    record.bytes = downloader.fetched
+                logger.info('%s downloaded at %.1f MB/s',
+                            url, downloader.rate() / MB)
+        if not streamed:
+            src = open(package_path, 'rb')
+            try:
+                with stage('convert'), \
+                        metrics.stage('extract') as record:
+                    member, checksum, stats = extract_disk(src, disk_path)
+                    record.bytes = stats.logical
+            finally:
+                src.close()
+        if os.path.exists(package_path):
+            os.unlink(package_path)
+        # needed only to resume download
+        try:
+            os.rmdir(target_dir)
+        except OSError, e:
+            logger.warning('Could not remove %s: %s', target_dir, e)
+        logger.info('%s extracted from %s, sha1 %s',
+                    member, url, checksum)
+        self._report_io('extract', stats)
+        return disk_path
+
+
+    def _download_progress(self, downloader):
+        "Report download progress and throughput to the Task"
+        Package.touch(self.package_uuid)
+        task = Task.query.get(self.task_uuid)
+        if task is None:
+            return
+        completed = downloader.completed()
+        task.completed = int(completed * DOWNLOAD_SHARE)
+        task.message = 'Downloading package: %d%% at %.1f MB/s' % (
+            completed * 100, downloader.rate() / MB)
+        db.session.add(task)
+        db.session.commit()
 
-    def _copy_initrd(self, working_dir, mount_dir, pkg_uuid):
-        "Copy initrd from mounted vm disk"
-        boot_dir = os.path.join(mount_dir, 'boot')
-        files = glob(os.path.join(boot_dir, 'initrd.*'))
-        if not files:
-            raise RuntimeError(
-                "Could not find initrd image in vm disk boot dir")
-        target_file_path = os.path.join(
-            working_dir,
-            "%s-initrd" % pkg_uuid)
-        shutil.copy(files[0], target_file_path)
-        return target_file_path
 
+    def _report_io(self, stage, stats):
+        "Keep and log logical and physical bytes written by stage"
+        self.io_stats[stage] = stats
+        logger.info('%s of %s: %s bytes written, %s of them physical',
+                    stage, self.package_uuid,
+                    stats.logical, stats.physical)
 
-    def _copy_vmlinuz(self, working_dir, mount_dir, pkg_uuid):
-        "Copy vmlinuz from mounted vm disk"
-        boot_dir = os.path.join(mount_dir, 'boot')
-        files = glob(os.path.join(boot_dir, 'vmlinuz*'))
-        if not files:
-            raise RuntimeError(
-                "Could not find vmlinuz image in vm disk boot dir")
-        target_file_path = os.path.join(
-            working_dir,
-            "%s-vmlinuz" % pkg_uuid)
-        shutil.copy(files[0], target_file_path)
-        return target_file_path
 
+    def _get_partitions(self, file_path):
+        "Return root and boot partitions of raw disk"
+        with metrics.stage('offset'):
+            partitions = read_partitions(file_path)
+            logger.debug('partitions of %s: %s', file_path, partitions)
+            root = find_root(partitions)
+            return root, find_boot(partitions, root)
 
-    def _get_loop_dev(self, working_dir):
-        "Return loop device name used for mount"
-        proc = Popen(['sudo', 'losetup', '-a'],
-                     stdout=PIPE,
-                     stderr=PIPE)
-        stdout, stderr = proc.communicate()
-        if stderr:
-            raise RuntimeError(
-                "Could not get list of loop devices %s" % (
-                    stderr, ))
-        for line in stdout.split('\n'):
-            match = re.search('^/dev/loop(\d+):[^\(]+\(([^\)]+)\)', line)
-            if match:
-                loop_dev = "/dev/loop%s" % match.group(1)
-                dir_name = os.path.dirname(match.group(2))
-                if dir_name == working_dir:
-                    return loop_dev
-        raise RuntimeError(
-            "Could not find loop device for %s" % working_dir)
         
+    def _copy_boot_files(self, working_dir, disk_file_path, root, boot,
+                         pkg_uuid):
+        """Copy vmlinuz and initrd from boot partition
+        straight out of disk file, no mount needed.
+        Return paths of initrd and vmlinuz copies
 
-    def _copy_root_fs(self, working_dir, mount_dir):
-        "Put content of directory to raw img"
-        loop_dev = self._get_loop_dev(working_dir)
-        target_file_path = os.path.join(working_dir, 
-                                        'temp.img')
-        if call(['dd', 'if=%s' % loop_dev,
-                 'of=%s' % target_file_path,
-                 'bs=1024']):
-            raise RuntimeError(
-                "Could not copy from %s to %s" % (
-                    loop_dev, target_file_path))
-        return target_file_path
-
+        """
+        if boot == root:
+            mount_point, boot_dir = '/', '/boot'
+        else:
+            mount_point, boot_dir = '/boot', '/'
+        with metrics.stage('mount'):
+            fs = ExtFS(disk_file_path, boot.start, mount_point)
+        try:
+            kernels = sorted(fs.glob(boot_dir, 'vmlinuz*'),
+                             key=_natural_key)
+            if not kernels:
+                raise RuntimeError(
+                    "Could not find vmlinuz image in vm disk boot dir")
+            vmlinuz = kernels[-1]
+            initrds = sorted(fs.glob(boot_dir, 'initrd.*'),
+                             key=_natural_key)
+            if not initrds:
+                raise RuntimeError(
+                    "Could not find initrd image in vm disk boot dir")
+            # prefer initrd made for the chosen kernel version
+            version = vmlinuz[len('vmlinuz'):]
+            initrds = [x for x in initrds
+                       if version and x.endswith(version)] or initrds
+            result = []
+            with metrics.stage('kernel copy') as record:
+                for name, suffix in [(initrds[-1], 'initrd'),
+                                     (vmlinuz, 'vmlinuz')]:
+                    target_file_path = os.path.join(
+                        working_dir, "%s-%s" % (pkg_uuid, suffix))
+                    record.bytes += fs.copy(
+                        posixpath.join(boot_dir, name), target_file_path)
+                    logger.debug('%s copied to %s', name, target_file_path)
+                    result.append(target_file_path)
+            return result
+        finally:
+            fs.close()
+
+
+    def _convert_raw2qcow(self, working_dir, disk_file_path, root, pkg_uuid):
+        """Convert root partition of raw disk to qcow2.
+        qemu-img reads the partition in place if it supports
+        raw offset, otherwise the partition is copied out first
 
-    def _convert_raw2qcow(self, working_dir, src_file_path, pkg_uuid):
-        "Convert raw image to qcow2"
+        """
         target_file_path = os.path.join(working_dir, 
                                         "%s.img" % pkg_uuid)
-        if call(
-            ['qemu-img',
-             'convert',
-             '-f', 'raw',
-             src_file_path,
-             '-O', 'qcow2',
-             target_file_path]):
-            raise RuntimeError(
-                "Could not convert %s to qcow2" % (
-                    src_file_path,))
-        os.unlink(src_file_path)
+        qemu_img = app.config.get('QEMU_IMG', QEMU_IMG)
+        if qemu_img_supports_offset(qemu_img):
+            src = 'json:' + json.dumps(
+                {'driver': 'raw',
+                 'offset': root.start,
+                 'size': root.size,
+                 'file': {'driver': 'file',
+                          'filename': disk_file_path}})
+            cmd = [qemu_img, 'convert', src, '-O', 'qcow2',
+                   target_file_path]
+            root_fs = None
+        else:
+            root_fs = os.path.join(working_dir, 'root.img')
+            with metrics.stage('rootfs copy') as record:
+                stats = copy_range(
+                    disk_file_path, root.start, root.size, root_fs)
+                record.bytes = stats.logical
+            self._report_io('rootfs copy', stats)
+            cmd = [qemu_img, 'convert', '-f', 'raw', root_fs,
+                   '-O', 'qcow2', target_file_path]
+        try:
+            with metrics.stage('qcow2 convert') as record:
+                returncode, stdout, stderr = metrics.run(
+                    cmd, 'qcow2 convert')
+                if returncode:
+                    raise RuntimeError(
+                        "Could not convert %s to qcow2: %s" % (
+                            disk_file_path, stderr))
+                record.bytes = os.path.getsize(target_file_path)
+        finally:
+            if root_fs:
+                os.unlink(root_fs)
         return target_file_path
     
 
     def _download_and_convert_pkg(self, pkg_uuid, arch):
-        """Download .xvm2,
-        extract disk file from it,
+        """Stream .xvm2 and extract raw disk file from it,
         from this file extract vmlinuz and initrd and root file system,
         convert root file system to qcow2 image,
         create .tar.gz and publish it with uec tools
 
         """
-        working_dir, file_name = self._download_pkg(pkg_uuid)
-        disk_file_name = self._extract_disk(working_dir, file_name)
-        mount_dir = self._mount_disk(working_dir, disk_file_name)
-        initrd = self._copy_initrd(working_dir, mount_dir, pkg_uuid)
-        vmlinuz = self._copy_vmlinuz(working_dir, mount_dir, pkg_uuid)
-        root_fs = self._copy_root_fs(working_dir, mount_dir)
-        qcow_img = self._convert_raw2qcow(working_dir, root_fs, pkg_uuid)
-        if call(['sudo', 'umount', mount_dir]):
-            logger.warning("Could not umount %s" % mount_dir)
-        os.unlink(os.path.join(working_dir, disk_file_name))
-        image_nova_id = self._publish_image(
-            initrd, vmlinuz, qcow_img, pkg_uuid, arch)
+        # scratch dir of this conversion, all paths are absolute
+        # and the process cwd is never changed, so any number
+        # of packages could be converted at once
+        working_dir = tempfile.mkdtemp(
+            prefix='%s-' % pkg_uuid, dir=_repo_dir())
+        try:
+            disk_file_path = self._ingest_pkg(pkg_uuid, working_dir)
+            Package.touch(pkg_uuid)
+            with stage('convert'):
+                root, boot = self._get_partitions(disk_file_path)
+                initrd, vmlinuz = self._copy_boot_files(
+                    working_dir, disk_file_path, root, boot, pkg_uuid)
+                Package.touch(pkg_uuid)
+                qcow_img = self._convert_raw2qcow(
+                    working_dir, disk_file_path, root, pkg_uuid)
+            os.unlink(disk_file_path)
+            Package.touch(pkg_uuid)
+            with stage('publish'):
+                image_nova_id = self._publish_image(
+                    working_dir, initrd, vmlinuz, qcow_img, pkg_uuid, arch)
+        finally:
+            shutil.rmtree(working_dir, ignore_errors=True)
         
-        package = Package(ecp_uuid=pkg_uuid,
-                          nova_id=image_nova_id)
+        package = Package.query.get(pkg_uuid)
+        package.nova_id = image_nova_id
+        package.state = 'ready'
         db.session.add(package)
         db.session.commit()
         return package
 
 
-    def _publish_image(self, initrd, vmlinuz, img, pkg_uuid, arch):
-        "Publish image with uec tool"
-        tar_name = "%s.tar.gz" % pkg_uuid
-        logging.debug("making %s", tar_name)
-        if call(
-            ['tar', 'czvf',
-             tar_name,
-             os.path.basename(initrd), 
-             os.path.basename(vmlinuz), 
-             os.path.basename(img)]):
-            raise RuntimeError(
-                "could not make %s" % tar_name)
-        logger.debug('made %s', tar_name)
-        proc = Popen(
-            [app.config['PUBLISH_SCRIPT'],
-             tar_name,
-             pkg_uuid[:7],
-             arch], 
-            stdout=PIPE,
-            stderr=PIPE)
-        stdout, stderr = proc.communicate()
-        if proc.returncode:
-            raise RuntimeError(
-                "Could not publish image, %s" % (
-                    stderr,))
+    def _publish_image(self, working_dir, initrd, vmlinuz, img,
+                       pkg_uuid, arch):
+        "Make tar.gz of files in working_dir and publish it with uec tool"
+        tar_path = os.path.join(working_dir, "%s.tar.gz" % pkg_uuid)
+        logger.debug("making %s", tar_path)
+        with metrics.stage('tar') as record:
+            returncode, stdout, stderr = metrics.run(
+                ['tar', 'czf',
+                 tar_path,
+                 os.path.basename(initrd), 
+                 os.path.basename(vmlinuz), 
+                 os.path.basename(img)],
+                'tar',
+                cwd=working_dir)
+            if returncode:
+                raise RuntimeError(
+                    "could not make %s: %s" % (tar_path, stderr))
+            record.bytes = os.path.getsize(tar_path)
+        logger.debug('made %s', tar_path)
+        with metrics.stage('publish') as record:
+            returncode, stdout, stderr = metrics.run(
+                [app.config['PUBLISH_SCRIPT'],
+                 tar_path,
+                 pkg_uuid[:7],
+                 arch],
+                'publish',
+                cwd=working_dir)
+            if returncode:
+                raise RuntimeError(
+                    "Could not publish image, %s" % (
+                        stderr,))
+            record.bytes = os.path.getsize(tar_path)
         emi = stdout.strip().split('\n')[-1].split()[0]
         match = re.search('emi=\W([^\"]+)', emi)
         if match:
-            # TODO remove files that already in tar.gz
             return match.group(1)
         else:
             raise RuntimeError(
@@ -309,18 +462,73 @@ class ProvisionWorker(Thread):
 
 
     def get_or_download_pkg(self, pkg_uuid, arch):
-        """"Return package object if it is in database,
-        run _download_and_convert other way
+        """"Return package object if it is ready in database.
+        Otherwise claim the package and run _download_and_convert,
+        or wait for the worker which already claimed it.
+        Only one conversion runs for simultaneous requests
 
         """
-        package = Package.query.get(pkg_uuid)
-        if package is None:
-            return self._download_and_convert_pkg(pkg_uuid, arch)
-        started = time.time()
-        while package.state == 'downloading': # in another thread
-            if (time.time() - started) > DOWNLOAD_LIMIT:
+        ttl = app.config.get('PACKAGE_CLAIM_TTL', CLAIM_TTL)
+        # measured from the last touch of the claim, not from the
+        # start of this wait: a claim of crashed converter is taken
+        # over after ttl, whenever the waiter or retry started
+        limit = timedelta(seconds=ttl + DOWNLOAD_LIMIT)
+        while True:
+            flight = _get_flight(pkg_uuid)
+            package = Package.query.populate_existing().get(pkg_uuid)
+            if package is not None and package.state == 'ready':
+                return package
+            if Package.claim(pkg_uuid, ttl):
+                return self._convert_claimed(flight, pkg_uuid, arch)
+            if package is not None and package.updated is not None and \
+                    datetime.now() - package.updated > limit:
                 raise RuntimeError(
                     "Time limit for package download is reached.")
-            time.sleep(5)
-            db.session.refresh(package)
+            # converter of this process wakes us up at once,
+            # one of other process is polled
+            flight.event.wait(WAIT_POLL)
+            if flight.error:
+                raise RuntimeError(
+                    "Conversion of package %s failed: %s" % (
+                        pkg_uuid, flight.error))
+
+
+    def _convert_claimed(self, flight, pkg_uuid, arch):
+        "Convert package, then wake up waiting workers"
+        try:
+            package = self._download_and_convert_pkg(pkg_uuid, arch)
+        except Exception, e:
+            db.session.rollback()
+            Package.release(pkg_uuid)
+            _land_flight(pkg_uuid, str(e))
+            raise
+        _land_flight(pkg_uuid)
         return package
+
+
+class _Flight(object):
+    "In-process notification about package conversion"
+    def __init__(self):
+        self.event = Event()
+        self.error = None
+
+
+_flights = {}
+_flights_lock = Lock()
+
+
+def _get_flight(pkg_uuid):
+    "Return flight waiters of pkg_uuid share"
+    with _flights_lock:
+        if pkg_uuid not in _flights:
+            _flights[pkg_uuid] = _Flight()
+        return _flights[pkg_uuid]
+
+
+def _land_flight(pkg_uuid, error=None):
+    "Wake up all waiters of pkg_uuid"
+    with _flights_lock:
+        flight = _flights.pop(pkg_uuid, None)
+    if flight is not None:
+        flight.error = error
+        flight.event.set()
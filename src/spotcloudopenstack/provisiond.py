@@ -0,0 +1,198 @@
+"""
+Run provisioning daemon.
+Pending Tasks are leased from database and run by own
+scheduler, so provisions survive restarts of uwsgi workers.
+Set PROVISION_MODE = "daemon" for API processes to only
+queue Tasks
+
+"""
+
+import os
+import socket
+import signal
+from datetime import datetime, timedelta
+from threading import Thread, Event, Lock
+
+from spotcloudopenstack.app import app, db
+from spotcloudopenstack.models import Task, upgrade_db
+from spotcloudopenstack.retention import get_retention
+from spotcloudopenstack.provision import ProvisionWorker
+from spotcloudopenstack.scheduler import get_scheduler
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+POLL_INTERVAL = 2 #sec
+LEASE = 5*60 #sec, renewed every poll while task runs
+MAX_ATTEMPTS = 3
+
+
+def _owner():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+class LeasedJob(object):
+    """Run ProvisionWorker and give up lease of its Task,
+    holder is ProvisionDaemon or LeaseKeeper
+
+    """
+    def __init__(self, daemon, worker):
+        self.daemon = daemon
+        self.worker = worker
+
+    def run(self):
+        try:
+            self.worker.run()
+        finally:
+            Task.release_lease(self.worker.task_uuid, self.daemon.owner)
+            self.daemon.finished(self.worker.task_uuid)
+
+
+class ProvisionDaemon(object):
+    """Lease pending Tasks while scheduler has free workers.
+    Leases of running Tasks are renewed every poll,
+    so Tasks of crashed daemon are retried after lease expires
+
+    """
+    worker_class = ProvisionWorker
+
+    def __init__(self, scheduler, poll_interval=POLL_INTERVAL,
+                 lease=LEASE, max_attempts=MAX_ATTEMPTS):
+        self.scheduler = scheduler
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.owner = _owner()
+        self.capacity = sum(scheduler.workers.values())
+        self._running = set()
+        self._lock = Lock()
+        self._stop = Event()
+
+    def finished(self, task_uuid):
+        with self._lock:
+            self._running.discard(task_uuid)
+
+    def poll(self):
+        "Renew leases, claim and queue new Tasks. Return number queued"
+        with self._lock:
+            running = list(self._running)
+        if running:
+            Task.renew_leases(self.owner, running, self.lease)
+        free = self.capacity - len(running)
+        if free <= 0:
+            return 0
+        tasks = Task.claim_pending(
+            self.owner, self.lease, free, self.max_attempts)
+        for task in tasks:
+            if task.attempts > 1:
+                logger.warning("Retrying task %s, attempt %s",
+                               task.ecp_uuid, task.attempts)
+            worker = self.worker_class(
+                task.vm_uuid, task.ecp_uuid,
+                task.hardware_uuid, task.package_uuid)
+            with self._lock:
+                self._running.add(task.ecp_uuid)
+            self.scheduler.submit(LeasedJob(self, worker),
+                                  fast=worker.is_fast())
+        return len(tasks)
+
+    def run(self):
+        logger.info("Provisioning daemon %s started", self.owner)
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception, e:
+                db.session.rollback()
+                logger.exception("Could not poll tasks: %s", e)
+            self._stop.wait(self.poll_interval)
+        logger.info("Provisioning daemon %s waits for running tasks",
+                    self.owner)
+        self.scheduler.stop()
+        logger.info("Provisioning daemon %s stopped", self.owner)
+
+    def stop(self, *args):
+        self._stop.set()
+
+
+class LeaseKeeper(Thread):
+    """Renew leases of Tasks run in API process, PROVISION_MODE
+    "inprocess". Tasks lost with a recycled uwsgi worker expire
+    and are retried by provisioning daemon
+
+    """
+    def __init__(self, lease=LEASE):
+        Thread.__init__(self, name='lease-keeper')
+        self.daemon = True
+        self.lease = lease
+        self.owner = 'api:%s' % _owner()
+        self._held = set()
+        self._lock = Lock()
+        self._stop = Event()
+
+    def hold(self, task):
+        "Lease new task to this process, it is committed by caller"
+        task.lease_owner = self.owner
+        task.lease_expires = datetime.now() + timedelta(seconds=self.lease)
+        task.attempts = 1
+        with self._lock:
+            self._held.add(task.ecp_uuid)
+
+    def finished(self, task_uuid):
+        with self._lock:
+            self._held.discard(task_uuid)
+
+    def run(self):
+        while not self._stop.wait(self.lease / 5.0):
+            with self._lock:
+                held = list(self._held)
+            if not held:
+                continue
+            try:
+                Task.renew_leases(self.owner, held, self.lease)
+            except Exception, e:
+                db.session.rollback()
+                logger.error("Could not renew leases: %s", e)
+        db.session.remove()
+
+    def stop(self):
+        self._stop.set()
+
+
+_keeper = None
+_keeper_lock = Lock()
+
+
+def get_lease_keeper():
+    """Return running LeaseKeeper of this process,
+    start it if needed (e.g. after uwsgi fork)
+
+    """
+    global _keeper
+    with _keeper_lock:
+        if _keeper is None or not _keeper.is_alive():
+            _keeper = LeaseKeeper(app.config.get('PROVISION_LEASE', LEASE))
+            _keeper.start()
+        return _keeper
+
+
+def main():
+    "Run provisioning daemon until SIGTERM or SIGINT"
+    added = upgrade_db()
+    if added:
+        logger.info("Columns and indexes added to database: %s",
+                    ', '.join(added))
+    # stages of ProvisionWorker use the same scheduler
+    daemon = ProvisionDaemon(
+        get_scheduler(),
+        app.config.get('PROVISION_POLL_INTERVAL', POLL_INTERVAL),
+        app.config.get('PROVISION_LEASE', LEASE),
+        app.config.get('PROVISION_MAX_ATTEMPTS', MAX_ATTEMPTS))
+    get_retention()
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
+
+
+if __name__ == '__main__':
+    main()
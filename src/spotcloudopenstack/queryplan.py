@@ -0,0 +1,136 @@
+"""
+Query plan audit for tests.
+Every statement issued from audited modules is explained
+with EXPLAIN QUERY PLAN on SQLite, full scans of large tables,
+by rows or by index, in filtered statements are violations
+
+    audit = QueryPlanAudit(db.engine).start()
+    ...
+    audit.stop()
+    assert not audit.violations, audit.report()
+
+"""
+
+import os
+import re
+import sys
+import sqlite3
+import weakref
+from threading import Lock
+
+from sqlalchemy import event
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+AUDITED_MODULES = ('api.py', 'provision.py', 'models.py')
+# tables growing with history, small catalogs are not here
+LARGE_TABLES = ('vm', 'task', 'package')
+
+_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+_FILTERED = re.compile(r'\bWHERE\b', re.I)
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 0.7 events cannot be removed from engines, so one listener is
+# installed per engine and dispatches to audits started on it
+_audits = weakref.WeakKeyDictionary() # engine -> list of audits
+_audits_lock = Lock()
+
+
+def _caller(modules):
+    "Return 'file:line' of the nearest frame in audited modules or None"
+    frame = sys._getframe(2)
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if os.path.basename(path) in modules and \
+                os.path.dirname(os.path.abspath(path)) == _PACKAGE_DIR:
+            return '%s:%s' % (os.path.basename(path), frame.f_lineno)
+        frame = frame.f_back
+    return None
+
+
+def _before_cursor_execute(conn, *args):
+    with _audits_lock:
+        audits = list(_audits.get(conn.engine, ()))
+    for audit in audits:
+        audit._explain(conn, *args)
+
+
+def full_scans(plan, tables=LARGE_TABLES):
+    """Return names of tables read whole, plan is list of detail
+    strings of EXPLAIN QUERY PLAN. Scan in index order is a full
+    scan too, only SEARCH reads part of a table
+
+    """
+    scanned = []
+    for detail in plan:
+        match = _SCAN.match(detail)
+        # VM table is named in upper case
+        if match and match.group(1).lower() in tables:
+            scanned.append(match.group(1).lower())
+    return scanned
+
+
+class QueryPlanAudit(object):
+    """Explain statements issued from modules on engine.
+    Statements without WHERE are listings and read every row
+    anyway, so they are not checked
+
+    """
+    def __init__(self, engine, modules=AUDITED_MODULES,
+                 tables=LARGE_TABLES):
+        self.engine = engine
+        self.modules = modules
+        self.tables = tables
+        self.statements = 0
+        self.violations = [] # (caller, statement, plan)
+        self._lock = Lock()
+
+    def start(self):
+        with _audits_lock:
+            if self.engine not in _audits:
+                _audits[self.engine] = []
+                event.listen(self.engine, 'before_cursor_execute',
+                             _before_cursor_execute)
+            if self not in _audits[self.engine]:
+                _audits[self.engine].append(self)
+        return self
+
+    def stop(self):
+        with _audits_lock:
+            audits = _audits.get(self.engine, [])
+            if self in audits:
+                audits.remove(self)
+
+    def _explain(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        if not _FILTERED.search(statement) or \
+                statement.lstrip().upper().startswith(
+                    ('EXPLAIN', 'PRAGMA', 'INSERT')):
+            return
+        caller = _caller(self.modules)
+        if caller is None:
+            return
+        if executemany:
+            parameters = parameters[0]
+        explain = conn.connection.cursor()
+        try:
+            explain.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            plan = [row[-1] for row in explain.fetchall()]
+        except sqlite3.Error, e:
+            logger.warning("Could not explain %s: %s", statement, e)
+            return
+        finally:
+            explain.close()
+        with self._lock:
+            self.statements += 1
+            if full_scans(plan, self.tables):
+                self.violations.append((caller, statement, plan))
+
+    def report(self):
+        "Return text describing violations"
+        return '\n'.join(
+            '%s full scan:\n  %s\n  plan: %s' % (
+                caller, ' '.join(statement.split()), '; '.join(plan))
+            for caller, statement, plan in self.violations)
@@ -0,0 +1,156 @@
+"""
+Background reconciliation of VM states with Nova.
+API calls are served from in-memory snapshot
+instead of DescribeInstances on every request
+
+"""
+
+import time
+from threading import Thread, Event, Lock, local, current_thread
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from spotcloudopenstack.app import app, db
+from spotcloudopenstack.models import VM
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+RECONCILE_INTERVAL = 30 #sec
+SNAPSHOT_MAX_AGE = 90 #sec
+
+
+class Reconciler(Thread):
+    """Sync VMs with Nova every interval seconds and keep
+    snapshot of VM dicts. Snapshot older than max_age
+    is refreshed inline by the reader, so staleness is bounded.
+
+    """
+    def __init__(self, interval=RECONCILE_INTERVAL,
+                 max_age=SNAPSHOT_MAX_AGE):
+        Thread.__init__(self, name='reconciler')
+        self.daemon = True
+        self.interval = interval
+        self.max_age = max_age
+        self._wakeup = Event()
+        self._lock = Lock()
+        self._vms = {}
+        self._synced = None
+        self._stopped = False
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped:
+                break
+            try:
+                with self._lock:
+                    self._refresh(self.age() >= self.interval)
+            except Exception, e:
+                logger.error("Could not refresh VM snapshot: %s", e)
+            finally:
+                db.session.remove()
+
+    def _sync_with_nova(self):
+        "Sync VM table with Nova"
+        summary = VM.sync_with_nova()
+        if summary['deleted'] or summary['updated']:
+            logger.info("VM sync: %s", summary)
+        else:
+            logger.debug("VM sync: %s", summary)
+
+    def _refresh(self, sync):
+        "Optionally sync with Nova, then rebuild snapshot from db"
+        if sync:
+            self._sync_with_nova()
+            self._synced = time.time()
+        self._vms = dict(
+            (vm.ecp_uuid, vm.to_dict()) for vm in VM.query.all())
+
+    def refresh(self, sync=True):
+        "Refresh snapshot in the calling thread"
+        with self._lock:
+            self._refresh(sync)
+
+    def stop(self):
+        "Ask thread to exit"
+        self._stopped = True
+        self._wakeup.set()
+
+    def notify(self):
+        "Rebuild snapshot from db as soon as possible"
+        self._wakeup.set()
+
+    def age(self):
+        "Seconds passed since last sync with Nova"
+        if self._synced is None:
+            return float('inf')
+        return time.time() - self._synced
+
+    def _ensure_fresh(self):
+        "Sync inline if background thread is late"
+        if self.age() <= self.max_age:
+            return
+        with self._lock:
+            if self.age() > self.max_age:
+                logger.warning(
+                    "VM snapshot is stale, syncing with Nova inline")
+                self._refresh(True)
+
+    def snapshot(self):
+        "Return list of VM dicts and snapshot age"
+        self._ensure_fresh()
+        return self._vms.values(), round(self.age(), 3)
+
+    def get(self, vm_uuid):
+        "Return VM dict or None and snapshot age"
+        self._ensure_fresh()
+        return self._vms.get(vm_uuid), round(self.age(), 3)
+
+
+_reconciler = None
+_reconciler_lock = Lock()
+
+
+def get_reconciler():
+    """Return running Reconciler of this process,
+    start it if needed (e.g. after uwsgi fork)
+
+    """
+    global _reconciler
+    with _reconciler_lock:
+        if _reconciler is None or not _reconciler.is_alive():
+            _reconciler = Reconciler(
+                app.config.get('RECONCILE_INTERVAL', RECONCILE_INTERVAL),
+                app.config.get('SNAPSHOT_MAX_AGE', SNAPSHOT_MAX_AGE))
+            _reconciler.start()
+        return _reconciler
+
+
+_pending = local()
+
+
+def _vm_changed(mapper, connection, target):
+    _pending.vm_changed = True
+
+
+def _after_commit(session):
+    if not getattr(_pending, 'vm_changed', False):
+        return
+    _pending.vm_changed = False
+    reconciler = _reconciler
+    if reconciler is not None and reconciler is not current_thread():
+        reconciler.notify()
+
+
+def _after_rollback(session):
+    _pending.vm_changed = False
+
+
+for _name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(VM, _name, _vm_changed)
+event.listen(Session, 'after_commit', _after_commit)
+event.listen(Session, 'after_rollback', _after_rollback)
@@ -0,0 +1,270 @@
+"""
+Retention of finished Tasks.
+Finished tasks older than the retention age, or beyond the newest
+retention count, and unfinished ones older than the age without
+VM row or lease, are archived to compressed JSON lines and
+deleted in small batches, then freed pages are vacuumed
+incrementally. Every batch is a short transaction, so API
+requests and provisions keep writing meanwhile.
+
+    $ python -m spotcloudopenstack.retention --once
+
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import fcntl
+import tempfile
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from threading import Thread, Event, Lock
+
+from spotcloudopenstack.app import app, db
+from spotcloudopenstack.models import Task, VM, SQL_CHUNK
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+RETENTION_INTERVAL = 60*60 #sec
+RETENTION_AGE = 30*24*60*60 #sec
+RETENTION_COUNT = 10000 # finished tasks kept
+RETENTION_PAUSE = 0.1 #sec between batches, lets writers in
+VACUUM_PAGES = 1000 # freed pages returned per batch
+
+
+class Retention(Thread):
+    """Sweep finished Tasks every interval seconds.
+    Sweeps of API processes and provisiond are serialized
+    by flock on a lock file, busy sweep is skipped
+
+    """
+    def __init__(self, interval=RETENTION_INTERVAL, age=RETENTION_AGE,
+                 count=RETENTION_COUNT, archive_dir=None,
+                 batch=SQL_CHUNK, pause=RETENTION_PAUSE):
+        Thread.__init__(self, name='retention')
+        self.daemon = True
+        self.interval = interval
+        self.age = age
+        self.count = count
+        self.archive_dir = archive_dir
+        self.batch = batch
+        self.pause = pause
+        self._wakeup = Event()
+        self._stopped = False
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped:
+                break
+            try:
+                self.sweep()
+            except Exception, e:
+                logger.error("Could not sweep tasks: %s", e)
+            finally:
+                db.session.remove()
+
+    def stop(self):
+        "Ask thread to exit"
+        self._stopped = True
+        self._wakeup.set()
+
+    def lock_path(self):
+        return os.path.join(self.archive_dir or tempfile.gettempdir(),
+                            'spotcloudopenstack-retention.lock')
+
+    def cutoff(self, now):
+        """Return datetime, finished tasks started before it go:
+        the later of age and start of the newest kept by count.
+        None if neither age nor count is set
+
+        """
+        cutoff = None
+        if self.age is not None:
+            cutoff = now - timedelta(seconds=self.age)
+        if self.count is not None:
+            row = db.session.query(Task.started).filter(
+                Task.completed >= 100).order_by(
+                Task.started.desc()).offset(self.count).limit(1).first()
+            if row is not None and row[0] is not None:
+                # the task at offset count is the first to go
+                kept = row[0] + timedelta(microseconds=1)
+                cutoff = cutoff and max(cutoff, kept) or kept
+        return cutoff
+
+    def sweep(self, now=None):
+        """Archive and delete finished tasks started before cutoff.
+        Return summary dict, None if another process sweeps
+        or no policy is set
+
+        """
+        lock = open(self.lock_path(), 'a')
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                logger.debug("Tasks are swept by another process")
+                return None
+            return self._sweep(now or datetime.now())
+        finally:
+            lock.close()
+
+    def abandoned(self, now):
+        """Return where clause of unfinished tasks older than
+        retention age, not leased and without VM row, e.g. of
+        deleted VM or lost provision. None if age is not set
+
+        """
+        if self.age is None:
+            return None
+        table = Task.__table__
+        vm = VM.__table__
+        return db.and_(
+            table.c.completed < 100,
+            table.c.started < now - timedelta(seconds=self.age),
+            db.or_(table.c.lease_expires == None,
+                   table.c.lease_expires < now),
+            ~db.exists([vm.c.ecp_uuid], vm.c.ecp_uuid == table.c.vm_uuid))
+
+    def _sweep(self, now):
+        started = time.time()
+        cutoff = self.cutoff(now)
+        db.session.commit()
+        table = Task.__table__
+        # (where clause, archive as failed)
+        sweeps = []
+        if cutoff is not None:
+            sweeps.append((db.and_(table.c.completed >= 100,
+                                   table.c.started < cutoff), False))
+        abandoned = self.abandoned(now)
+        if abandoned is not None:
+            sweeps.append((abandoned, True))
+        if not sweeps:
+            return None
+        archived = deleted = failed = vacuumed = batches = 0
+        for where, is_failed in sweeps:
+            while not self._stopped:
+                rows = db.session.execute(
+                    table.select().where(where).order_by(
+                        table.c.started).limit(self.batch)).fetchall()
+                if not rows:
+                    break
+                if self.archive_dir:
+                    # archived before delete, a crash in between
+                    # archives the batch again on the next sweep
+                    self.archive(rows, now, is_failed)
+                    archived += len(rows)
+                count = db.session.execute(table.delete().where(
+                        table.c.ecp_uuid.in_([x.ecp_uuid for x in rows]))
+                                           ).rowcount
+                deleted += count
+                if is_failed:
+                    failed += count
+                db.session.commit()
+                vacuumed += self.vacuum()
+                batches += 1
+                time.sleep(self.pause)
+        summary = dict(archived=archived, deleted=deleted,
+                       abandoned=failed,
+                       vacuumed_pages=vacuumed, batches=batches,
+                       cutoff=cutoff and cutoff.isoformat(),
+                       seconds=round(time.time() - started, 3))
+        if deleted:
+            logger.info("Tasks swept: %s", summary)
+        return summary
+
+    def archive(self, rows, now, failed=False):
+        """Append rows to gzipped JSON lines file of the day,
+        failed marks abandoned unfinished tasks as failed
+
+        """
+        path = os.path.join(self.archive_dir,
+                            now.strftime('tasks-%Y%m%d.jsonl.gz'))
+        f = open(path, 'ab')
+        try:
+            # every append is a gzip member, gunzip reads them all
+            gz = gzip.GzipFile(fileobj=f, mode='ab')
+            for row in rows:
+                record = dict(
+                    (key, isinstance(value, datetime) and
+                     value.isoformat() or value)
+                    for key, value in row.items())
+                if failed:
+                    record.update(
+                        is_error=True, completed=100,
+                        ended=now.isoformat(),
+                        message='Abandoned, VM is gone%s' % (
+                            record['message'] and
+                            ': %s' % record['message'] or ''))
+                gz.write(json.dumps(record) + '\n')
+            gz.close()
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+    def vacuum(self):
+        """Return freed pages of SQLite database to the file system,
+        only with incremental auto vacuum. Return number of pages
+
+        """
+        if db.engine.dialect.name != 'sqlite':
+            return 0
+        connection = db.engine.connect()
+        try:
+            if connection.execute('PRAGMA auto_vacuum').scalar() != 2:
+                return 0
+            free = connection.execute('PRAGMA freelist_count').scalar()
+            if free:
+                # pages are freed while the result is stepped through
+                connection.execute('PRAGMA incremental_vacuum(%d)' %
+                                   VACUUM_PAGES).fetchall()
+            return min(free, VACUUM_PAGES)
+        finally:
+            connection.close()
+
+
+_retention = None
+_retention_lock = Lock()
+
+
+def get_retention():
+    """Return running Retention of this process,
+    start it if needed (e.g. after uwsgi fork)
+
+    """
+    global _retention
+    with _retention_lock:
+        if _retention is None or not _retention.is_alive():
+            _retention = make_retention()
+            _retention.start()
+        return _retention
+
+
+def make_retention():
+    "Return Retention configured by app config"
+    return Retention(
+        app.config.get('TASK_RETENTION_INTERVAL', RETENTION_INTERVAL),
+        app.config.get('TASK_RETENTION_AGE', RETENTION_AGE),
+        app.config.get('TASK_RETENTION_COUNT', RETENTION_COUNT),
+        app.config.get('TASK_ARCHIVE_DIR'))
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage='%prog --once')
+    parser.add_option('--once', action='store_true',
+                      help='sweep tasks now and exit')
+    options, args = parser.parse_args(argv[1:])
+    if not options.once:
+        parser.error('only --once is supported, '
+                     'API and provisiond sweep in background')
+    print make_retention().sweep()
+
+
+if __name__ == '__main__':
+    main()
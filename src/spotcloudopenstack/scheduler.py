@@ -0,0 +1,199 @@
+"""
+Bounded provisioning scheduler.
+Jobs wait in a queue for a worker thread, each stage of a job
+(download, convert, publish, nova) has its own concurrency limit,
+so a burst of orders does not run everything at once.
+Jobs with a ready package use a separate fast lane
+and never wait behind conversions
+
+"""
+
+import time
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from threading import Thread, Lock, BoundedSemaphore
+from Queue import Queue
+
+from spotcloudopenstack.app import app, session_scope
+
+import logging
+logger = logging.getLogger('spotcloudopenstack')
+
+
+WORKERS = 8 # jobs which may need conversion
+FAST_WORKERS = 4 # jobs with ready package
+STAGE_LIMITS = {
+    'download': 4, # network
+    'convert': cpu_count(), # gunzip, partitions, qemu-img
+    'publish': 1, # tar and image upload
+    'nova': 4, # run_instances calls
+    }
+LANES = ('fast', 'slow')
+
+
+class WaitStats(object):
+    "Count and duration of waits"
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        return dict(
+            count=self.count,
+            wait_avg=round(self.total / max(self.count, 1), 3),
+            wait_max=round(self.max, 3))
+
+
+class Stage(object):
+    "Semaphore of one kind of work with wait statistics"
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.waiting = 0
+        self.active = 0
+        self.waits = WaitStats()
+        self._semaphore = BoundedSemaphore(limit)
+        self._lock = Lock()
+
+    @contextmanager
+    def slot(self):
+        "Run the block when the stage has a free slot"
+        started = time.time()
+        with self._lock:
+            self.waiting += 1
+        self._semaphore.acquire()
+        with self._lock:
+            self.waiting -= 1
+            self.active += 1
+            self.waits.add(time.time() - started)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+            self._semaphore.release()
+
+    def to_dict(self):
+        with self._lock:
+            result = self.waits.to_dict()
+            result.update(limit=self.limit,
+                          waiting=self.waiting,
+                          active=self.active)
+        return result
+
+
+class Scheduler(object):
+    """Run jobs, objects with run() method, by worker threads
+    of two lanes. Stages limit concurrency inside of the jobs
+
+    """
+    def __init__(self, workers=WORKERS, fast_workers=FAST_WORKERS,
+                 limits=None):
+        stage_limits = dict(STAGE_LIMITS)
+        stage_limits.update(limits or {})
+        self.stages = dict((name, Stage(name, limit))
+                           for name, limit in stage_limits.items())
+        self.workers = {'fast': fast_workers, 'slow': workers}
+        self._queues = dict((lane, Queue()) for lane in LANES)
+        self._waits = dict((lane, WaitStats()) for lane in LANES)
+        self._running = dict((lane, 0) for lane in LANES)
+        self._lock = Lock()
+        self._threads = []
+
+    def start(self):
+        for lane in LANES:
+            for i in range(self.workers[lane]):
+                thread = Thread(target=self._worker, args=(lane,),
+                                name='provision-%s-%s' % (lane, i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def stop(self):
+        "Finish queued jobs and stop worker threads"
+        for lane in LANES:
+            for i in range(self.workers[lane]):
+                self._queues[lane].put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def is_alive(self):
+        return bool(self._threads) and all(
+            x.is_alive() for x in self._threads)
+
+    def submit(self, job, fast=False):
+        "Queue job, fast is for jobs not doing conversion"
+        lane = fast and 'fast' or 'slow'
+        self._queues[lane].put((time.time(), job))
+
+    def _worker(self, lane):
+        queue = self._queues[lane]
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            queued, job = item
+            with self._lock:
+                self._waits[lane].add(time.time() - queued)
+                self._running[lane] += 1
+            try:
+                # session of this thread must not outlive the job
+                with session_scope():
+                    job.run()
+            except Exception, e:
+                logger.exception("Provision job failed: %s", e)
+            finally:
+                with self._lock:
+                    self._running[lane] -= 1
+
+    @contextmanager
+    def stage(self, name):
+        with self.stages[name].slot():
+            yield
+
+    def stats(self):
+        "Queue depth, wait times and stage usage"
+        lanes = {}
+        with self._lock:
+            for lane in LANES:
+                lanes[lane] = self._waits[lane].to_dict()
+                lanes[lane].update(queued=self._queues[lane].qsize(),
+                                   running=self._running[lane],
+                                   workers=self.workers[lane])
+        return dict(
+            lanes=lanes,
+            stages=dict((name, stage.to_dict())
+                        for name, stage in self.stages.items()))
+
+
+_scheduler = None
+_scheduler_lock = Lock()
+
+
+def get_scheduler():
+    """Return running Scheduler of this process,
+    start it if needed (e.g. after uwsgi fork)
+
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = Scheduler(
+                app.config.get('PROVISION_WORKERS', WORKERS),
+                app.config.get('PROVISION_FAST_WORKERS', FAST_WORKERS),
+                app.config.get('PROVISION_STAGE_LIMITS'))
+            _scheduler.start()
+        return _scheduler
+
+
+def stage(name):
+    "Context manager taking a slot of the stage of process scheduler"
+    return get_scheduler().stage(name)
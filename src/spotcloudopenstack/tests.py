@@ -6,15 +6,55 @@ Test suite for OpenStack SpotCloud adapter
 import unittest
 import json
 import sys
+import time
 
 import uuid
+import os
+import tarfile
+import gzip
+import zipfile
+import tempfile
+import shutil
+import struct
+import fcntl
+import urllib
+from hashlib import sha1, md5
+from datetime import datetime, timedelta
+from threading import Thread, Event, Lock
+from StringIO import StringIO
+from subprocess import Popen, PIPE
 
 from flask import request
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine.url import make_url
 
-from spotcloudopenstack.app import app, db
+from spotcloudopenstack.app import app, db, session_scope
 from spotcloudopenstack.models import VM, Package, HardwareTemplate, Task
+from spotcloudopenstack import api
 from spotcloudopenstack import auth
-from spotcloudopenstack.api import rest, ptemplate_list
+from spotcloudopenstack.novaconn import NovaConnectionManager
+from spotcloudopenstack import reconciler
+from spotcloudopenstack import models
+from spotcloudopenstack import diskio
+from spotcloudopenstack import partitions
+from spotcloudopenstack import extfs
+from spotcloudopenstack import provision
+from spotcloudopenstack import download
+from spotcloudopenstack import scheduler
+from spotcloudopenstack import provisiond
+from spotcloudopenstack import metrics
+from spotcloudopenstack import fakes
+from spotcloudopenstack import bench
+from spotcloudopenstack import apibench
+from spotcloudopenstack import authbench
+from spotcloudopenstack import dbbench
+from spotcloudopenstack import capacity
+from spotcloudopenstack import queryplan
+from spotcloudopenstack import retention
+from spotcloudopenstack import novaconn
+from spotcloudopenstack.fakes import PackageServer
+from spotcloudopenstack.api import hosting, htemplate_list, ptemplate_list
 
 import logging
 
@@ -39,6 +79,7 @@ class ApiTestCase(unittest.TestCase):
         db.drop_all()
         db.create_all()
         self.app = app.test_client()
+        self.audit = queryplan.QueryPlanAudit(db.engine).start()
 
         pkg_uuid = str(uuid.uuid1())
         self.pkg = Package(ecp_uuid=pkg_uuid,
@@ -59,7 +100,19 @@ class ApiTestCase(unittest.TestCase):
         db.session.commit()
 
     def tearDown(self):
+        self.audit.stop()
+        if retention._retention is not None:
+            # started by vm_put
+            retention._retention.stop()
+            retention._retention = None
+        if provisiond._keeper is not None:
+            # started by vm_put
+            provisiond._keeper.stop()
+            provisiond._keeper = None
+        db.session.remove()
         db.drop_all()
+        if self.audit.violations:
+            self.fail(self.audit.report())
 
     def test_digest(self):
         self.assertTrue(
@@ -90,5 +143,1844 @@ class ApiTestCase(unittest.TestCase):
         self.assertTrue(
             data['packages'][0]['uuid'] == self.pkg.ecp_uuid)
 
+
+class AuthTestCase(ApiTestCase):
+    def setUp(self):
+        ApiTestCase.setUp(self)
+        app.config['AUTH_REPLAY_CACHE_SIZE'] = 100
+        auth._replay_cache = None
+
+    def tearDown(self):
+        del app.config['AUTH_REPLAY_CACHE_SIZE']
+        auth._replay_cache = None
+        ApiTestCase.tearDown(self)
+
+    def put(self, form):
+        response = self.app.put("/rest/hosting/vm", data=form)
+        return json.loads(response.data)
+
+    def test_digest_unchanged(self):
+        for args in [{'ecp_username': USER},
+                     {'ecp_username': USER, 'Name': u'\u0432m',
+                      'b': 1, 'ecp_auth_digest': 'x'}]:
+            self.assertEqual(auth.get_digest(PASSWD, args),
+                             authbench.uncached_digest(PASSWD, args))
+
+    def test_get_digest_cached(self):
+        args = get_auth_args()
+        for i in range(2):
+            response = self.app.get("/rest/hosting/htemplate/list?%s" % args)
+            self.assertEqual(json.loads(response.data)['errno'], 0)
+        response = self.app.get(
+            "/rest/hosting/htemplate/list?%s" % args.replace('=', 'A=', 2))
+        self.assertEqual(json.loads(response.data)['errno'], 1)
+
+    def test_put_replay(self):
+        form = {'name': str(uuid.uuid1()),
+                'package': self.pkg.ecp_uuid,
+                'hardware': 'missing',
+                'ecp_username': USER}
+        form['ecp_auth_digest'] = auth.get_digest(PASSWD, form)
+        self.assertTrue('does not exist' in self.put(form)['message'])
+        self.assertEqual(self.put(form)['message'],
+                         'Wrong digest auth: Replayed auth digest')
+        form['ecp_auth_digest'] = 'x' + form['ecp_auth_digest'][1:]
+        self.assertEqual(self.put(form)['message'],
+                         'Wrong digest auth: Wrong auth digest')
+
+    def test_replay_cache(self):
+        cache = auth.ReplayCache(size=2, window=60)
+        for digest in ('a', 'b', 'c'):
+            self.assertTrue(cache.check_and_add(digest))
+        self.assertFalse(cache.check_and_add('c'))
+        # the oldest was evicted
+        self.assertTrue(cache.check_and_add('a'))
+        self.assertTrue(cache.check_and_add('a', 'POST', '/other'))
+        cache.window = 0
+        time.sleep(0.01)
+        self.assertTrue(cache.check_and_add('a'))
+
+    def test_compare_digest(self):
+        self.assertTrue(auth._compare_digest('abc', 'abc'))
+        self.assertFalse(auth._compare_digest('abc', 'abd'))
+        self.assertFalse(auth._compare_digest('abc', 'ab'))
+        self.assertTrue(auth.compare_digest(u'abc', 'abc'))
+
+
+class CatalogTestCase(ApiTestCase):
+    def get(self, path, etag=None):
+        headers = etag and {'If-None-Match': etag} or {}
+        return self.app.get("/rest/hosting/%s?%s" % (
+                path, get_auth_args()), headers=headers)
+
+    def test_not_modified(self):
+        response = self.get('ptemplate/list')
+        etag = response.headers['ETag']
+        self.assertTrue(response.headers['Last-Modified'])
+        builds = ptemplate_list.catalog.builds
+        response = self.get('ptemplate/list', etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(ptemplate_list.catalog.builds, builds)
+
+    def test_invalidated_by_commit(self):
+        etag = self.get('ptemplate/list').headers['ETag']
+        db.session.add(Package(nova_id='ami-new'))
+        db.session.commit()
+        response = self.get('ptemplate/list', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)['packages']), 2)
+
+    def test_bulk_delete(self):
+        self.get('htemplate/list')
+        HardwareTemplate.query.delete()
+        db.session.commit()
+        data = json.loads(self.get('htemplate/list').data)
+        self.assertEqual(data['templates'], [])
+
+    def test_rollback_keeps_cache(self):
+        self.get('htemplate/list')
+        builds = htemplate_list.catalog.builds
+        HardwareTemplate.query.delete()
+        db.session.rollback()
+        self.get('htemplate/list')
+        self.assertEqual(htemplate_list.catalog.builds, builds)
+
+    def test_ttl(self):
+        response = self.get('htemplate/list')
+        builds = htemplate_list.catalog.builds
+        app.config['CATALOG_TTL'] = 0
+        try:
+            again = self.get('htemplate/list', response.headers['ETag'])
+            time.sleep(1)
+            last = self.get('htemplate/list')
+        finally:
+            del app.config['CATALOG_TTL']
+        # rebuilt, but the same content is still not modified
+        self.assertEqual(htemplate_list.catalog.builds, builds + 2)
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(last.headers['Last-Modified'],
+                         response.headers['Last-Modified'])
+
+
+class FakeReconciler(reconciler.Reconciler):
+    syncs = 0
+
+    def _sync_with_nova(self):
+        self.syncs += 1
+
+
+class QueryPlanTestCase(ApiTestCase):
+    def test_full_scans(self):
+        self.assertEqual(queryplan.full_scans(
+                ['SCAN TABLE VM', 'SCAN hardware_template']), ['vm'])
+        self.assertEqual(queryplan.full_scans(
+                ['SCAN task USING INDEX ix_task_started']), ['task'])
+        self.assertEqual(queryplan.full_scans(
+                ['SEARCH vm USING INDEX ix_vm_package_uuid '
+                 '(package_uuid=?)']), [])
+
+    def test_audit(self):
+        pkg_uuid = self.pkg.ecp_uuid
+        audit = queryplan.QueryPlanAudit(
+            db.engine, modules=('tests.py',)).start()
+        try:
+            VM.query.filter_by(package_uuid=pkg_uuid).all()
+            Task.query.filter_by(vm_uuid='vm-1').all()
+            self.assertEqual(audit.violations, [])
+            VM.query.filter_by(state='running').all()
+            VM.query.all()
+        finally:
+            audit.stop()
+        self.assertEqual(audit.statements, 3)
+        self.assertEqual(len(audit.violations), 1)
+        self.assertTrue('tests.py' in audit.report())
+
+    def test_listener_installed_once(self):
+        listeners = len(list(db.engine.dispatch.before_cursor_execute))
+        for i in range(2):
+            audit = queryplan.QueryPlanAudit(
+                db.engine, modules=('tests.py',)).start()
+            audit.stop()
+        self.assertEqual(
+            len(list(db.engine.dispatch.before_cursor_execute)), listeners)
+        VM.query.filter_by(state='running').all()
+        self.assertEqual(audit.statements, 0)
+
+    def test_api_audited(self):
+        response = self.app.get(
+            "/rest/hosting/ptemplate/list?%s" % get_auth_args())
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.audit.statements > 0)
+
+
+class ReconcilerTestCase(ApiTestCase):
+    def setUp(self):
+        ApiTestCase.setUp(self)
+        self.reconciler = FakeReconciler(interval=3600, max_age=3600)
+        self.reconciler.start()
+        reconciler._reconciler = self.reconciler
+
+    def tearDown(self):
+        reconciler._reconciler = None
+        self.reconciler.stop()
+        self.reconciler.join()
+        ApiTestCase.tearDown(self)
+
+    def add_vm(self):
+        vm = VM(state='running',
+                nova_id='i-%s' % uuid.uuid1().hex[:8],
+                hardware=self.hardware,
+                package_uuid=self.pkg.ecp_uuid)
+        db.session.add(vm)
+        db.session.commit()
+        return vm.ecp_uuid
+
+    def test_vm_list_from_snapshot(self):
+        self.reconciler.refresh()
+        vm_uuid = self.add_vm()
+        self.reconciler.refresh(sync=False)
+        response = self.app.get(
+            "/rest/hosting/vm/list?%s" % get_auth_args())
+        data = json.loads(response.data)
+        self.assertEqual(data['vms'][0]['uuid'], vm_uuid)
+        self.assertTrue(data['snapshot_age'] < 3600)
+        self.assertEqual(self.reconciler.syncs, 1)
+
+    def test_stale_snapshot_synced_inline(self):
+        self.reconciler.max_age = 0
+        self.reconciler.refresh()
+        time.sleep(0.01)
+        self.reconciler.snapshot()
+        self.assertEqual(self.reconciler.syncs, 2)
+
+    def test_stop(self):
+        other = FakeReconciler(interval=3600, max_age=3600)
+        other.start()
+        other.stop()
+        other.join(5)
+        self.assertFalse(other.is_alive())
+        self.assertEqual(other.syncs, 0)
+
+    def test_commit_triggers_refresh(self):
+        self.reconciler.refresh()
+        vm_uuid = self.add_vm()
+        for i in range(100):
+            if self.reconciler.get(vm_uuid)[0]:
+                break
+            time.sleep(0.02)
+        self.assertEqual(self.reconciler.get(vm_uuid)[0]['uuid'], vm_uuid)
+        self.assertEqual(self.reconciler.syncs, 1)
+
+
+class RoutingTestCase(ReconcilerTestCase):
+    def test_rules_sorted(self):
+        # sorted at import, concurrent first requests do not sort them
+        proc = Popen([sys.executable, '-c',
+                      'from spotcloudopenstack.api import app; '
+                      'print app.url_map._remap'],
+                     stdout=PIPE, stderr=PIPE, cwd=os.path.dirname(
+                os.path.dirname(os.path.abspath(__file__))))
+        stdout, stderr = proc.communicate()
+        self.assertEqual(stdout.strip(), 'False', stderr)
+
+    def test_query_in_path(self):
+        response = self.app.get(
+            "/rest/hosting/htemplate/list%%3F%s" % get_auth_args())
+        self.assertEqual(json.loads(response.data)['errno'], 0)
+
+    def test_query_in_path_quoted(self):
+        passwd = app.config['SPOTCLOUD_PASSWD']
+        # digest of this password has '+', '/' and '='
+        app.config['SPOTCLOUD_PASSWD'] = 'pw3'
+        try:
+            digest = auth.get_digest('pw3', {'ecp_username': USER})
+            self.assertTrue('+' in digest and '/' in digest and
+                            '=' in digest)
+            quote = urllib.quote
+            for quoted, errno in [(quote(quote(digest, ''), ''), 0),
+                                  (quote(quote(digest)), 0),
+                                  (quote(digest), 1)]:
+                for sep in ('?', '%3F'):
+                    response = self.app.get(
+                        "/rest/hosting/htemplate/list%s"
+                        "ecp_username=%s&ecp_auth_digest=%s" % (
+                            sep, USER, quoted))
+                    self.assertEqual(
+                        (sep, quoted, json.loads(response.data)['errno']),
+                        (sep, quoted, errno))
+        finally:
+            app.config['SPOTCLOUD_PASSWD'] = passwd
+
+    def test_vm_get(self):
+        vm_uuid = self.add_vm()
+        for path in ('vm/%s' % vm_uuid, 'vm/%s/' % vm_uuid):
+            response = self.app.get(
+                "/rest/hosting/%s?%s" % (path, get_auth_args()))
+            self.assertEqual(json.loads(response.data)['vm']['uuid'],
+                             vm_uuid)
+        self.assertTrue(metrics.API_SECONDS.count('vm/<uuid>', 'GET') >= 2)
+        response = self.app.get("/rest/hosting/vm/%s?%s" % (
+                vm_uuid.upper(), get_auth_args()))
+        self.assertEqual(response.status_code, 404)
+
+    def test_auth_on_every_route(self):
+        vm_uuid = self.add_vm()
+        response = self.app.get("/rest/hosting/vm/%s" % vm_uuid)
+        self.assertEqual(json.loads(response.data)['errno'], 1)
+
+    def test_vm_methods(self):
+        vm_uuid = self.add_vm()
+        response = self.app.get("/rest/hosting/vm?%s" % get_auth_args())
+        self.assertEqual(json.loads(response.data)['errno'], 2)
+        manager = novaconn._manager
+        novaconn._manager = fakes.FakeNovaManager()
+        try:
+            form = {'ecp_username': USER, 'action': 'delete'}
+            form['ecp_auth_digest'] = auth.get_digest(PASSWD, form)
+            response = self.app.post("/rest/hosting/vm/%s" % vm_uuid,
+                                     data=form)
+        finally:
+            novaconn._manager = manager
+        self.assertEqual(json.loads(response.data)['errno'], 0)
+        self.assertEqual(VM.query.get(vm_uuid), None)
+
+    def test_delete_two_vms(self):
+        # path is not signed, both deletes have the same digest
+        vms = [self.add_vm(), self.add_vm()]
+        app.config['AUTH_REPLAY_CACHE_SIZE'] = 100
+        auth._replay_cache = None
+        manager = novaconn._manager
+        novaconn._manager = fakes.FakeNovaManager()
+        try:
+            for vm_uuid in vms:
+                form = {'ecp_username': USER, 'action': 'delete'}
+                form['ecp_auth_digest'] = auth.get_digest(PASSWD, form)
+                response = self.app.post("/rest/hosting/vm/%s" % vm_uuid,
+                                         data=form)
+                self.assertEqual(json.loads(response.data)['errno'], 0)
+        finally:
+            novaconn._manager = manager
+            del app.config['AUTH_REPLAY_CACHE_SIZE']
+            auth._replay_cache = None
+        self.assertEqual(VM.query.filter(VM.ecp_uuid.in_(vms)).count(), 0)
+
+
+class FakeInstance(object):
+    def __init__(self, state, dns_name):
+        self.state = state
+        self.dns_name = dns_name
+
+
+class VMSyncTestCase(ApiTestCase):
+    def setUp(self):
+        ApiTestCase.setUp(self)
+        self.get_instances_dict = models.get_instances_dict
+        self.vms = []
+        for state in VM.STATES:
+            vm = VM(state=state,
+                    nova_id='i-%s' % state,
+                    hardware=self.hardware,
+                    package_uuid=self.pkg.ecp_uuid)
+            db.session.add(vm)
+            self.vms.append(vm.ecp_uuid)
+        db.session.commit()
+
+    def tearDown(self):
+        models.get_instances_dict = self.get_instances_dict
+        ApiTestCase.tearDown(self)
+
+    def test_sync(self):
+        models.get_instances_dict = lambda: {
+            'i-scheduling': FakeInstance('scheduling', '127.0.0.1'),
+            'i-launching': FakeInstance('running', '10.0.0.2')}
+        summary = VM.sync_with_nova()
+        self.assertEqual(summary['deleted'], 1)
+        self.assertEqual(summary['updated'], 1)
+        self.assertEqual(summary['unchanged'], 1)
+        self.assertEqual(VM.query.get(self.vms[2]), None)
+        vm = VM.query.get(self.vms[1])
+        self.assertEqual((vm.state, vm.ip_address),
+                         ('running', '10.0.0.2'))
+
+
+    def test_vm_created_while_described(self):
+        created = []
+        hardware_uuid = self.hardware.ecp_uuid
+        pkg_uuid = self.pkg.ecp_uuid
+
+        def create_vm():
+            vm = VM(state='scheduling', nova_id='i-new',
+                    hardware_uuid=hardware_uuid, package_uuid=pkg_uuid)
+            db.session.add(vm)
+            db.session.commit()
+            created.append(vm.ecp_uuid)
+            db.session.remove()
+
+        def describe():
+            # instance_created of a provision commits meanwhile
+            thread = Thread(target=create_vm)
+            thread.start()
+            thread.join()
+            return {'i-scheduling': FakeInstance('scheduling', '127.0.0.1'),
+                    'i-launching': FakeInstance('launching', '127.0.0.1'),
+                    'i-running': FakeInstance('running', '127.0.0.1')}
+
+        models.get_instances_dict = describe
+        summary = VM.sync_with_nova()
+        self.assertEqual(summary['deleted'], 0)
+        self.assertTrue(VM.query.get(created[0]) is not None)
+
+
+class StreamOnly(object):
+    "File object without seek, like HTTP response"
+    def __init__(self, data):
+        self._file = StringIO(data)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+
+def make_gzip(data):
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb')
+    gz.write(data)
+    gz.close()
+    return buf.getvalue()
+
+
+def make_package(disk_gz):
+    "Return .xvm2 content with metadata and gzipped disk"
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w')
+    for name, data in [('package.xml', '<package/>'),
+                       ('disk.raw.gz', disk_gz)]:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, StringIO(data))
+    tar.close()
+    return buf.getvalue()
+
+
+class DiskIOTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_extract_disk(self):
+        disk = os.urandom(1000) + '\0' * 3 * diskio.BLOCK_SIZE
+        target = os.path.join(self.dir, 'disk.img')
+        name, checksum, stats = diskio.extract_disk(
+            StreamOnly(make_package(make_gzip(disk))), target)
+        self.assertEqual(name, 'disk.raw.gz')
+        self.assertEqual(stats.logical, len(disk))
+        self.assertEqual(stats.physical, diskio.SPARSE_BLOCK)
+        self.assertEqual(checksum, sha1(disk).hexdigest())
+        self.assertEqual(open(target, 'rb').read(), disk)
+        self.assertTrue(os.stat(target).st_blocks * 512 < diskio.BLOCK_SIZE)
+
+    def test_gunzip_members(self):
+        dst = StringIO()
+        size, checksum = diskio.gunzip_stream(
+            StringIO(make_gzip('first') + make_gzip('second')), dst)
+        self.assertEqual(dst.getvalue(), 'firstsecond')
+
+    def test_gunzip_bounded(self):
+        writes = []
+        dst = StringIO()
+        dst.write = lambda data: writes.append(len(data))
+        disk = '\0' * 8 * diskio.BLOCK_SIZE + 'end'
+        size, checksum = diskio.gunzip_stream(
+            StringIO(make_gzip(disk) + make_gzip('next')), dst)
+        self.assertEqual(size, len(disk) + 4)
+        self.assertEqual(sum(writes), size)
+        self.assertEqual(max(writes), diskio.BLOCK_SIZE)
+        self.assertEqual(checksum, sha1(disk + 'next').hexdigest())
+
+    def test_gunzip_truncated(self):
+        disk = os.urandom(1000) + '\0' * 3 * diskio.BLOCK_SIZE
+        gz = make_gzip(disk)
+        # inside the trailer, before it and inside deflate data
+        for size in [len(gz) - 1, len(gz) - 8, len(gz) // 2, 0]:
+            self.assertRaises(RuntimeError, diskio.gunzip_stream,
+                              StringIO(gz[:size]), StringIO())
+        self.assertRaises(RuntimeError, diskio.gunzip_stream,
+                          StringIO(make_gzip('first') + gz[:-1]),
+                          StringIO())
+        self.assertRaises(RuntimeError, diskio.extract_disk,
+                          StreamOnly(make_package(gz[:-4])),
+                          os.path.join(self.dir, 'disk.img'))
+
+    def test_copy_range(self):
+        src = os.path.join(self.dir, 'disk.img')
+        block = diskio.BLOCK_SIZE
+        data = 'x' * 512 + '\0' * 4 * block + 'y' * block
+        open(src, 'wb').write('h' * 512 + data + 't' * 512)
+        dst = os.path.join(self.dir, 'root.img')
+        stats = diskio.copy_range(src, 512, len(data), dst)
+        self.assertEqual(stats, (len(data), block + diskio.SPARSE_BLOCK + 512))
+        self.assertEqual(open(dst, 'rb').read(), data)
+        self.assertTrue(os.stat(dst).st_blocks * 512 < 3 * block)
+
+    def test_qemu_img_version(self):
+        script = os.path.join(self.dir, 'qemu-img')
+        open(script, 'w').write(
+            '#!/bin/sh\necho "qemu-img version 2.11.1"\n')
+        os.chmod(script, 0755)
+        self.assertTrue(provision.qemu_img_supports_offset(script))
+        self.assertFalse(provision.qemu_img_supports_offset(
+                os.path.join(self.dir, 'missing')))
+
+    def test_sparse_tail(self):
+        path = os.path.join(self.dir, 'tail.img')
+        with diskio.SparseFile(path, block_size=4096) as dst:
+            dst.write('x' * 10 + '\0' * 3 * 4096)
+        self.assertEqual(dst.stats(), (10 + 3 * 4096, 4096))
+        self.assertEqual(os.path.getsize(path), 10 + 3 * 4096)
+
+    def test_sparse_aligned(self):
+        path = os.path.join(self.dir, 'aligned.img')
+        with diskio.SparseFile(path, block_size=4096) as dst:
+            # zero run straddles the writes, not their blocks
+            dst.write('x' * 100 + '\0' * 5000)
+            dst.write('\0' * 3192 + 'y' * 4096)
+            dst.write('z')
+        self.assertEqual(dst.stats(), (12389, 4096 * 2 + 101))
+        self.assertEqual(open(path, 'rb').read(),
+                         'x' * 100 + '\0' * 8192 + 'y' * 4096 + 'z')
+
+    def test_no_disk(self):
+        self.assertRaises(
+            RuntimeError,
+            diskio.extract_disk,
+            StreamOnly(make_package('')[:1024]),
+            os.path.join(self.dir, 'disk.img'))
+
+
+def mbr_entry(ptype, lba, sectors, bootable=False):
+    return struct.pack('<B3sB3sII', bootable and 0x80 or 0, '\0' * 3,
+                       ptype, '\0' * 3, lba, sectors)
+
+
+def write_sector(path, lba, entries):
+    "Write MBR/EBR with entries at lba"
+    f = open(path, 'r+b')
+    f.seek(lba * 512 + 446)
+    f.write(''.join(entries).ljust(64, '\0') + '\x55\xaa')
+    f.close()
+
+
+class PartitionsTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.ftruncate(fd, 64 * 1024 * 1024)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_mbr_with_boot_partition(self):
+        write_sector(self.path, 0, [
+                mbr_entry(0x83, 2048, 2048, bootable=True),
+                mbr_entry(0x83, 4096, 100000),
+                mbr_entry(0x82, 104096, 2048)])
+        parts = partitions.read_partitions(self.path)
+        self.assertEqual(len(parts), 3)
+        root = partitions.find_root(parts)
+        self.assertEqual((root.number, root.start), (2, 4096 * 512))
+        self.assertEqual(partitions.find_boot(parts, root).number, 1)
+
+    def test_extended(self):
+        write_sector(self.path, 0, [
+                mbr_entry(0x82, 2048, 2048),
+                mbr_entry(0x05, 4096, 100000)])
+        write_sector(self.path, 4096, [
+                mbr_entry(0x83, 63, 1000),
+                mbr_entry(0x05, 2000, 50000)])
+        write_sector(self.path, 6096, [
+                mbr_entry(0x83, 63, 40000)])
+        parts = partitions.read_partitions(self.path)
+        self.assertEqual([x.number for x in parts], [1, 5, 6])
+        root = partitions.find_root(parts)
+        self.assertEqual((root.number, root.start, root.size),
+                         (6, (6096 + 63) * 512, 40000 * 512))
+        self.assertEqual(partitions.find_boot(parts, root), root)
+
+    def test_gpt(self):
+        write_sector(self.path, 0, [mbr_entry(0xee, 1, 131071)])
+        f = open(self.path, 'r+b')
+        f.seek(512)
+        f.write('EFI PART' + '\0' * 64 + struct.pack('<QII', 2, 128, 128))
+        efi = uuid.UUID('c12a7328-f81f-11d2-ba4b-00a0c93ec93b').bytes_le
+        root = uuid.UUID(partitions.GPT_ROOT_TYPES[1]).bytes_le
+        f.seek(1024)
+        f.write(efi + '\0' * 16 + struct.pack('<QQQ', 2048, 4095, 0))
+        f.write('\0' * 72)
+        f.write(root + '\0' * 16 + struct.pack('<QQQ', 4096, 8191, 0))
+        f.close()
+        parts = partitions.read_partitions(self.path)
+        self.assertEqual([x.number for x in parts], [1, 2])
+        root = partitions.find_root(parts)
+        self.assertEqual((root.number, root.start, root.size),
+                         (2, 4096 * 512, 4096 * 512))
+
+    def test_not_partitioned(self):
+        f = open(self.path, 'r+b')
+        f.seek(partitions.EXT_MAGIC_OFFSET)
+        f.write(partitions.EXT_MAGIC)
+        f.close()
+        root = partitions.find_root(
+            partitions.read_partitions(self.path))
+        self.assertEqual((root.start, root.size), (0, 64 * 1024 * 1024))
+
+    def test_no_table(self):
+        self.assertRaises(RuntimeError,
+                          partitions.read_partitions, self.path)
+
+
+def make_ext_image(path, fs_type, offset, files, links=()):
+    "Make file system with files by mke2fs -d, no root needed"
+    src = tempfile.mkdtemp()
+    try:
+        for name, data in files:
+            dir_name = os.path.dirname(os.path.join(src, name))
+            if not os.path.exists(dir_name):
+                os.makedirs(dir_name)
+            open(os.path.join(src, name), 'wb').write(data)
+        for name, target in links:
+            os.symlink(target, os.path.join(src, name))
+        block_size = fs_type == 'ext2' and '1024' or '4096'
+        proc = Popen(['mke2fs', '-q', '-F', '-t', fs_type,
+                      '-b', block_size, '-E', 'offset=%s' % offset,
+                      '-d', src, path, '8M'], stdout=PIPE, stderr=PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode:
+            raise RuntimeError(stderr)
+    finally:
+        shutil.rmtree(src)
+
+
+def has_mke2fs():
+    try:
+        Popen(['mke2fs', '-V'], stdout=PIPE, stderr=PIPE).communicate()
+        return True
+    except OSError:
+        return False
+
+
+class ExtFSTestCase(unittest.TestCase):
+    def setUp(self):
+        if not has_mke2fs():
+            self.skipTest('mke2fs is not installed')
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.kernel = os.urandom(400 * 1024)
+        self.initrd = os.urandom(5000)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def check(self, fs_type):
+        make_ext_image(
+            self.path, fs_type, 1024 * 1024,
+            [('boot/vmlinuz-2.6.32-21', self.kernel),
+             ('boot/initrd.img-2.6.32-21', self.initrd),
+             ('etc/hostname', 'vm\n')],
+            [('vmlinuz', 'boot/vmlinuz-2.6.32-21'),
+             ('boot/vmlinuz', '/boot/vmlinuz-2.6.32-21')])
+        fs = extfs.ExtFS(self.path, 1024 * 1024)
+        try:
+            self.assertEqual(
+                fs.glob('/boot', 'vmlinuz*'),
+                ['vmlinuz', 'vmlinuz-2.6.32-21'])
+            self.assertEqual(
+                fs.read_data(fs.lookup('/vmlinuz')), self.kernel)
+            self.assertEqual(
+                fs.read_data(fs.lookup('boot/vmlinuz')), self.kernel)
+            target = self.path + '-initrd'
+            fs.copy('/boot/initrd.img-2.6.32-21', target)
+            self.assertEqual(open(target, 'rb').read(), self.initrd)
+            os.unlink(target)
+            self.assertRaises(extfs.ExtFSError, fs.lookup, '/boot/nothing')
+        finally:
+            fs.close()
+
+    def test_ext2(self):
+        self.check('ext2')
+
+    def test_ext4(self):
+        self.check('ext4')
+
+    def test_separate_boot(self):
+        make_ext_image(
+            self.path, 'ext4', 0,
+            [('vmlinuz-2.6.32-21', self.kernel)],
+            [('vmlinuz', '/boot/vmlinuz-2.6.32-21')])
+        fs = extfs.ExtFS(self.path, mount_point='/boot')
+        try:
+            self.assertEqual(
+                fs.read_data(fs.lookup('/vmlinuz')), self.kernel)
+        finally:
+            fs.close()
+
+    def test_no_fs(self):
+        open(self.path, 'wb').write('\0' * 4096)
+        self.assertRaises(extfs.ExtFSError, extfs.ExtFS, self.path)
+
+
+class DownloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'package.xvm2')
+        self.data = os.urandom(300 * 1024 + 7)
+        self.server = PackageServer({'pkg': self.data}).start()
+        self.url = self.server.url_tmpl % 'pkg'
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def downloader(self):
+        downloader = download.Downloader(
+            self.url, self.path, workers=4, chunk_size=32 * 1024)
+        downloader.retry_delay = 0
+        return downloader
+
+    def test_download(self):
+        downloader = self.downloader()
+        downloader.run()
+        self.assertEqual(open(self.path, 'rb').read(), self.data)
+        self.assertEqual(downloader.md5, md5(self.data).hexdigest())
+        self.assertEqual(downloader.completed(), 1.0)
+        self.assertFalse(os.path.exists(downloader.state_path))
+
+    def test_resume(self):
+        chunks = self.downloader()
+        chunks.probe()
+        self.server.fail_after = 5
+        self.assertRaises(download.DownloadError, self.downloader().run)
+        self.server.fail_after = None
+        self.server.requests = 0
+        downloader = self.downloader()
+        downloader.run()
+        self.assertEqual(open(self.path, 'rb').read(), self.data)
+        # probe and missing chunks only
+        self.assertTrue(self.server.requests < chunks.chunks() + 1)
+
+    def test_chunk_synced_before_state(self):
+        events = []
+        fsync = os.fsync
+        downloader = self.downloader()
+        downloader.workers = 1
+        save_state = downloader._save_state
+        def record_fsync(fd):
+            events.append('fsync')
+            fsync(fd)
+        def record_state():
+            events.append('state')
+            save_state()
+        os.fsync = record_fsync
+        downloader._save_state = record_state
+        try:
+            downloader.run()
+        finally:
+            os.fsync = fsync
+        # data of every chunk, then the state file
+        self.assertEqual(events, ['fsync', 'state', 'fsync'] *
+                         downloader.chunks())
+
+    def test_checksum(self):
+        downloader = self.downloader()
+        downloader.probe()
+        downloader.md5 = md5('other').hexdigest()
+        self.assertRaises(download.DownloadError, downloader.run)
+
+    def test_no_ranges(self):
+        self.server.ranges = False
+        self.assertRaises(download.RangesNotSupported,
+                          self.downloader().probe)
+
+
+class FakeUser(object):
+    accesskey = 'access'
+    secretkey = 'secret'
+
+
+class FakeAdminClient(object):
+    def __init__(self):
+        self.calls = 0
+
+    def get_user(self, name):
+        self.calls += 1
+        return FakeUser()
+
+
+class FakeConnectionManager(NovaConnectionManager):
+    def _make_admin_client(self):
+        return FakeAdminClient()
+
+    def _make_connection(self, credentials):
+        return object()
+
+
+class NovaConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.manager = FakeConnectionManager(
+            {'USERNAME': 'admin',
+             'PROJECT_NAME': 'project',
+             'NOVA_CREDENTIALS_TTL': 60})
+
+    def test_credentials_cached(self):
+        for i in range(3):
+            with self.manager.connection():
+                pass
+        self.assertEqual(self.manager.admin_client().calls, 1)
+        self.assertEqual(self.manager.credentials(),
+                         ('access:project', 'secret'))
+
+    def test_credentials_expire(self):
+        self.manager.credentials()
+        self.manager._credentials_expire = 0
+        self.manager.credentials()
+        self.assertEqual(self.manager.admin_client().calls, 2)
+
+    def test_connection_reused(self):
+        with self.manager.connection() as conn1:
+            pass
+        with self.manager.connection() as conn2:
+            pass
+        self.assertTrue(conn1 is conn2)
+
+    def test_failed_connection_dropped(self):
+        try:
+            with self.manager.connection() as conn1:
+                raise IOError('broken socket')
+        except IOError:
+            pass
+        with self.manager.connection() as conn2:
+            pass
+        self.assertTrue(conn1 is not conn2)
+
+
+class HardwareSyncTestCase(ApiTestCase):
+    def setUp(self):
+        ApiTestCase.setUp(self)
+        self.server = fakes.FakeNovaServer().start()
+        self.old_manager = novaconn._manager
+        novaconn._manager = NovaConnectionManager(
+            {'NOVA_ENDPOINT': self.server.url,
+             'NOVA_REGION': 'nova',
+             'NOVA_ACCESS_KEY': 'admin-access',
+             'NOVA_SECRET_KEY': 'admin-secret',
+             'NOVA_INSTANCE_TYPES_TTL': 60})
+
+    def tearDown(self):
+        novaconn._manager = self.old_manager
+        self.server.stop()
+        ApiTestCase.tearDown(self)
+
+    def uuids(self):
+        return dict((x.name, x.ecp_uuid) for x in HardwareTemplate.query)
+
+    def test_sync(self):
+        pkg_uuid = self.pkg.ecp_uuid
+        summary = HardwareTemplate.sync_with_nova()
+        # 'test' template is not a Nova type and no VM uses it
+        self.assertEqual(summary, dict(added=10, updated=0, deleted=1,
+                                       retired=0, unchanged=0))
+        uuids = self.uuids()
+        self.assertEqual(HardwareTemplate.sync_with_nova(),
+                         dict(added=0, updated=0, deleted=0, retired=0,
+                              unchanged=10))
+        self.assertEqual(self.server.calls['DescribeInstanceTypes'], 1)
+
+        db.session.add(VM(state='running', nova_id='i-1',
+                          hardware_uuid=uuids['m1.tiny.i386'],
+                          package_uuid=self.pkg.ecp_uuid))
+        db.session.commit()
+        self.server.instance_types = [
+            ('m1.small', 3072, 1, 20, 2),
+            ('m1.medium', 4096, 2, 40, 3),
+            ('m1.huge', 32768, 16, 320, 6)]
+        novaconn._manager._instance_types_expire = 0
+        self.assertEqual(HardwareTemplate.sync_with_nova(),
+                         dict(added=2, updated=2, deleted=5, retired=1,
+                              unchanged=2))
+        self.assertEqual(self.server.calls['DescribeInstanceTypes'], 2)
+        synced = self.uuids()
+        for name in ('m1.small.i386', 'm1.small.x86_64', 'm1.medium.i386',
+                     'm1.tiny.i386'):
+            self.assertEqual(synced[name], uuids[name])
+        self.assertFalse('m1.tiny.x86_64' in synced)
+        self.assertTrue('m1.huge.x86_64' in synced)
+        self.assertEqual(HardwareTemplate.query.get(
+                uuids['m1.small.i386']).memory, 3072)
+
+        # kept for the VM, but not offered any more
+        self.assertTrue(HardwareTemplate.query.get(
+                uuids['m1.tiny.i386']).retired)
+        response = self.app.get(
+            "/rest/hosting/htemplate/list?%s" % get_auth_args())
+        listed = [x['name'] for x in json.loads(response.data)['templates']]
+        self.assertEqual(len(listed), 6)
+        self.assertFalse('m1.tiny.i386' in listed)
+        form = {'name': str(uuid.uuid1()),
+                'package': pkg_uuid,
+                'hardware': uuids['m1.tiny.i386'],
+                'ecp_username': USER}
+        form['ecp_auth_digest'] = auth.get_digest(PASSWD, form)
+        response = self.app.put("/rest/hosting/vm", data=form)
+        self.assertTrue('does not exist' in
+                        json.loads(response.data)['message'])
+
+        # the type is back in Nova
+        self.server.instance_types.append(('m1.tiny', 512, 1, 0, 1))
+        novaconn._manager._instance_types_expire = 0
+        summary = HardwareTemplate.sync_with_nova()
+        self.assertEqual((summary['added'], summary['updated']), (1, 1))
+        self.assertFalse(HardwareTemplate.query.get(
+                uuids['m1.tiny.i386']).retired)
+
+    def test_no_types(self):
+        self.server.instance_types = []
+        self.assertRaises(RuntimeError, HardwareTemplate.sync_with_nova)
+        self.assertEqual(HardwareTemplate.query.count(), 1)
+
+
+class CountingWorker(provision.ProvisionWorker):
+    "Pretend to convert package, count conversions"
+    conversions = 0
+    fail = False
+
+    def _download_and_convert_pkg(self, pkg_uuid, arch):
+        CountingWorker.conversions += 1
+        time.sleep(0.2)
+        if self.fail:
+            raise RuntimeError('broken package')
+        package = Package.query.get(pkg_uuid)
+        package.nova_id = 'ami-converted'
+        package.state = 'ready'
+        db.session.commit()
+        return package
+
+
+class PackageClaimTestCase(ApiTestCase):
+    def setUp(self):
+        ApiTestCase.setUp(self)
+        CountingWorker.conversions = 0
+        CountingWorker.fail = False
+        self.pkg_uuid = str(uuid.uuid1())
+
+    def get_pkg(self, results):
+        worker = CountingWorker(None, None, None, self.pkg_uuid)
+        try:
+            results.append(
+                worker.get_or_download_pkg(self.pkg_uuid, 'i386').nova_id)
+        except RuntimeError, e:
+            results.append(e)
+        finally:
+            db.session.remove()
+
+    def run_workers(self, count):
+        results = []
+        threads = [Thread(target=self.get_pkg, args=(results,))
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_conversion(self):
+        results = self.run_workers(8)
+        self.assertEqual(CountingWorker.conversions, 1)
+        self.assertEqual(results, ['ami-converted'] * 8)
+
+    def test_failure_propagated(self):
+        CountingWorker.fail = True
+        results = self.run_workers(4)
+        self.assertEqual(CountingWorker.conversions, 1)
+        self.assertTrue(all(isinstance(x, RuntimeError) for x in results))
+        self.assertTrue(Package.query.get(self.pkg_uuid) is None)
+
+    def test_expired_claim(self):
+        self.assertTrue(Package.claim(self.pkg_uuid, 60))
+        self.assertFalse(Package.claim(self.pkg_uuid, 60))
+        Package.query.filter_by(ecp_uuid=self.pkg_uuid).update(
+            {'updated': datetime.now() - timedelta(seconds=120)})
+        db.session.commit()
+        self.assertTrue(Package.claim(self.pkg_uuid, 60))
+        self.assertFalse(Package.claim(self.pkg_uuid, 60))
+
+    def test_crashed_claim_taken_over(self):
+        # the claimer crashed right after claiming
+        self.assertTrue(Package.claim(self.pkg_uuid, 60))
+        app.config['PACKAGE_CLAIM_TTL'] = 1
+        wait_poll, limit = provision.WAIT_POLL, provision.DOWNLOAD_LIMIT
+        # shorter than TTL, the wait must not end before the takeover
+        provision.WAIT_POLL, provision.DOWNLOAD_LIMIT = 0.1, 0.5
+        try:
+            results = self.run_workers(1)
+        finally:
+            provision.WAIT_POLL, provision.DOWNLOAD_LIMIT = wait_poll, limit
+            del app.config['PACKAGE_CLAIM_TTL']
+        self.assertEqual(results, ['ami-converted'])
+        self.assertEqual(CountingWorker.conversions, 1)
+
+    def test_downloading_not_listed(self):
+        Package.claim(self.pkg_uuid, 60)
+        response = self.app.get(
+            "/rest/hosting/ptemplate/list?%s" % get_auth_args())
+        uuids = [x['uuid'] for x in json.loads(response.data)['packages']]
+        self.assertEqual(uuids, [self.pkg.ecp_uuid])
+
+
+class StageJob(object):
+    "Job holding a stage slot, records concurrency"
+    def __init__(self, sched, stage_name, concurrency, release=None):
+        self.sched = sched
+        self.stage_name = stage_name
+        self.concurrency = concurrency
+        self.release = release
+        self.done = Event()
+
+    def run(self):
+        with self.sched.stage(self.stage_name):
+            with self.concurrency['lock']:
+                self.concurrency['now'] += 1
+                self.concurrency['max'] = max(
+                    self.concurrency['max'], self.concurrency['now'])
+            if self.release:
+                self.release.wait(5)
+            else:
+                time.sleep(0.05)
+            with self.concurrency['lock']:
+                self.concurrency['now'] -= 1
+        self.done.set()
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.concurrency = {'now': 0, 'max': 0, 'lock': Lock()}
+
+    def test_stage_limit(self):
+        sched = scheduler.Scheduler(
+            workers=6, fast_workers=1, limits={'convert': 2}).start()
+        jobs = [StageJob(sched, 'convert', self.concurrency)
+                for i in range(6)]
+        for job in jobs:
+            sched.submit(job)
+        sched.stop()
+        self.assertTrue(all(x.done.is_set() for x in jobs))
+        self.assertEqual(self.concurrency['max'], 2)
+        stats = sched.stats()
+        self.assertEqual(stats['stages']['convert']['count'], 6)
+        self.assertEqual(stats['lanes']['slow']['count'], 6)
+
+    def test_fast_lane(self):
+        sched = scheduler.Scheduler(workers=1, fast_workers=1).start()
+        release = Event()
+        slow = StageJob(sched, 'convert', self.concurrency, release)
+        queued = StageJob(sched, 'convert', self.concurrency, release)
+        fast = StageJob(sched, 'nova', self.concurrency)
+        sched.submit(slow)
+        sched.submit(queued)
+        sched.submit(fast, fast=True)
+        self.assertTrue(fast.done.wait(5))
+        self.assertFalse(slow.done.is_set())
+        self.assertEqual(sched.stats()['lanes']['slow']['queued'], 1)
+        release.set()
+        sched.stop()
+        self.assertTrue(queued.done.is_set())
+
+
+class ProvisionStatsTestCase(ApiTestCase):
+    def test_stats(self):
+        response = self.app.get(
+            "/rest/hosting/provision/stats?%s" % get_auth_args())
+        data = json.loads(response.data)
+        self.assertEqual(data['errno'], 0)
+        self.assertEqual(sorted(data['lanes']), ['fast', 'slow'])
+        self.assertTrue('convert' in data['stages'])
+
+
+class FinishingWorker(provision.ProvisionWorker):
+    "Complete Task without doing anything"
+    runs = []
+
+    def run(self):
+        FinishingWorker.runs.append(self.task_uuid)
+        task = Task.query.get(self.task_uuid)
+        task.completed = 100
+        db.session.commit()
+
+
+class ProvisionDaemonTestCase(ApiTestCase):
+    def setUp(self):
+        ApiTestCase.setUp(self)
+        FinishingWorker.runs = []
+        self.task = Task(vm_uuid=str(uuid.uuid1()),
+                         hardware_uuid=self.hardware.ecp_uuid,
+                         package_uuid=self.pkg.ecp_uuid)
+        db.session.add(self.task)
+        db.session.commit()
+        self.task_uuid = self.task.ecp_uuid
+
+    def test_claim_lease(self):
+        claimed = Task.claim_pending('a', 60, 10, 3)
+        self.assertEqual([x.ecp_uuid for x in claimed], [self.task_uuid])
+        self.assertEqual(Task.claim_pending('b', 60, 10, 3), [])
+        # daemon a crashed
+        Task.query.filter_by(ecp_uuid=self.task_uuid).update(
+            {'lease_expires': datetime.now() - timedelta(seconds=1)})
+        db.session.commit()
+        task, = Task.claim_pending('b', 60, 10, 3)
+        self.assertEqual((task.lease_owner, task.attempts), ('b', 2))
+
+    def test_max_attempts(self):
+        Task.query.filter_by(ecp_uuid=self.task_uuid).update(
+            {'attempts': 3})
+        db.session.commit()
+        self.assertEqual(Task.claim_pending('a', 60, 10, 3), [])
+        task = Task.query.populate_existing().get(self.task_uuid)
+        self.assertTrue(task.is_error)
+        self.assertEqual(task.completed, 100)
+
+    def test_daemon_runs_task(self):
+        sched = scheduler.Scheduler(workers=1, fast_workers=1).start()
+        daemon = provisiond.ProvisionDaemon(sched)
+        daemon.worker_class = FinishingWorker
+        self.assertEqual(daemon.poll(), 1)
+        sched.stop()
+        self.assertEqual(FinishingWorker.runs, [self.task_uuid])
+        task = Task.query.populate_existing().get(self.task_uuid)
+        self.assertEqual((task.completed, task.lease_owner), (100, None))
+        self.assertEqual(daemon.poll(), 0)
+
+    def test_lease_keeper(self):
+        keeper = provisiond.LeaseKeeper(lease=1)
+        keeper.hold(self.task)
+        db.session.commit()
+        self.assertEqual(Task.claim_pending('b', 60, 10, 3), [])
+        expires = self.task.lease_expires
+        keeper.start()
+        try:
+            time.sleep(0.5)
+            task = Task.query.populate_existing().get(self.task_uuid)
+            self.assertTrue(task.lease_expires > expires)
+        finally:
+            keeper.stop()
+            keeper.join()
+        # API process was recycled
+        time.sleep(1)
+        task, = Task.claim_pending('b', 60, 10, 3)
+        self.assertEqual((task.lease_owner, task.attempts), ('b', 2))
+
+    def crashing_worker(self):
+        worker = provision.ProvisionWorker(
+            self.task.vm_uuid, self.task_uuid,
+            self.hardware.ecp_uuid, self.pkg.ecp_uuid)
+        def crash(nova_id):
+            raise RuntimeError('crashed')
+        worker.instance_created = crash
+        return worker
+
+    def test_retry_reuses_instance(self):
+        manager = novaconn._manager
+        novaconn._manager = fakes.FakeNovaManager()
+        try:
+            # process died after run_instances
+            self.assertRaises(RuntimeError, self.crashing_worker()._run)
+            provision.ProvisionWorker(
+                self.task.vm_uuid, self.task_uuid,
+                self.hardware.ecp_uuid, self.pkg.ecp_uuid).run()
+            reservations = novaconn._manager.conn.reservations
+        finally:
+            novaconn._manager = manager
+        self.assertEqual(len(reservations), 1)
+        vm = VM.query.get(self.task.vm_uuid)
+        self.assertEqual(vm.nova_id, reservations[0].instances[0].id)
+        task = Task.query.populate_existing().get(self.task_uuid)
+        self.assertEqual((task.completed, task.is_error), (100, False))
+
+    def test_failed_instance_terminated(self):
+        manager = novaconn._manager
+        novaconn._manager = fakes.FakeNovaManager()
+        try:
+            self.crashing_worker().run()
+            reservation, = novaconn._manager.conn.reservations
+        finally:
+            novaconn._manager = manager
+        self.assertEqual(reservation.instances, [])
+        task = Task.query.populate_existing().get(self.task_uuid)
+        self.assertEqual((task.is_error, task.message), (True, 'crashed'))
+
+    def test_vm_put_daemon_mode(self):
+        app.config['PROVISION_MODE'] = 'daemon'
+        try:
+            form = {'name': str(uuid.uuid1()),
+                    'package': self.pkg.ecp_uuid,
+                    'hardware': self.hardware.ecp_uuid,
+                    'ecp_username': USER}
+            form['ecp_auth_digest'] = auth.get_digest(PASSWD, form)
+            response = self.app.put("/rest/hosting/vm", data=form)
+        finally:
+            del app.config['PROVISION_MODE']
+        data = json.loads(response.data)
+        self.assertEqual(data['errno'], 0)
+        claimed = Task.claim_pending('a', 60, 10, 3)
+        self.assertEqual(len(claimed), 2)
+
+    def test_vm_put_submit_fails(self):
+        def get_scheduler():
+            raise RuntimeError('scheduler down')
+        old_get_scheduler = api.get_scheduler
+        api.get_scheduler = get_scheduler
+        try:
+            vm_uuid = str(uuid.uuid1())
+            form = {'name': vm_uuid,
+                    'package': self.pkg.ecp_uuid,
+                    'hardware': self.hardware.ecp_uuid,
+                    'ecp_username': USER}
+            form['ecp_auth_digest'] = auth.get_digest(PASSWD, form)
+            response = self.app.put("/rest/hosting/vm", data=form)
+        finally:
+            api.get_scheduler = old_get_scheduler
+        data = json.loads(response.data)
+        self.assertEqual(data['errno'], 1)
+        task = Task.query.filter_by(vm_uuid=vm_uuid).one()
+        self.assertEqual((task.is_error, task.completed, task.lease_owner),
+                         (True, 100, None))
+        # the caller was told it failed, provisiond must not run it
+        task.lease_expires = datetime.now() - timedelta(seconds=1)
+        db.session.commit()
+        claimed = Task.claim_pending('a', 60, 10, 3)
+        self.assertEqual([x.ecp_uuid for x in claimed], [self.task_uuid])
+
+    def test_upgrade_db(self):
+        path = tempfile.mktemp(suffix='.db')
+        engine = create_engine('sqlite:///' + path)
+        try:
+            engine.execute('CREATE TABLE task (ecp_uuid VARCHAR(36) '
+                           'PRIMARY KEY, message TEXT)')
+            added = models.upgrade_db(engine)
+            self.assertTrue('task.lease_owner' in added)
+            self.assertTrue('task.completed' in added)
+            self.assertTrue('ix_task_started' in added)
+            self.assertTrue('ix_task_pending' in added)
+            self.assertEqual(models.upgrade_db(engine), [])
+        finally:
+            engine.dispose()
+            os.unlink(path)
+
+
+class ConversionTestCase(ApiTestCase):
+    def setUp(self):
+        if not has_mke2fs():
+            self.skipTest('mke2fs is not installed')
+        ApiTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.repo_dir = os.path.join(self.dir, 'repo')
+        os.mkdir(self.repo_dir)
+        qemu_img, publish = fakes.write_fake_tools(
+            self.dir, publish_delay=0.2, keep_dir=self.dir)
+        self.kernels = {}
+        packages = {}
+        for i in range(3):
+            pkg_uuid = str(uuid.uuid4())
+            self.kernels[pkg_uuid] = os.urandom(100 * 1024)
+            disk = os.path.join(self.dir, 'disk.img')
+            make_ext_image(
+                disk, 'ext4', 1024 * 1024,
+                [('boot/vmlinuz-2.6.32-%s' % i, self.kernels[pkg_uuid]),
+                 ('boot/initrd.img-2.6.32-%s' % i, 'initrd')])
+            write_sector(disk, 0, [mbr_entry(0x83, 2048, 16384, True)])
+            packages[pkg_uuid] = make_package(
+                make_gzip(open(disk, 'rb').read()))
+        self.server = PackageServer(packages).start()
+        self.config = dict(app.config)
+        app.config.update(
+            REPO_DIR=self.repo_dir,
+            PACKAGE_DOWNLOAD_URL_TMPL=self.server.url_tmpl,
+            QEMU_IMG=qemu_img,
+            PUBLISH_SCRIPT=publish)
+
+    def tearDown(self):
+        app.config.clear()
+        app.config.update(self.config)
+        self.server.stop()
+        shutil.rmtree(self.dir)
+        ApiTestCase.tearDown(self)
+
+    def convert(self, pkg_uuid, results):
+        task = Task(vm_uuid=None)
+        db.session.add(task)
+        db.session.commit()
+        worker = provision.ProvisionWorker(
+            None, task.ecp_uuid, None, pkg_uuid)
+        try:
+            results[pkg_uuid] = worker.get_or_download_pkg(
+                pkg_uuid, 'x86_64').nova_id
+        except Exception, e:
+            results[pkg_uuid] = e
+        finally:
+            db.session.remove()
+
+    def test_concurrent_conversions(self):
+        cwd = os.getcwd()
+        converted = metrics.STAGE_SECONDS.count('qcow2 convert')
+        results = {}
+        threads = [Thread(target=self.convert, args=(x, results))
+                   for x in self.kernels]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(os.getcwd(), cwd)
+        for pkg_uuid, kernel in self.kernels.items():
+            self.assertEqual(results[pkg_uuid], 'emi-' + pkg_uuid[:7])
+            tar = tarfile.open(
+                os.path.join(self.dir, '%s.tar.gz' % pkg_uuid))
+            self.assertEqual(sorted(tar.getnames()), sorted(
+                    [pkg_uuid + '-initrd', pkg_uuid + '-vmlinuz',
+                     pkg_uuid + '.img']))
+            self.assertEqual(
+                tar.extractfile(pkg_uuid + '-vmlinuz').read(), kernel)
+            tar.close()
+        self.assertEqual(
+            metrics.STAGE_SECONDS.count('qcow2 convert') - converted, 3)
+        # scratch and download dirs are removed
+        self.assertEqual(os.listdir(self.repo_dir), [])
+
+
+class MetricsTestCase(ApiTestCase):
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test', ['name'],
+                                      buckets=(0.1, 1))
+        metrics._registry.remove(histogram)
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.5, 'a')
+        self.assertEqual(histogram.render()[2:], [
+                'test_seconds_bucket{name="a",le="0.1"} 1',
+                'test_seconds_bucket{name="a",le="1"} 2',
+                'test_seconds_bucket{name="a",le="+Inf"} 2',
+                'test_seconds_sum{name="a"} 0.55',
+                'test_seconds_count{name="a"} 2'])
+
+    def test_child_rusage(self):
+        before = metrics.CHILD_CPU.get('test', 'user') + \
+            metrics.CHILD_CPU.get('test', 'system')
+        returncode, stdout, stderr = metrics.run(
+            ['sh', '-c', 'i=0; while [ $i -lt 50000 ]; do i=$((i+1)); '
+             'done; echo done; exit 3'], 'test')
+        self.assertEqual((returncode, stdout), (3, 'done\n'))
+        after = metrics.CHILD_CPU.get('test', 'user') + \
+            metrics.CHILD_CPU.get('test', 'system')
+        self.assertTrue(after > before)
+
+    def test_timed_proxy(self):
+        proxy = metrics.TimedProxy(FakeAdminClient(), 'test')
+        proxy.get_user('admin')
+        self.assertEqual(proxy.calls, 1)
+        self.assertEqual(
+            metrics.NOVA_SECONDS.count('test.get_user'), 1)
+
+    def test_metrics_route(self):
+        local = {'REMOTE_ADDR': '127.0.0.1'}
+        self.app.get("/rest/hosting/htemplate/list?%s" % get_auth_args())
+        response = self.app.get('/metrics', environ_base=local)
+        self.assertEqual(response.status_code, 404)
+        app.config['METRICS_ENABLED'] = True
+        try:
+            response = self.app.get('/metrics', environ_base=local)
+            remote = self.app.get(
+                '/metrics', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        finally:
+            del app.config['METRICS_ENABLED']
+        self.assertEqual(remote.status_code, 403)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertTrue(
+            'spotcloud_api_request_seconds_count{endpoint="htemplate/list",'
+            'method="GET"}' in response.data)
+
+
+class BenchTestCase(unittest.TestCase):
+    def setUp(self):
+        if not has_mke2fs():
+            self.skipTest('mke2fs is not installed')
+        self.dir = tempfile.mkdtemp()
+        self.disk = os.path.join(self.dir, 'disk.img')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_layouts(self):
+        for layout in fakes.LAYOUTS:
+            fakes.make_disk(self.disk, 16 * 1024 * 1024, layout,
+                            kernel_size=64 * 1024)
+            parts = partitions.read_partitions(self.disk)
+            root = partitions.find_root(parts)
+            boot = partitions.find_boot(parts, root)
+            self.assertEqual(boot == root, layout in ('mbr', 'none'))
+            fs = extfs.ExtFS(self.disk, boot.start)
+            try:
+                boot_dir = boot == root and '/boot' or '/'
+                self.assertEqual(len(fs.glob(boot_dir, 'vmlinuz-*')), 1)
+                self.assertEqual(len(fs.glob(boot_dir, 'initrd.*')), 1)
+            finally:
+                fs.close()
+
+    def test_run_level(self):
+        fakes.make_disk(self.disk, 16 * 1024 * 1024, 'mbr-boot',
+                        kernel_size=64 * 1024)
+        xvm2 = fakes.make_xvm2(self.disk, self.disk + '.xvm2')
+        config = dict(app.config)
+        manager = novaconn._manager
+        server, hardware_uuid = bench.setup(self.dir, {})
+        try:
+            result = bench.run_level(
+                server, hardware_uuid, open(xvm2, 'rb').read(), 2)
+        finally:
+            server.stop()
+            db.session.remove()
+            novaconn._manager = manager
+            app.config.clear()
+            app.config.update(config)
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(result['stages']['publish'][0], 2)
+        self.assertEqual(result['stages']['run_instances'][0], 2)
+
+
+class FakeNovaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = fakes.FakeNovaServer().start()
+        self.manager = NovaConnectionManager(
+            {'NOVA_ENDPOINT': self.server.url,
+             'NOVA_REGION': 'nova',
+             'NOVA_ACCESS_KEY': 'admin-access',
+             'NOVA_SECRET_KEY': 'admin-secret',
+             'USERNAME': 'admin',
+             'PROJECT_NAME': 'project'})
+        self.old_manager = novaconn._manager
+        novaconn._manager = self.manager
+
+    def tearDown(self):
+        novaconn._manager = self.old_manager
+        self.server.stop()
+
+    def test_instances(self):
+        added = self.server.add_instances(3)
+        self.assertEqual(sorted(novaconn.get_instances_dict()),
+                         sorted(x[1] for x in added))
+        self.assertEqual(novaconn.get_instance_id(added[1][0]),
+                         added[1][1])
+        with novaconn.nova_connection() as conn:
+            reservation = conn.run_instances(
+                'ami-test', instance_type='m1.tiny')
+            conn.terminate_instances([added[0][1]])
+        instances = novaconn.get_instances_dict()
+        self.assertEqual(len(instances), 3)
+        self.assertEqual(
+            instances[reservation.instances[0].id].state, 'scheduling')
+        self.assertEqual(self.server.calls['DescribeUser'], 1)
+
+    def test_instance_ids_not_reused(self):
+        added = self.server.add_instances(3)
+        with novaconn.nova_connection() as conn:
+            conn.terminate_instances([added[0][1]])
+            reservation = conn.run_instances('ami-test')
+        instances = novaconn.get_instances_dict()
+        self.assertEqual(len(instances), 3)
+        self.assertFalse(reservation.instances[0].id in
+                         [x[1] for x in added])
+        self.assertEqual(len(self.server.reservations), 3)
+
+    def test_admin(self):
+        admin = self.manager.admin_client()
+        self.assertEqual(admin.get_user('nobody'), None)
+        self.assertEqual(self.manager.credentials(),
+                         ('admin-access:project', 'admin-secret'))
+        types = dict((x.name, (x.memory_mb, x.vcpus))
+                     for x in admin.get_instance_types())
+        self.assertEqual(types['m1.small'], ('2048', '1'))
+        self.server.add_instances(2)
+        hosts = admin.get_hosts()
+        self.assertEqual([(x.hostname, x.instance_count) for x in hosts],
+                         [('compute-1', '2')])
+
+    def test_credentials_zip(self):
+        content = novaconn.get_credentials_zip('admin', 'project')
+        archive = zipfile.ZipFile(StringIO(content))
+        self.assertTrue('cert.pem' in archive.namelist())
+        novarc = archive.read('novarc')
+        self.assertTrue(
+            'EC2_ACCESS_KEY="admin-access:project"' in novarc)
+        self.assertTrue('EC2_URL="%s/services/Cloud"' % self.server.url
+                        in novarc)
+        self.assertRaises(Exception, novaconn.get_credentials_zip,
+                          'nobody', 'project')
+        self.assertEqual(self.server.calls['GenerateX509ForUser'], 2)
+
+    def test_instance_types(self):
+        self.assertEqual(novaconn.get_instance_types()[1],
+                         ('m1.small', 2048, 1))
+        novaconn.get_instance_types()
+        self.assertEqual(self.server.calls['DescribeInstanceTypes'], 1)
+
+    def test_failure_injection(self):
+        self.server.fail('DescribeInstances')
+        self.assertRaises(Exception, novaconn.get_instances_dict)
+        self.assertEqual(novaconn.get_instances_dict(), {})
+        self.assertTrue(
+            metrics.NOVA_ERRORS.get('ec2.get_all_instances') > 0)
+
+    def test_latency(self):
+        self.server.action_latency['DescribeHosts'] = 0.2
+        started = time.time()
+        self.manager.admin_client().get_hosts()
+        self.assertTrue(time.time() - started >= 0.2)
+
+
+class CapacityTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = dict(app.config)
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///%s' % os.path.join(
+                self.dir, 'test.db'),
+            SPOTCLOUD_USER=USER,
+            SPOTCLOUD_PASSWD=PASSWD)
+        db.session.remove()
+        db.create_all()
+        self.app = app.test_client()
+        pkg = Package(nova_id='ami-capacity', state='ready')
+        db.session.add(pkg)
+        db.session.commit()
+        self.pkg_uuid = pkg.ecp_uuid
+        self.server = fakes.FakeNovaServer(
+            hosts=['compute-1', 'compute-2', 'volume-1',
+                   'compute-3']).start()
+        self.server.host_fields['compute-1'] = {
+            'memoryMb': 16384, 'vcpus': 8, 'localGb': 100}
+        # neither a volume only host nor a host with compute
+        # service down can run instances
+        self.server.host_fields['volume-1'] = {
+            'compute': None, 'volume': 'up'}
+        self.server.host_fields['compute-3'] = {
+            'compute': 'down', 'memoryMb': 65536, 'vcpus': 32}
+        self.old_manager = novaconn._manager
+        novaconn._manager = NovaConnectionManager(
+            {'NOVA_ENDPOINT': self.server.url,
+             'NOVA_REGION': 'nova',
+             'NOVA_ACCESS_KEY': 'admin-access',
+             'NOVA_SECRET_KEY': 'admin-secret'})
+        self.capacity = capacity.Capacity(interval=3600)
+        capacity._capacity = self.capacity
+        self.capacity.start()
+        self.wait(lambda: self.capacity.age() is not None)
+        # refresh made templates of fake Nova instance types
+        self.small_uuid = HardwareTemplate.query.filter_by(
+            name='m1.small.x86_64').one().ecp_uuid
+
+    def tearDown(self):
+        self.capacity.stop()
+        self.capacity.join()
+        capacity._capacity = None
+        novaconn._manager = self.old_manager
+        self.server.stop()
+        db.session.remove()
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.dir)
+
+    def wait(self, condition):
+        for i in range(100):
+            if condition():
+                return
+            time.sleep(0.02)
+        self.fail('condition was not met')
+
+    def add_vm(self):
+        vm = VM(state='running', nova_id='i-%s' % uuid.uuid1().hex[:8],
+                hardware_uuid=self.small_uuid, package_uuid=self.pkg_uuid)
+        db.session.add(vm)
+        db.session.commit()
+        return vm
+
+    def get(self):
+        response = self.app.get(
+            "/rest/hosting/utilization?%s" % get_auth_args())
+        return json.loads(response.data)
+
+    def test_totals(self):
+        data = self.get()
+        self.assertEqual(data['total_memory'], 16384 + 8000)
+        self.assertEqual(data['cpus'], 8 + 4)
+        self.assertEqual(data['total_storage'], 100 * 1024 + 800000)
+        self.assertEqual(data['free_memory'], data['total_memory'])
+        self.assertEqual(self.capacity.hosts, 2)
+
+    def test_incremental(self):
+        calls = dict(self.server.calls)
+        vm_uuid = self.add_vm().ecp_uuid
+        data = self.get()
+        self.assertEqual(data['vms'], 1)
+        self.assertEqual(data['free_memory'], 16384 + 8000 - 2048)
+        self.assertEqual(data['free_cpus'], 11)
+        self.assertEqual(data['committed_storage'], 20 * 1024)
+        db.session.delete(VM.query.get(vm_uuid))
+        db.session.commit()
+        self.assertEqual(self.get()['vms'], 0)
+        # served from memory only
+        self.assertEqual(self.server.calls, calls)
+
+    def test_bulk_delete_recounts(self):
+        self.add_vm()
+        hosts_calls = self.server.calls['DescribeHosts']
+        VM.query.delete()
+        db.session.commit()
+        self.wait(lambda: self.server.calls['DescribeHosts'] > hosts_calls)
+        self.wait(lambda: self.capacity.vms == 0)
+
+    def test_concurrent_sync(self):
+        # another process added the new type first
+        sync_with_nova = HardwareTemplate.__dict__['sync_with_nova']
+        def conflict():
+            raise IntegrityError('INSERT', {}, Exception('not unique'))
+        HardwareTemplate.sync_with_nova = staticmethod(conflict)
+        try:
+            self.add_vm()
+            self.capacity.vms = None
+            self.capacity.refresh()
+        finally:
+            HardwareTemplate.sync_with_nova = sync_with_nova
+        self.assertEqual(self.capacity.vms, 1)
+
+    def test_load_average(self):
+        self.add_vm()
+        self.capacity._loads_at -= 15 * 60
+        data = self.get()
+        self.assertTrue(data['loadone'] > data['loadfifteen'] > 0)
+        self.assertTrue(data['loadone'] <= round(1 / 12.0, 2))
+
+
+class ApiBenchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = dict(app.config)
+        self.manager = novaconn._manager
+
+    def tearDown(self):
+        if reconciler._reconciler is not None:
+            reconciler._reconciler.stop()
+            reconciler._reconciler = None
+        db.session.remove()
+        novaconn._manager = self.manager
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.dir)
+
+    def test_run_level(self):
+        server, hardware_uuid, package_uuid = apibench.setup(self.dir)
+        try:
+            vms = apibench.populate(server, hardware_uuid, package_uuid, 50)
+            results = apibench.run_level(vms, 4, 20)
+        finally:
+            server.stop()
+        for name in ('vm/list', 'vm/<uuid>', 'get_instance_id',
+                     'sync_with_nova'):
+            self.assertEqual(results[name]['errors'], [])
+        self.assertEqual(results['vm/list']['count'], 20)
+        self.assertTrue(results['vm/list']['p99'] >=
+                        results['vm/list']['p50'])
+        self.assertEqual(VM.query.filter_by(state='running').count(), 50)
+
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = dict(app.config)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % (
+            os.path.join(self.dir, 'test.db'))
+        db.session.remove()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.dir)
+
+    def pragma(self, name):
+        return db.session.execute('PRAGMA %s' % name).scalar()
+
+    def test_sqlite_pragmas(self):
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('busy_timeout'), 30000)
+        self.assertEqual(self.pragma('synchronous'), 1) # NORMAL
+        self.assertEqual(self.pragma('auto_vacuum'), 2) # INCREMENTAL
+
+    def test_pool_options(self):
+        app.config.update(SQLALCHEMY_POOL_SIZE=5,
+                          SQLALCHEMY_POOL_RECYCLE=3600,
+                          SQLALCHEMY_MAX_OVERFLOW=20)
+        options = {'pool_size': 5, 'pool_recycle': 3600}
+        db.apply_driver_hacks(app, make_url('postgresql://db/sc'), options)
+        self.assertEqual(options['max_overflow'], 20)
+        self.assertEqual(options['pool_size'], 5)
+        options = {'pool_size': 5, 'pool_recycle': 3600}
+        db.apply_driver_hacks(app, make_url('sqlite:///sc.db'), options)
+        self.assertFalse('pool_size' in options)
+        self.assertFalse('max_overflow' in options)
+
+    def test_session_scope(self):
+        with session_scope() as session:
+            session.add(Task('vm-1'))
+        self.assertEqual(Task.query.count(), 1)
+        try:
+            with session_scope() as session:
+                session.add(Task('vm-2'))
+                session.flush()
+                raise RuntimeError('failed job')
+        except RuntimeError:
+            pass
+        self.assertEqual(Task.query.count(), 1)
+
+    def test_session_per_thread(self):
+        sessions = []
+
+        def run():
+            with session_scope() as session:
+                sessions.append(session)
+                session.add(Task('vm-thread'))
+
+        threads = [Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(id(x) for x in sessions)), 4)
+        self.assertEqual(Task.query.count(), 4)
+
+    def test_bench_writers(self):
+        dbbench.setup(self.dir, 'wal', 30000)
+        for processes in (False, True):
+            result = dbbench.run_level(4, 10, processes)
+            self.assertEqual(result['errors'], [])
+            self.assertEqual(result['commits'], 80)
+
+
+
+class RetentionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = dict(app.config)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % (
+            os.path.join(self.dir, 'test.db'))
+        db.session.remove()
+        db.create_all()
+        self.now = datetime.now()
+
+    def tearDown(self):
+        db.session.remove()
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.dir)
+
+    def add_tasks(self, count, days, completed=100, message='',
+                  lease=None):
+        uuids = []
+        for i in range(count):
+            task = Task('vm-%s' % i)
+            task.started = self.now - timedelta(days=days, seconds=i)
+            task.completed = completed
+            task.message = message
+            if lease is not None:
+                task.lease_owner = 'a'
+                task.lease_expires = self.now + timedelta(seconds=lease)
+            db.session.add(task)
+            uuids.append(task.ecp_uuid)
+        db.session.commit()
+        return uuids
+
+    def make(self, **kw):
+        options = dict(age=30*24*60*60, count=None, archive_dir=self.dir,
+                       batch=3, pause=0)
+        options.update(kw)
+        return retention.Retention(**options)
+
+    def test_age(self):
+        old = self.add_tasks(10, 40)
+        self.add_tasks(5, 1)
+        running = self.add_tasks(2, 40, completed=50, lease=60)
+        summary = self.make().sweep(self.now)
+        self.assertEqual(summary['deleted'], 10)
+        self.assertEqual(summary['archived'], 10)
+        self.assertEqual(summary['batches'], 4)
+        self.assertEqual(Task.query.count(), 7)
+        for ecp_uuid in running:
+            self.assertTrue(Task.query.get(ecp_uuid) is not None)
+        path = os.path.join(
+            self.dir, self.now.strftime('tasks-%Y%m%d.jsonl.gz'))
+        lines = gzip.open(path).read().splitlines()
+        self.assertEqual(sorted(json.loads(x)['ecp_uuid'] for x in lines),
+                         sorted(old))
+        self.assertEqual(self.make().sweep(self.now)['deleted'], 0)
+
+    def test_abandoned(self):
+        lost = self.add_tasks(2, 40, completed=50, message='Downloading',
+                              lease=-60)
+        recent = self.add_tasks(1, 1, completed=50)
+        provisioned = self.add_tasks(1, 40, completed=50)
+        Task.query.get(provisioned[0]).vm_uuid = 'vm-provisioned'
+        db.session.add(VM(ecp_uuid='vm-provisioned', state='running',
+                          hardware_uuid='h', package_uuid='p'))
+        db.session.commit()
+        summary = self.make().sweep(self.now)
+        self.assertEqual((summary['deleted'], summary['abandoned']), (2, 2))
+        self.assertEqual(sorted(x.ecp_uuid for x in Task.query.all()),
+                         sorted(recent + provisioned))
+        path = os.path.join(
+            self.dir, self.now.strftime('tasks-%Y%m%d.jsonl.gz'))
+        records = [json.loads(x) for x in gzip.open(path)]
+        self.assertEqual(sorted(x['ecp_uuid'] for x in records), sorted(lost))
+        self.assertEqual(
+            set((x['is_error'], x['completed'], x['message'])
+                for x in records),
+            set([(True, 100, 'Abandoned, VM is gone: Downloading')]))
+
+    def test_count(self):
+        self.add_tasks(4, 3)
+        newest = self.add_tasks(3, 1)
+        summary = self.make(age=None, count=3, archive_dir=None).sweep(
+            self.now)
+        self.assertEqual(summary['deleted'], 4)
+        self.assertEqual(summary['archived'], 0)
+        self.assertEqual(sorted(x.ecp_uuid for x in Task.query.all()),
+                         sorted(newest))
+
+    def test_vacuum(self):
+        self.add_tasks(200, 40, message='x' * 4000)
+        summary = self.make(batch=100).sweep(self.now)
+        self.assertEqual(summary['deleted'], 200)
+        self.assertTrue(summary['vacuumed_pages'] > 0)
+        self.assertEqual(
+            db.session.execute('PRAGMA freelist_count').scalar(), 0)
+
+    def test_one_sweeper(self):
+        self.add_tasks(3, 40)
+        sweeper = self.make()
+        lock = open(sweeper.lock_path(), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.assertEqual(sweeper.sweep(self.now), None)
+        finally:
+            lock.close()
+        self.assertEqual(sweeper.sweep(self.now)['deleted'], 3)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,4 +4,4 @@ Used to run from any uwsgi server or container
 """
 
 from spotcloudopenstack.app import app as application
-from spotcloudopenstack.api import rest
+from spotcloudopenstack.api import hosting